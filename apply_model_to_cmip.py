@@ -1,20 +1,25 @@
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
 import GrasslandModels
 
-from glob import glob
 from time import sleep
 
 from dask_jobqueue import SLURMCluster
 from dask.distributed import Client
 import dask
 
-from tools import cmip5_file_tools
+from tools import cmip5_file_tools, instrument_tools, mask_tools, pixel_tools, pipeline_tools, quantize_tools
 
 #################################################
 # Layout all the data
 
-climate_data_folder = 'data/cmip5_nc_files/'
+# The int16 copies of the cmip files once they're validated, see tools/quantize_tools.py
+climate_data_folder = quantize_tools.climate_data_folder()
 climate_model_info = cmip5_file_tools.get_cmip5_spec(models='all',scenarios='all')
 n_climate_models = len(climate_model_info)
 
@@ -26,6 +31,19 @@ phenograss_encoding = {'fCover':{'zlib':True,
 
 phenograss_output_folder = 'data/phenograss_nc_files/'
 
+# The phenograss output is only saved for cells in an ecoregion, with
+# pixel_tools, instead of the full CONUS grid which is mostly NaN.
+ecoregion_mask_file = 'data/ecoregion_mask.nc'
+
+# The annual tmean/pr for each climate model/scenario, made alongside the 
+# phenograss output and used in process_climate_data_for_website.py
+annual_climate_folder = 'data/climate_annual_nc_files/'
+os.makedirs(annual_climate_folder, exist_ok=True)
+
+# Timing/memory for every stage is written here, along with a dask
+# performance report for each climate model/scenario
+run_report_folder = 'data/run_reports/'
+
 ###############################################3
 # Dask/ceres config stuff
 ceres_workers          = 100 # Number of slurm jobs started
@@ -36,7 +54,28 @@ ceres_partition        = 'short'    # short: 48 hours, 55 nodes
                                     # medium: 7 days, 25 nodes
                                     # long:  21 days, 15 nodes
 
-chunk_sizes = {'latitude':4,'longitude':4,'time':-1}
+# Every climate model/scenario is split into tile_size x tile_size cell tiles,
+# each a single task on a worker. The chunks line up with the tiles so each
+# task only reads its own part of the files. 
+tile_size = 16
+chunk_sizes = {'latitude':tile_size,'longitude':tile_size,'time':-1}
+
+# The most (estimated) tile output on the cluster, or waiting to be written, 
+# at any one time. More tiles are submitted as others are written. The historic
+# tile forcing kept for the scenarios, about 40MB a tile, is on top of this.
+max_in_flight_gb = 20
+
+# The most jobs built ahead, ie. built but not yet finished. Each holds a lazy 
+# dataset and open output files, so this caps those on the head node while 
+# keeping the next jobs' tiles queued before the current ones run out.
+prefetch_jobs = 3
+
+# Start each 2006-2100 scenario from the phenograss state at the end of its 
+# historic run (with a warm-up overlap), instead of a full 1980-2100 run per 
+# scenario. Only set this once validate_segmented_phenograss.py has shown the
+# hand-off matches a full run with the real models, as every forecast 
+# depends on it.
+historic_state_handoff = False
 
 ######################################################
 # Setup dask cluster
@@ -57,15 +96,18 @@ while active_workers < (ceres_workers-1):
 print('all workers online')
 #dask_client = Client()
 
+run_report = instrument_tools.RunReport('apply_model_to_cmip', dask_client=dask_client)
+
 
 ###################################################
 # Don't import xarray until here so that it registers with dask
 import xarray as xr
-from tools import xarray_tools
+from tools import xarray_tools, product_tools
 
 #climate_model_name = 'ccsm4'
 #climate_model_files = 'data/NE_CO_ccsm4.nc4'
 other_var_ds = xr.open_dataset('data/other_variables.nc')
+output_mask = mask_tools.load_ecoregion_label(ecoregion_mask_file) > 0
 
 # One model for each of the ecoregions. These were determined in this study: https://github.com/sdtaylor/PhenograssReplication
 phenograss_model_files = ['models/ecoregion-vegtype_ETempForests_GR_PhenoGrass_4dac8b702c3241eb.json',  
@@ -75,37 +117,314 @@ phenograss_models = [GrasslandModels.utils.load_saved_model(f) for f in phenogra
 # Need to use numpy, as opposed to cython method, for gridded data.
 _ = [m.set_internal_method('numpy') for m in phenograss_models]
 
-#all_phenograss_output = []
-for ds_i, ds_info in enumerate(climate_model_info):
-    model_files = glob(climate_data_folder + ds_info['model_file_search_str'])
+if historic_state_handoff:
+    assert xarray_tools.is_segmented_run_validated(), 'historic_state_handoff needs a passing {f}, from validate_segmented_phenograss.py'.format(f=xarray_tools.segmented_validation_report_file)
+    # The report may be from another GrasslandModels install
+    _ = [xarray_tools.check_phenograss_state_api(m) for m in phenograss_models]
+    # Every scenario gets the most warm-up days any model needs
+    max_warmup_days = max([xarray_tools.phenograss_warmup_days(m) for m in phenograss_models])
+
+def phenograss_output_file(ds_i, climate_model_name, scenario, model):
+    # model metadata fitting_set looks like: 'ecoregion-vegtype_NWForests_GR'
+    model_info = model.metadata['fitting_set'].split('_')
+    model_ecoregion = model_info[1]
+    model_vegtype = model_info[2]
+    
+    output_file = 'phenograss_file{i}_{m}_{s}_{e}_{v}.nc4'.format(i=ds_i, m=climate_model_name, s=scenario,
+                                                                  e = model_ecoregion, v = model_vegtype)
+    return phenograss_output_folder + output_file, model_ecoregion
+
+# Each climate model/scenario is a job. Each climate model's historic job 
+# comes before its scenarios. Instead of running one job at a time, every
+# job is split into tiles and all the tiles are submitted to the cluster as
+# prioritized futures (pipeline_tools.FutureQueue), so the workers are kept 
+# busy until the final tile instead of idling at the end of each job.
+#   - A tile task reads the forcing for the tile and makes every phenograss
+#     model output, and the registered climate products, from that one read.
+#   - The historic tiles have the highest priority, as the scenario tiles can
+#     wait on them, then earlier jobs before later ones, so jobs finish roughly in order.
+#   - The tile outputs are written as they finish, each phenograss file with
+#     a pixel_tools.PixelFileWriter, so no job's output is ever all in memory.
+#   - Building each job's lazy dataset is slow, so it's done for one job after
+#     another in a background thread, and each job's tiles are submitted as
+#     soon as it's built, while the tiles of earlier jobs run.
+
+jobs = []
+for climate_model_name, scenario_info in itertools.groupby(enumerate(climate_model_info), key = lambda m: m[1]['climate_model_name']):
+    scenario_info = list(scenario_info)
+    historic_i, historic_spec = scenario_info[0]
+    historic_job_i = len(jobs)
+    jobs.append(dict(job_i = historic_job_i, ds_i = historic_i, climate_model_name = climate_model_name, scenario = 'historic', spec = historic_spec,
+                     scenarios_left = len(scenario_info)))
+    for ds_i, ds_info in scenario_info:
+        jobs.append(dict(job_i = len(jobs), historic_job_i = historic_job_i, ds_i = ds_i, climate_model_name = climate_model_name, 
+                         scenario = ds_info['scenario'], spec = ds_info))
+
+# The 1980-2005 historic data is the same for every scenario of a climate model.
+# So for each climate model it is written once, to its own 'historic' file, and
+# the scenario files are only 2006-2100. Each scenario phenograss run still
+# needs the days before 2006, and every scenario tile gets them from the 
+# historic tile at the same place, so the historic forcing is only read and
+# derived once per climate model. 
+#   - By default the historic tile forcing stays on the cluster, and each 
+#     scenario tile is a full 1980-2100 run with it in front of the scenario 
+#     forcing, with the historic days dropped from the output. 
+#   - With historic_state_handoff only the model state at the end of the 
+#     historic tile stays on the cluster, and each scenario tile starts from
+#     it, only re-running the warm-up days from the lazy historic dataset.
+# Either way a scenario tile is submitted once both the historic tile is
+# finished and the scenario job is built, whichever is last, and what's kept
+# from the historic tiles is released once every scenario of the climate 
+# model is finished.
+# The lazy historic datasets provide the last days of tmean, and the warm-up days.
+historic_datasets = {}
+
+# The finished historic tiles and the built scenario jobs are tracked from 
+# both threads, under this lock.
+handoff_lock = threading.Lock()
+
+# A slot for each job built but not finished, see prefetch_jobs. Set 
+# stop_preparing so the background thread stops waiting on one.
+job_slots = threading.Semaphore(prefetch_jobs)
+stop_preparing = threading.Event()
+
+def prepare_job(job):
+    """
+    Build the lazy dataset for a job (reading all the file metadata, which is 
+    slow for the hundreds of cmip files), and make its empty output files.
+    """
+    stage_tags = dict(model = job['climate_model_name'], scenario = job['scenario'])
+    is_historic = job['scenario'] == 'historic'
+    model_files = cmip5_file_tools.get_cmip5_files(model_spec = job['spec'], base_folder = climate_data_folder,
+                                                   get_historic = is_historic, get_forecast = not is_historic)
+    
+    print('building climate data {i}/{n} {m} {s}'.format(i=job['ds_i'], n=n_climate_models, m=job['climate_model_name'], s=job['scenario']))
+    with run_report.stage('compile_climate_data', count_dask_tasks = False, **stage_tags):
+        ds = xarray_tools.compile_cmip_model_data(climate_model_name =  job['climate_model_name'], 
+                                                  scenario =            job['scenario'], 
+                                                  climate_model_files = model_files, 
+                                                  other_var_ds =        other_var_ds, 
+                                                  chunk_sizes =         chunk_sizes,
+                                                  historic_ds =         None if is_historic else historic_datasets[job['climate_model_name']])
+    if is_historic:
+        historic_datasets[job['climate_model_name']] = ds
+        job['spinup_days'] = 0
+    elif historic_state_handoff:
+        # The warm-up days the phenograss runs need before the scenario. 
+        # Without the hand-off all the historic days come from the historic tiles.
+        job['spinup_days'] = max_warmup_days
+        ds = xarray_tools.with_prior_days(ds, historic_datasets[job['climate_model_name']], n_days = job['spinup_days'])
+    else:
+        job['spinup_days'] = 0
+    
+    job['ds'] = ds
+    job['tiles'] = pixel_tools.tile_slices(ds.latitude.size, ds.longitude.size, tile_size)
+    
+    fCover_template = ds.pr.isel(time = slice(job['spinup_days'], None)).rename('fCover')
+    job['writers'] = []
+    for model in phenograss_models:
+        output_file, _ = phenograss_output_file(job['ds_i'], job['climate_model_name'], job['scenario'], model)
+        job['writers'].append(pixel_tools.PixelFileWriter(output_file, fCover_template, output_mask, job['tiles'], 
+                                                          encoding = phenograss_encoding))
+    
+    # Tiles without any ecoregion cells are skipped entirely
+    job['active_tiles'] = [tile_i for tile_i in range(len(job['tiles'])) if job['writers'][0].n_tile_pixels(tile_i) > 0]
+    job['tiles_done'] = 0
+    job['annual_climate'] = None
+    job['historic_tile_futures'] = {}
+    return job
+
+def tile_bytes(job, tile_i):
+    """ 
+    Rough size of the output of one tile, the daily output of every phenograss
+    model and the annual climate, and the phenograss forcing of a historic tile
+    """
+    ds = job['ds']
+    latitude_slice, longitude_slice = job['tiles'][tile_i]
+    n_cells = (latitude_slice.stop - latitude_slice.start) * (longitude_slice.stop - longitude_slice.start) * ds.model.size * ds.scenario.size
+    n_days = ds.time.size - job['spinup_days']
+    n_daily = len(phenograss_models)
+    if job['scenario'] == 'historic' and not historic_state_handoff:
+        n_daily += len(xarray_tools.phenograss_timeseries_vars)
+    return n_cells * (n_daily * n_days + 2 * n_days / 365) * 4
+
+def run_tile(ds_tile, historic_tile=None, spinup_days=0):
+    """
+    Every phenograss model output, and the registered climate products, for
+    one tile of a climate model/scenario. This runs on a worker, where the tile
+    forcing is read and derived once, in memory, with the local scheduler.
+    
+    The first spinup_days of ds_tile are the historic days before a scenario.
+    They're only used for the phenograss runs, and are dropped from every 
+    output. historic_tile is from historic_tile_handoff() for the historic 
+    run of the same tile. Without historic_state_handoff it's the historic 
+    forcing, which goes in front of ds_tile for the phenograss runs as more
+    spin-up days, and with it the model states to start from.
+    """
+    ds_tile = ds_tile.load(scheduler='synchronous')
     
-    print('building climate data {i}/{n}'.format(i=ds_i, n=n_climate_models))
-    ds = xarray_tools.compile_cmip_model_data(climate_model_name =  ds_info['climate_model_name'], 
-                                              scenario =            ds_info['scenario'], 
-                                              climate_model_files = model_files, 
-                                              other_var_ds =        other_var_ds, 
-                                              chunk_sizes =         chunk_sizes)
-    print('loading climate data into memory')
-    ds.load()
+    phenograss_ds = ds_tile
+    phenograss_spinup_days = spinup_days
+    initial_states = None
+    if historic_tile is not None and historic_state_handoff:
+        initial_states = historic_tile
+    elif historic_tile is not None:
+        phenograss_ds = xarray_tools.with_prior_days(ds_tile, historic_tile)
+        phenograss_spinup_days = spinup_days + historic_tile.time.size
     
+    def phenograss(model, initial_state):
+        warmup_days = xarray_tools.phenograss_warmup_days(model) if historic_state_handoff else 0
+        if initial_state is None:
+            fCover, state = xarray_tools.apply_phenograss_dask_wrapper(model = model, ds = phenograss_ds, return_state = True, warmup_days = warmup_days)
+            return fCover.isel(time = slice(phenograss_spinup_days, None)), state
+        return xarray_tools.apply_phenograss_dask_wrapper(model = model, ds = phenograss_ds.isel(time = slice(phenograss_spinup_days - warmup_days, None)), 
+                                                          initial_state = initial_state, return_state = True, warmup_days = warmup_days)
+    
+    # The phenograss runs use the spin-up days, the other products only the
+    # days of this climate model/scenario.
+    products = {}
     for model_i, model in enumerate(phenograss_models):
-        print('applying phenograss model {i}'.format(i=model_i))
+        initial_state = None if initial_states is None else initial_states[model_i]
+        products['phenograss_{i}'.format(i=model_i)] = lambda ds, model=model, initial_state=initial_state: phenograss(model, initial_state)
+    
+    with dask.config.set(scheduler='synchronous'):
+        tile_output = product_tools.compute_products(ds_tile.isel(time = slice(spinup_days, None)), products)
+    if not historic_state_handoff and historic_tile is None:
+        # For the scenarios of a historic tile, see historic_tile_handoff()
+        tile_output['phenograss_forcing'] = ds_tile[list(xarray_tools.phenograss_timeseries_vars.values())]
+    return tile_output
 
-        # This compute command kicks off everything in dask, returning the final xarray dataset to the head machine.
-        phenograss_ds = xarray_tools.apply_phenograss_dask_wrapper(model = model, ds=ds).compute() 
-        
-        # model metadata fitting_set looks like: 'ecoregion-vegtype_NWForests_GR'
-        model_info = model.metadata['fitting_set'].split('_')
-        model_ecoregion = model_info[1]
-        model_vegtype = model_info[2]
-        
-        output_file = 'phenograss_file{i}_{m}_{s}_{e}_{v}.nc4'.format(i=ds_i, m=ds_info['climate_model_name'], s=ds_info['scenario'],
-                                                                      e = model_ecoregion, v = model_vegtype)
+def historic_tile_handoff(tile_output):
+    """ 
+    What the scenario tiles need from a historic tile. With historic_state_handoff
+    the model state for each phenograss model, which is small, just 2 values 
+    for every pixel. Otherwise the derived phenograss forcing.
+    """
+    if historic_state_handoff:
+        return [tile_output['phenograss_{i}'.format(i=model_i)][1] for model_i in range(len(phenograss_models))]
+    return tile_output['phenograss_forcing']
+
+def submit_tile(job, tile_i, historic_tile=None):
+    latitude_slice, longitude_slice = job['tiles'][tile_i]
+    # Only the part of the dask graph for this tile goes to the worker
+    ds_tile, = dask.optimize(job['ds'].isel(latitude = latitude_slice, longitude = longitude_slice))
+    # Historic tiles go first, as the scenarios wait on them, then earlier 
+    # jobs before later ones.
+    job_i = job['job_i']
+    priority = 2 * len(jobs) - job_i if job['scenario'] == 'historic' else len(jobs) - job_i
+    tile_queue.add((job_i, tile_i), run_tile, ds_tile, historic_tile, job['spinup_days'],
+                   priority = priority, nbytes = tile_bytes(job, tile_i))
+
+def write_tile(job, tile_i, tile_output):
+    stage_tags = dict(model = job['climate_model_name'], scenario = job['scenario'])
+    latitude_slice, longitude_slice = job['tiles'][tile_i]
+    
+    with run_report.stage('write_tile', count_dask_tasks = False, **stage_tags):
+        for model_i, writer in enumerate(job['writers']):
+            phenograss_tile, _ = tile_output['phenograss_{i}'.format(i=model_i)]
+            writer.write_tile(tile_i, phenograss_tile)
         
-        phenograss_ds.to_dataset(name='fCover').to_netcdf(phenograss_output_folder + output_file,
-                                                          encoding = phenograss_encoding)
+        # The annual climate is small enough to be put together in memory
+        if job['annual_climate'] is None:
+            job['annual_climate'] = tile_output['annual_climate'].reindex(latitude = job['ds'].latitude, longitude = job['ds'].longitude)
+        else:
+            job['annual_climate'][dict(latitude = latitude_slice, longitude = longitude_slice)] = tile_output['annual_climate']
     
-    # The files get pretty big, so clear them out for the next round
-    ds = phenograss_ds = None
+    job['tiles_done'] += 1
+    if job['tiles_done'] == len(job['active_tiles']):
+        finish_job(job)
+
+def finish_job(job):
+    """ Write the annual climate of a job once all its tiles are written, and drop everything it holds """
+    stage_tags = dict(model = job['climate_model_name'], scenario = job['scenario'])
+    if job['annual_climate'] is None:
+        # A job without any ecoregion cells has no tiles, so its annual
+        # climate is all NaN, from the lazy layout of the product. 
+        annual_template = product_tools.annual_climate(job['ds'].isel(time = slice(job['spinup_days'], None)))
+        job['annual_climate'] = xr.full_like(annual_template, np.nan).load()
+    
+    with run_report.stage('write_annual_climate', count_dask_tasks = False, **stage_tags):
+        job['annual_climate'].to_netcdf(annual_climate_folder + 'climate_annual_{m}_{s}.nc'.format(m=job['climate_model_name'], s=job['scenario']))
+    
+    # The lazy dataset and all the job info can go
+    for k in ['ds','writers','annual_climate']:
+        job.pop(k)
+    
+    if job['scenario'] != 'historic':
+        # and once the last scenario is done, what's kept from the historic tiles
+        with handoff_lock:
+            historic_job = jobs[job['historic_job_i']]
+            historic_job['scenarios_left'] -= 1
+            if historic_job['scenarios_left'] == 0:
+                historic_job['historic_tile_futures'].clear()
+    
+    # Written every job so there's a report even if a later one fails
+    run_report.write(run_report_folder + 'apply_model_to_cmip.json')
+    print('dataset {i} {s} processing complete'.format(i=job['ds_i'], s=job['scenario']))
+    job_slots.release()
+
+def prepare_jobs():
+    """
+    Build every job in order, in a background thread, and submit the tiles 
+    of each as soon as it's built. A scenario's tiles wait on their historic
+    tiles, so only the tiles whose historic tile is already finished are 
+    submitted here.
     
-    print('dataset {i} processing complete'.format(i=ds_i))
+    At most prefetch_jobs are built ahead of the jobs finished so far. Jobs
+    finish roughly in order, and a job only waits on earlier ones, so this
+    never blocks the jobs already built.
+    """
+    for job in jobs:
+        while not job_slots.acquire(timeout = 5):
+            if stop_preparing.is_set():
+                return
+        prepare_job(job)
+        if not job['active_tiles']:
+            # Nothing will ever finish for it in the results loop
+            finish_job(job)
+        elif job['scenario'] == 'historic':
+            for tile_i in job['active_tiles']:
+                submit_tile(job, tile_i)
+        else:
+            with handoff_lock:
+                job['prepared'] = True
+                for tile_i, historic_tile in jobs[job['historic_job_i']]['historic_tile_futures'].items():
+                    submit_tile(job, tile_i, historic_tile = historic_tile)
+        tile_queue.submit_pending()
+
+tile_queue = pipeline_tools.FutureQueue(dask_client, max_in_flight_bytes = max_in_flight_gb * 1e9)
+
+with run_report.performance_report(run_report_folder + 'apply_model_to_cmip_dask.html'), \
+     ThreadPoolExecutor(max_workers = 1) as prepare_pool:
+    # The tiles start on the cluster as soon as each job is built, while the 
+    # next jobs, up to prefetch_jobs ahead, are still being built. 
+    preparing = prepare_pool.submit(prepare_jobs)
+    
+    print('applying phenograss models and climate products')
+    try:
+        with run_report.stage('apply_tiles'):
+            for (job_i, tile_i), future in tile_queue.results(adding = preparing):
+                job = jobs[job_i]
+                tile_output = future.result()
+            
+                if job['scenario'] == 'historic':
+                    # Only what the scenario tiles need stays on the cluster, 
+                    # the rest of the historic tile output is released once written.
+                    # Scenario jobs not yet built get it from historic_tile_futures.
+                    historic_tile = dask_client.submit(historic_tile_handoff, future, priority = 3 * len(jobs))
+                    with handoff_lock:
+                        job['historic_tile_futures'][tile_i] = historic_tile
+                        for scenario_job in jobs[job_i + 1:]:
+                            if scenario_job['climate_model_name'] != job['climate_model_name']:
+                                break
+                            if scenario_job.get('prepared'):
+                                submit_tile(scenario_job, tile_i, historic_tile = historic_tile)
+                    tile_queue.submit_pending()
+            
+                write_tile(job, tile_i, tile_output)
+                tile_output = future = None
+    finally:
+        # so the background thread doesn't wait forever on a slot after an error
+        stop_preparing.set()
+
+run_report.write(run_report_folder + 'apply_model_to_cmip.json')
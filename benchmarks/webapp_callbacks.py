@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import resource
+
+import numpy as np
+import pandas as pd
+
+"""
+Load test for the webapp callbacks. Requests for update_timeseries,
+update_tabtext and the /api/pixel endpoint are made for randomly clicked
+pixels and scenario tabs, at several levels of concurrency. For each level
+the p50/p95/p99 latency, throughput, and the memory (RSS) of every worker
+is reported.
+
+By default each concurrent client is a separate process with its own copy of
+the app, using the flask test client. This is the same as running gunicorn
+with that many workers. The workers always use the server timeseries callback
+(site_config.clientside_timeseries = False), since with the clientside figures
+update_timeseries runs in the browser and there is nothing to benchmark. With
+--url the requests go to an already running server instead, and --server-pids
+can be given to get the RSS of its workers. That server must also have
+clientside_timeseries off when update_timeseries is one of the targets, otherwise
+those requests fail and are reported as errors.
+
+Usage, from the repo root:
+
+    python benchmarks/webapp_callbacks.py --concurrency 1 2 4 8 --requests 400
+    python benchmarks/webapp_callbacks.py --url http://localhost:8000 --server-pids 1234 1235
+"""
+
+webapp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webapp')
+webapp_dir = os.path.normpath(webapp_dir)
+
+sys.path.insert(0, webapp_dir)
+from pixel_grid import PixelGrid
+
+scenarios = ['rcp26','rcp45','rcp60','rcp85']
+all_targets = ['update_timeseries','update_tabtext','api_pixel']
+
+#################################################
+# Building the synthetic requests
+#################################################
+
+def dash_request(output_id, output_property, inputs, changed_prop):
+    """
+    Body of a POST to /_dash-update-component, the same as what the browser
+    sends when an input changes.
+    """
+    return {'output'        : '{i}.{p}'.format(i=output_id, p=output_property),
+            'outputs'       : {'id':output_id, 'property':output_property},
+            'inputs'        : [{'id':i, 'property':p, 'value':v} for i, p, v in inputs],
+            'changedPropIds': [changed_prop],
+            'state'         : []}
+
+def build_requests(n_requests, targets, seed=1):
+    """
+    A list of (target, path, body) for random pixels/tabs. Pixels are drawn
+    uniformly from the cells with data, which is where users can click.
+    body is None for GET requests.
+    """
+    mask = pd.read_csv(os.path.join(webapp_dir, 'data/ecoregion_mask.csv'))
+    grid = PixelGrid.from_mask(mask, resolution=0.5)
+    clickable_pixels = grid.pixel_id(mask.latitude[mask.ecoregion_mask], mask.longitude[mask.ecoregion_mask])
+
+    rng = np.random.default_rng(seed)
+    all_requests = []
+    for target in rng.choice(targets, size=n_requests).tolist():
+        pixel = int(rng.choice(clickable_pixels))
+        scenario = str(rng.choice(scenarios))
+
+        if target == 'update_timeseries':
+            body = dash_request('timeseries','children',
+                                inputs = [('map','clickData',{'points':[{'location':pixel}]}),
+                                          ('timeseries-tabs','value',scenario)],
+                                changed_prop = 'map.clickData')
+            all_requests.append((target, '/_dash-update-component', body))
+        elif target == 'update_tabtext':
+            tab = str(rng.choice(scenarios + ['about']))
+            body = dash_request('rcp_description','children',
+                                inputs = [('timeseries-tabs','value',tab)],
+                                changed_prop = 'timeseries-tabs.value')
+            all_requests.append((target, '/_dash-update-component', body))
+        elif target == 'api_pixel':
+            path = '/api/pixel?lat={lat}&lon={lon}&scenario={s}'.format(lat=float(grid.latitude(pixel)),
+                                                                        lon=float(grid.longitude(pixel)),
+                                                                        s=scenario)
+            all_requests.append((target, path, None))
+
+    return all_requests
+
+def rss_mb(pid='self'):
+    """ Current resident memory of a process, in MB. Linux only. """
+    try:
+        with open('/proc/{p}/status'.format(p=pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    return np.nan
+
+#################################################
+# In process workers, one app per process
+#################################################
+
+_client = None
+
+def _init_worker(startup_barrier):
+    global _client
+    os.chdir(webapp_dir)
+    # update_timeseries is only a server callback when the clientside figures
+    # are off, so force that before the app is built.
+    import site_config
+    site_config.clientside_timeseries = False
+    import app
+    _client = app.server.test_client()
+    startup_barrier.wait()
+
+def _available_targets():
+    import app
+    targets = ['update_tabtext','api_pixel']
+    if 'timeseries.children' in app.app.callback_map:
+        targets.append('update_timeseries')
+    return targets
+
+def _run_batch(batch):
+    results = []
+    for target, path, body in batch:
+        start = time.perf_counter()
+        if body is None:
+            response = _client.get(path)
+        else:
+            response = _client.post(path, json=body)
+        results.append((target, time.perf_counter() - start, response.status_code))
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return results, os.getpid(), rss_mb(), peak_rss
+
+def run_in_process(all_requests, concurrency, batch_size=10):
+    ctx = multiprocessing.get_context('spawn')
+    startup_barrier = ctx.Barrier(concurrency + 1)
+    with ctx.Pool(processes=concurrency, initializer=_init_worker, initargs=(startup_barrier,)) as pool:
+        # wait on every worker to load the app so startup isn't part of the timing
+        startup_barrier.wait()
+        available = pool.apply(_available_targets)
+        missing = sorted(set(r[0] for r in all_requests) - set(available))
+        if missing:
+            raise RuntimeError('targets not available in the app: {m}'.format(m=', '.join(missing)))
+
+        batches = [all_requests[i:i+batch_size] for i in range(0, len(all_requests), batch_size)]
+
+        start = time.perf_counter()
+        batch_results = list(pool.imap_unordered(_run_batch, batches))
+        wall_time = time.perf_counter() - start
+
+    results = []
+    worker_memory = {}
+    for batch, pid, current_rss, peak_rss in batch_results:
+        results.extend(batch)
+        worker_memory[pid] = {'rss_mb':current_rss, 'peak_rss_mb':peak_rss}
+
+    return results, wall_time, worker_memory
+
+#################################################
+# Requests to a running server
+#################################################
+
+def _http_request(url, path, body):
+    if body is None:
+        request = urllib.request.Request(url + path)
+    else:
+        request = urllib.request.Request(url + path,
+                                         data = json.dumps(body).encode('utf-8'),
+                                         headers = {'Content-Type':'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return time.perf_counter() - start, status
+
+def run_http(all_requests, concurrency, url, server_pids=()):
+    def run_one(r):
+        target, path, body = r
+        latency, status = _http_request(url, path, body)
+        return target, latency, status
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(run_one, all_requests))
+        wall_time = time.perf_counter() - start
+
+    worker_memory = {pid:{'rss_mb':rss_mb(pid), 'peak_rss_mb':np.nan} for pid in server_pids}
+    return results, wall_time, worker_memory
+
+#################################################
+
+def summarize(results, wall_time, worker_memory, concurrency):
+    summary = {'concurrency'    : concurrency,
+               'n_requests'     : len(results),
+               'wall_time_s'    : round(wall_time, 3),
+               'throughput_rps' : round(len(results) / wall_time, 1),
+               'worker_memory'  : {str(pid):m for pid, m in worker_memory.items()},
+               'targets'        : {}}
+
+    for target in sorted(set(r[0] for r in results)):
+        latencies = np.array([r[1] for r in results if r[0] == target]) * 1000
+        errors = sum([r[2] >= 400 for r in results if r[0] == target])
+        summary['targets'][target] = {'n'      : len(latencies),
+                                      'errors' : int(errors),
+                                      'p50_ms' : round(float(np.percentile(latencies, 50)), 2),
+                                      'p95_ms' : round(float(np.percentile(latencies, 95)), 2),
+                                      'p99_ms' : round(float(np.percentile(latencies, 99)), 2)}
+    return summary
+
+def print_summary(summary):
+    print('concurrency {c}: {n} requests in {t}s, {r} requests/s'.format(c=summary['concurrency'],
+                                                                          n=summary['n_requests'],
+                                                                          t=summary['wall_time_s'],
+                                                                          r=summary['throughput_rps']))
+    for target, s in summary['targets'].items():
+        print('    {t:<18} n={n:<6} errors={e:<4} p50={p50}ms p95={p95}ms p99={p99}ms'.format(t=target, n=s['n'], e=s['errors'],
+                                                                                               p50=s['p50_ms'], p95=s['p95_ms'], p99=s['p99_ms']))
+    for pid, m in summary['worker_memory'].items():
+        print('    worker {p}: rss {r:.0f}MB, peak {pk:.0f}MB'.format(p=pid, r=m['rss_mb'], pk=m['peak_rss_mb']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency/throughput benchmark for the webapp callbacks')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1,2,4,8],
+                        help='number of concurrent clients (worker processes when run in process)')
+    parser.add_argument('--requests', type=int, default=400, help='requests per concurrency level')
+    parser.add_argument('--targets', nargs='+', default=all_targets, choices=all_targets)
+    parser.add_argument('--url', default=None, help='benchmark a running server instead, eg. http://localhost:8000')
+    parser.add_argument('--server-pids', type=int, nargs='*', default=[], help='pids of the server workers, to report their RSS')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='also write the results to this json file')
+    args = parser.parse_args()
+
+    all_requests = build_requests(args.requests, args.targets, seed=args.seed)
+
+    all_summaries = []
+    for concurrency in args.concurrency:
+        if args.url:
+            results, wall_time, worker_memory = run_http(all_requests, concurrency, args.url.rstrip('/'), args.server_pids)
+        else:
+            results, wall_time, worker_memory = run_in_process(all_requests, concurrency)
+
+        summary = summarize(results, wall_time, worker_memory, concurrency)
+        print_summary(summary)
+        all_summaries.append(summary)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(all_summaries, f, indent=2)
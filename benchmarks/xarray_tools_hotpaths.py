@@ -0,0 +1,223 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+"""
+Microbenchmarks for the hot paths in tools/xarray_tools.py, using
+data/test_dataset.nc4 (a 10x10 cell, 1 year subset of the CCSM4 rcp26 data).
+
+Every case is run for each combination of chunk size and number of dask
+threads, and the min/median of several repeats is reported. Results are
+appended to a history file, one json line per run along with the git commit,
+and each run is compared with the last one on the same machine so
+regressions show up.
+
+    annual_reductions    the annual tmean/pr groupby from process_climate_data_for_website.py
+    period_reductions    the same annual tmean/pr with period_tools.reduce_periods
+    radiation            create_radiation_data_array
+    et                   create_et_data_array
+    rolling_tmean        rolling_tmean
+    phenograss           apply_phenograss_dask_wrapper, with the GrPlains model
+
+The test dataset can be repeated along time with --years to get
+closer to the real time series lengths.
+
+Usage, from the repo root:
+
+    python benchmarks/xarray_tools_hotpaths.py
+    python benchmarks/xarray_tools_hotpaths.py --cases et rolling_tmean --chunks 2 5 10 --threads 1 4 --years 10
+"""
+
+repo_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, repo_dir)
+
+all_cases = ['annual_reductions','period_reductions','radiation','et','rolling_tmean','phenograss']
+
+# phenograss uses time as a core dimension, so it must be a single chunk
+time_core_cases = ['phenograss']
+
+phenograss_model_file = 'models/ecoregion-vegtype_GrPlains_GR_PhenoGrass_4dac8b702c3241eb.json'
+
+# Constant soil/MAP values standing in for data/other_variables.nc
+other_variable_values = {'Wcap':250., 'Wp':120., 'MAP':600.}
+
+default_history_file = os.path.join(repo_dir, 'benchmarks', 'results', 'xarray_tools_history.jsonl')
+
+def load_test_dataset(n_years=1):
+    """
+    data/test_dataset.nc4 in memory, repeated n_years times along time with
+    the dates shifted forward by a year each time.
+    """
+    import pandas as pd
+    import xarray as xr
+    ds = xr.open_dataset(os.path.join(repo_dir, 'data/test_dataset.nc4')).load()
+    if n_years > 1:
+        years = []
+        for year_i in range(n_years):
+            y = ds.copy()
+            y['time'] = ds.time.to_index() + pd.DateOffset(years=year_i)
+            years.append(y)
+        ds = xr.concat(years, dim='time')
+    return ds
+
+def build_case(case, ds, spatial_chunk, time_chunk):
+    """
+    Returns a function which builds and computes the case, with the inputs
+    already chunked so only the xarray_tools step is timed.
+    """
+    if case not in ['annual_reductions','period_reductions']:
+        from tools import xarray_tools
+
+    if case in time_core_cases:
+        time_chunk = -1
+    chunks = {'latitude':spatial_chunk, 'longitude':spatial_chunk, 'time':time_chunk}
+    chunked = ds.chunk(chunks)
+
+    if case == 'annual_reductions':
+        chunked['tmean'] = (chunked.tasmin + chunked.tasmax) / 2
+        def run():
+            by_year = chunked.assign_coords(time = chunked['time.year'])
+            by_year.tmean.groupby('time').mean().compute()
+            by_year.pr.groupby('time').sum().compute()
+    elif case == 'period_reductions':
+        from tools import period_tools
+        chunked['tmean'] = (chunked.tasmin + chunked.tasmax) / 2
+        def run():
+            period_tools.reduce_periods(chunked.tmean, how='mean', freq='year').compute()
+            period_tools.reduce_periods(chunked.pr, how='sum', freq='year').compute()
+    elif case == 'radiation':
+        def run():
+            xarray_tools.create_radiation_data_array(ref = chunked).compute()
+    elif case == 'et':
+        radiation = xarray_tools.create_radiation_data_array(ref = ds).chunk(chunks)
+        def run():
+            xarray_tools.create_et_data_array(tmin = chunked.tasmin, tmax = chunked.tasmax, radiation = radiation).compute()
+    elif case == 'rolling_tmean':
+        def run():
+            xarray_tools.rolling_tmean(ds = chunked, window_size = 15).compute()
+    elif case == 'phenograss':
+        import GrasslandModels
+        model = GrasslandModels.utils.load_saved_model(os.path.join(repo_dir, phenograss_model_file))
+        model.set_internal_method('numpy')
+
+        model_ds = ds.copy()
+        model_ds['radiation'] = xarray_tools.create_radiation_data_array(ref = ds)
+        model_ds['et'] = xarray_tools.create_et_data_array(tmin = ds.tasmin, tmax = ds.tasmax, radiation = model_ds.radiation)
+        model_ds['tmean'] = xarray_tools.rolling_tmean(ds = ds, window_size = 15)
+        for var, value in other_variable_values.items():
+            model_ds[var] = ds.pr.isel(time=0, drop=True) * 0 + value
+        model_ds = model_ds.chunk(chunks)
+        def run():
+            xarray_tools.apply_phenograss_dask_wrapper(model = model, ds = model_ds).compute()
+    else:
+        raise ValueError('unknown case {c}'.format(c=case))
+
+    return run
+
+def time_case(run, n_threads, repeats):
+    import dask
+    timings = []
+    with dask.config.set(scheduler='threads', num_workers=n_threads):
+        # the first call also includes imports and numba/bottleneck setup
+        run()
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+    return timings
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','--short','HEAD'], cwd=repo_dir, stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+def result_key(r):
+    return (r['case'], r['spatial_chunk'], r['time_chunk'], r['threads'])
+
+def load_previous_run(history_file, machine, n_years):
+    """ The last run in the history from the same machine and dataset length, or None """
+    if not os.path.exists(history_file):
+        return None
+    previous = None
+    with open(history_file) as f:
+        for line in f:
+            run = json.loads(line)
+            if run['machine'] == machine and run['n_years'] == n_years:
+                previous = run
+    return previous
+
+def compare_runs(results, previous, threshold):
+    """
+    Ratio of the median time to the previous run for every result, flagging
+    anything slower than threshold (ie. 1.2 is 20% slower).
+    """
+    previous_results = {result_key(r):r for r in previous['results']}
+    regressions = []
+    for r in results:
+        p = previous_results.get(result_key(r))
+        if p is None:
+            continue
+        r['vs_previous'] = round(r['median_s'] / p['median_s'], 3)
+        if r['vs_previous'] > threshold:
+            regressions.append(r)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the xarray_tools hot paths on data/test_dataset.nc4')
+    parser.add_argument('--cases', nargs='+', default=all_cases, choices=all_cases)
+    parser.add_argument('--chunks', type=int, nargs='+', default=[2,5,10], help='latitude/longitude chunk sizes')
+    parser.add_argument('--time-chunks', type=int, nargs='+', default=[-1], help='time chunk sizes, -1 for a single chunk')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1,4], help='number of dask threads')
+    parser.add_argument('--years', type=int, default=1, help='repeat the test dataset this many years')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--history', default=default_history_file, help='json lines file to append the results to')
+    parser.add_argument('--no-history', action='store_true', help='do not append this run to the history')
+    parser.add_argument('--regression-threshold', type=float, default=1.2,
+                        help='flag cases this many times slower than the previous run')
+    args = parser.parse_args()
+
+    os.chdir(repo_dir)
+    ds = load_test_dataset(args.years)
+    machine = '{n} {p} {c}cpu'.format(n=platform.node(), p=platform.processor() or platform.machine(), c=os.cpu_count())
+
+    results = []
+    for case in args.cases:
+        time_chunks = [-1] if case in time_core_cases else args.time_chunks
+        for spatial_chunk, time_chunk, n_threads in itertools.product(args.chunks, time_chunks, args.threads):
+            run = build_case(case, ds, spatial_chunk, time_chunk)
+            timings = time_case(run, n_threads, args.repeats)
+            r = {'case'          : case,
+                 'spatial_chunk' : spatial_chunk,
+                 'time_chunk'    : time_chunk,
+                 'threads'       : n_threads,
+                 'min_s'         : round(min(timings), 5),
+                 'median_s'      : round(float(np.median(timings)), 5)}
+            results.append(r)
+            print('{c:<18} chunk={s:<3} time_chunk={t:<5} threads={n:<3} min={mn:.4f}s median={md:.4f}s'.format(c=case, s=spatial_chunk, t=time_chunk,
+                                                                                                             n=n_threads, mn=r['min_s'], md=r['median_s']))
+
+    previous = load_previous_run(args.history, machine, args.years)
+    if previous is not None:
+        regressions = compare_runs(results, previous, args.regression_threshold)
+        print('compared with {c} from {d}: {n} regressions'.format(c=previous['commit'], d=previous['date'], n=len(regressions)))
+        for r in regressions:
+            print('    {c} chunk={s} time_chunk={t} threads={n}: {x}x slower'.format(c=r['case'], s=r['spatial_chunk'], t=r['time_chunk'],
+                                                                                     n=r['threads'], x=r['vs_previous']))
+
+    if not args.no_history:
+        os.makedirs(os.path.dirname(args.history), exist_ok=True)
+        with open(args.history, 'a') as f:
+            f.write(json.dumps({'date'    : datetime.now().isoformat(timespec='seconds'),
+                                'commit'  : git_commit(),
+                                'machine' : machine,
+                                'n_years' : args.years,
+                                'results' : results}) + '\n')
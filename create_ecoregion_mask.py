@@ -1,14 +1,17 @@
 import geopandas as gpd
-import rasterio.mask
 import rasterio
+import rasterio.features
 import xarray as xr
 import numpy as np
+import pandas as pd
 
 
 """
 This script creates a mask netCDF file for the specified ecoregions below. It's
 designed to be used in the process_phenograss_output_for_website script so that
 each grid cell gets fCover values from only its respective ecoregion model.
+
+The mask is a single int8 layer of ecoregion bit flags, see tools/mask_tools.py for using it.
 """
 
 
@@ -33,51 +36,88 @@ ecoregions = ecoregions.to_crs(4326)
 #ecoregions = ecoregions.dissolve(by='NA_L1NAME')
 
 
-# Make a mask array based on each ecoregion and  referenced to the
-# resolution/extent of the base_grid
-# invert = True means locations *within* the shapefile  will be marked tru
+# Optionally also get the fraction of each cell covered by any of the ecoregions,
+# by rasterizing on a grid this many times finer and averaging back up.
+# None to skip it.
+coverage_supersample = None
+
+def block_reduce(values, latitude, longitude, func, resolution=0.5):
+    """
+    Reduce a (lat, lon) array to a coarser resolution with func, a numpy ufunc
+    like np.maximum or np.add. Blocks are the coarse cells with lower left
+    corners at floor(coordinate/resolution)*resolution, so blocks at the edges
+    can be partial. Coordinates must be increasing.
+
+    Returns the reduced array and the lower left corner coordinates.
+    """
+    coarse_lat = np.floor(latitude/resolution)*resolution
+    coarse_lon = np.floor(longitude/resolution)*resolution
+    _, lat_starts = np.unique(coarse_lat, return_index=True)
+    _, lon_starts = np.unique(coarse_lon, return_index=True)
+    
+    reduced = func.reduceat(func.reduceat(values, lat_starts, axis=0), lon_starts, axis=1)
+    return reduced, coarse_lat[lat_starts], coarse_lon[lon_starts]
+
+# Make a single int8 label array referenced to the resolution/extent of 
+# the base_grid, with bit i set for cells in ecoregions_to_keep[i], and 0 
+# outside all ecoregions. all_touched=True marks every cell the ecoregion 
+# touches, so cells along the borders have the bits of both ecoregions, and
+# later get the average of both ecoregion models.
+ecoregion_shapes = [ecoregions[ecoregions.NA_L1NAME==ecoregion_name].geometry.values for ecoregion_name in ecoregions_to_keep]
+
 with rasterio.open(base_grid_file) as base_grid_rio:
-    mask = []
-    for ecoregion_name in ecoregions_to_keep:
-        ecoregion_shapely = ecoregions[ecoregions.NA_L1NAME==ecoregion_name].geometry.values
-        m, _, _ = rasterio.mask.raster_geometry_mask(base_grid_rio, 
-                                                     shapes = ecoregion_shapely,
-                                                     all_touched=True,
-                                                     invert = True)
-        # rasterio and geopandas getting confused and somehow flipping the y axis here...
-        m = np.flip(m,0)
-        mask.append(m)
-
-# single numpy array of shape (ecoregions, lat, lon) to shove into array
-mask = np.stack(mask)
-
-# Make an empty xarray dataset referenced to the base_grid.
-# where each ecoregion is a different boolean layer
+    label = np.zeros(base_grid_rio.shape, dtype=np.int8)
+    for ecoregion_i, shapes in enumerate(ecoregion_shapes):
+        in_ecoregion = rasterio.features.rasterize([(shape, 1) for shape in shapes],
+                                                   out_shape = base_grid_rio.shape,
+                                                   transform = base_grid_rio.transform,
+                                                   fill = 0,
+                                                   all_touched = True,
+                                                   dtype = 'uint8')
+        label |= (in_ecoregion * 2**ecoregion_i).astype(np.int8)
+    
+    if coverage_supersample is not None:
+        fine_transform = base_grid_rio.transform * rasterio.Affine.scale(1/coverage_supersample)
+        fine_shape = (base_grid_rio.height*coverage_supersample, base_grid_rio.width*coverage_supersample)
+        covered = rasterio.features.rasterize([(shape, 1) for shapes in ecoregion_shapes for shape in shapes],
+                                              out_shape = fine_shape,
+                                              transform = fine_transform,
+                                              fill = 0,
+                                              all_touched = False,
+                                              dtype = 'uint8')
+        coverage = covered.reshape(base_grid_rio.height, coverage_supersample,
+                                   base_grid_rio.width,  coverage_supersample).mean(axis=(1,3)).astype(np.float32)
+
+# rasterio and geopandas getting confused and somehow flipping the y axis here...
+label = np.flip(label,0)
+
+# Make an xarray dataset referenced to the base_grid.
 with xr.open_dataset(base_grid_file) as base_grid_nc:
-    mask_nc = xr.DataArray(mask,
-                           dims = ('ecoregion','latitude','longitude'),
-                           coords = {'ecoregion' : ecoregion_shortnames,
-                                     'latitude'  : base_grid_nc.latitude,
-                                     'longitude' : base_grid_nc.longitude})
+    grid_coords = {'latitude'  : base_grid_nc.latitude.values,
+                   'longitude' : base_grid_nc.longitude.values - 360} # match the longitude to phenograss output, website input
 
-mask_nc = mask_nc.to_dataset(name='ecoregion_mask')
+mask_nc = xr.Dataset({'ecoregion_label' : (('latitude','longitude'), label)}, coords = grid_coords)
+mask_nc.ecoregion_label.attrs = {'flag_masks'    : 2 ** np.arange(len(ecoregion_shortnames), dtype=np.int8),
+                                 'flag_meanings' : ' '.join(ecoregion_shortnames)}
 
-# match the longitude to phenograss output, website input
-mask_nc['longitude'] = mask_nc.longitude - 360
+if coverage_supersample is not None:
+    mask_nc['ecoregion_coverage'] = (('latitude','longitude'), np.flip(coverage,0))
+    mask_nc.ecoregion_coverage.attrs = {'notes':'fraction of each cell within any of the ecoregions'}
 
-mask_nc.attrs = {'notes':'mask using ecoregions, with spatial extent/scale of the reference dataset. True indicates where the ecoregion is located.',
+mask_nc.attrs = {'notes':'mask using ecoregions, with spatial extent/scale of the reference dataset. ecoregion_label has a bit set for each ecoregion a cell touches, see flag_masks/flag_meanings, and is 0 outside all ecoregions.',
                  'ecoregions' : ','.join(ecoregions_to_keep),
                  'reference_dataset':base_grid_file}
 
 mask_nc.to_netcdf('data/ecoregion_mask.nc')
 
-# Also create a downscaled dataframe to use in website stuff, that way xarray isn't needed there
-mask_df = mask_nc.to_dataframe().reset_index()
-
-mask_df['latitude'] = np.floor(mask_df.latitude*2)/2
-mask_df['longitude'] = np.floor(mask_df.longitude*2)/2
-
-mask_df = mask_df.groupby(['latitude','longitude']).agg({'ecoregion_mask':'max'}).reset_index()
+# Also create a downscaled dataframe to use in website stuff, that way xarray isn't needed there.
+# A 0.5 degree cell is in the mask if any of the fine cells within it are.
+coarse_mask, coarse_lat, coarse_lon = block_reduce(label > 0,
+                                                   latitude  = mask_nc.latitude.values,
+                                                   longitude = mask_nc.longitude.values,
+                                                   func = np.logical_or)
 
-mask_df['ecoregion_mask'] = mask_df.ecoregion_mask.astype(bool)
+mask_df = pd.DataFrame({'latitude'       : np.repeat(coarse_lat, len(coarse_lon)),
+                        'longitude'      : np.tile(coarse_lon, len(coarse_lat)),
+                        'ecoregion_mask' : coarse_mask.ravel()})
 mask_df.to_csv('webapp/data/ecoregion_mask.csv', index=False)
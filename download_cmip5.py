@@ -1,4 +1,5 @@
 from tools.cmip_download_tool import CMIP_FTP_TOOL
+from tools import quantize_tools
 
 
 
@@ -22,4 +23,16 @@ for m in models:
                                      variable = v,
                                      decades = decades,
                                      n_runs=max_runs,
-                                     dest_folder = './data/cmip5_nc_files/')
\ No newline at end of file
+                                     dest_folder = './data/cmip5_nc_files/')
+
+# int16 copies of the forcing, which are about half the size and read time
+# of the original float files. See tools/quantize_tools.py for the precision. 
+# They are only made once validate_forcing_quantization.py, which needs the 
+# original files, has written its report. The originals are always kept. 
+# apply_model_to_cmip.py and process_climate_data_for_website.py read the 
+# copies once there's one for every original file, see quantize_tools.climate_data_folder().
+if quantize_tools.is_validated():
+    converted_files = quantize_tools.quantize_folder(quantize_tools.original_data_folder, out_folder = quantize_tools.quantized_data_folder)
+    print('wrote {n} int16 copies to {f}'.format(n=len(converted_files), f=quantize_tools.quantized_data_folder))
+else:
+    print('not making int16 copies, run validate_forcing_quantization.py first')
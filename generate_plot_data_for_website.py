@@ -1,13 +1,19 @@
+import os
+import tempfile
+
 import pandas as pd
 
 import site_config
+import plot_store
+from tools import ensemble_tools
 
 
 """
 Generate the final data used in the timeseries plots on the site. These are 
 derived from the data/climate_annual_data.csv and data/phenograss_downscaled_annual_integral.csv
-files. This step is memory intensive so the final file, data/phenograss_timeseries_plot_data.csv,
-is made here and loaded by dash_test.py on the server.
+files, one climate model at a time. The final file, data/phenograss_timeseries_plot_data.csv,
+is made here along with the memory mapped copy in webapp/data/plot_store/, which
+is what the webapp loads on the server.
 """
 
 climatology_years = site_config.climatology_years
@@ -17,41 +23,83 @@ year_resolution = site_config.year_resolution # final figure will display the av
 debug=site_config.debug
 
 ################################
-climate_data = pd.read_csv('data/climate_annual_data.csv')
-phenograss_data = pd.read_csv('data/phenograss_downscaled_annual_integral.csv')
-phenograss_data = pd.merge(phenograss_data, climate_data, how='right', on=['latitude', 'longitude', 'model', 'scenario', 'year'])
-
-# TODO: quick check that all timeseries are intact, and all models/secnarios avaialble
-
-climatology = phenograss_data[phenograss_data.year.isin(climatology_years)]
-climatology = climatology.groupby(['latitude','longitude','model','scenario']).agg({'fCover':'mean','tmean':'mean','pr':'mean'}).reset_index()
-                                                                                      
-climatology.rename(columns={'fCover':'fCover_climatology','tmean':'tmean_climatology','pr':'pr_climatology'}, inplace=True)
-
-# subset to desired years and aggregate to larger temporal resolution
-phenograss_data = phenograss_data[phenograss_data.year.isin(display_years)]
-phenograss_data['year'] = phenograss_data.year - (phenograss_data.year % year_resolution)
-phenograss_data = phenograss_data.groupby(['latitude','longitude','model','scenario','year']).agg({'fCover':'mean','tmean':'mean','pr':'mean'}).reset_index()
-
-phenograss_data = pd.merge(phenograss_data, climatology, on=['latitude','longitude','model','scenario'], how='left')
-
-phenograss_data['fCover_annomoly'] = (phenograss_data.fCover - phenograss_data.fCover_climatology) / phenograss_data.fCover_climatology
-phenograss_data['tmean_annomoly']  = (phenograss_data.tmean  - phenograss_data.tmean_climatology)
-phenograss_data['pr_anomaly']      = (phenograss_data.pr     - phenograss_data.pr_climatology)     / phenograss_data.pr_climatology
-
-# Aggregate everything per decade.
-# This should not be so convoluted but omg doing groupby stuff in pandas is a total chore
-
-annual_mean = phenograss_data.groupby(['latitude','longitude','year','scenario']).agg({'fCover_annomoly':'mean',
-                                                                                       'tmean_annomoly':'mean',
-                                                                                       'pr_anomaly':'mean'}).reset_index()
-annual_mean.rename(columns={'fCover_annomoly':'fCover_annomoly_mean','tmean_annomoly':'tmean_annomoly_mean','pr_anomaly':'pr_anomaly_mean'}, inplace=True)
-
-annual_std = phenograss_data.groupby(['latitude','longitude','year','scenario']).agg({'fCover_annomoly':'std',
-                                                                                       'tmean_annomoly':'std',
-                                                                                       'pr_anomaly':'std'}).reset_index()
-annual_std.rename(columns={'fCover_annomoly':'fCover_annomoly_std','tmean_annomoly':'tmean_annomoly_std','pr_anomaly':'pr_anomaly_std'}, inplace=True)
-
-phenograss_plot_data = pd.merge(annual_mean, annual_std, on=['latitude','longitude','year','scenario'] , how='left')
+anomaly_columns = ['fCover_annomoly','tmean_annomoly','pr_anomaly']
+group_columns   = ['latitude','longitude','year','scenario']
+
+def model_anomalies(phenograss_data, climate_data):
+    """
+    The decadal anomalies of every (latitude, longitude, model, scenario, year)
+    for the phenograss and climate data of a single climate model.
+    """
+    phenograss_data = pd.merge(phenograss_data, climate_data, how='right', on=['latitude', 'longitude', 'model', 'scenario', 'year'])
+    
+    # TODO: quick check that all timeseries are intact, and all models/secnarios avaialble
+    
+    climatology = phenograss_data[phenograss_data.year.isin(climatology_years)]
+    climatology = climatology.groupby(['latitude','longitude','model','scenario']).agg({'fCover':'mean','tmean':'mean','pr':'mean'}).reset_index()
+                                                                                          
+    climatology.rename(columns={'fCover':'fCover_climatology','tmean':'tmean_climatology','pr':'pr_climatology'}, inplace=True)
+    
+    # subset to desired years and aggregate to larger temporal resolution
+    phenograss_data = phenograss_data[phenograss_data.year.isin(display_years)]
+    phenograss_data['year'] = phenograss_data.year - (phenograss_data.year % year_resolution)
+    phenograss_data = phenograss_data.groupby(['latitude','longitude','model','scenario','year']).agg({'fCover':'mean','tmean':'mean','pr':'mean'}).reset_index()
+    
+    phenograss_data = pd.merge(phenograss_data, climatology, on=['latitude','longitude','model','scenario'], how='left')
+    
+    phenograss_data['fCover_annomoly'] = (phenograss_data.fCover - phenograss_data.fCover_climatology) / phenograss_data.fCover_climatology
+    phenograss_data['tmean_annomoly']  = (phenograss_data.tmean  - phenograss_data.tmean_climatology)
+    phenograss_data['pr_anomaly']      = (phenograss_data.pr     - phenograss_data.pr_climatology)     / phenograss_data.pr_climatology
+    return phenograss_data
+
+def plot_keys_of(climate_data):
+    """ The (latitude, longitude, year, scenario) rows model_anomalies() makes from climate_data """
+    keys = climate_data[climate_data.year.isin(display_years)][group_columns]
+    keys = keys.assign(year = keys.year - (keys.year % year_resolution))
+    return keys.drop_duplicates()
+
+# Aggregate everything per decade across the ensemble members, which are the
+# climate models, and also their different runs if there is a run column.
+# Both csv files are first split into a file per climate model, reading them
+# a chunk at a time. Then one climate model at a time is read, and its members 
+# streamed through the ensemble reducer, so neither the full data nor more 
+# than one climate model is ever in memory. Every calculation is within a 
+# climate model, so the results are the same as with all of them at once.
+climate_data_file    = 'data/climate_annual_data.csv'
+phenograss_data_file = 'data/phenograss_downscaled_annual_integral.csv'
+run_columns = [c for c in ['run'] if c in pd.read_csv(climate_data_file, nrows=0).columns.union(pd.read_csv(phenograss_data_file, nrows=0).columns)]
+
+with tempfile.TemporaryDirectory() as member_folder:
+    climate_files    = ensemble_tools.split_csv_by_member(climate_data_file, ['model'], os.path.join(member_folder, 'climate'))
+    phenograss_files = ensemble_tools.split_csv_by_member(phenograss_data_file, ['model'], os.path.join(member_folder, 'phenograss'))
+    
+    # Every row of the final data, from the climate data as it's the right side of the merge
+    plot_keys = pd.concat([plot_keys_of(pd.read_csv(f, usecols=['latitude','longitude','scenario','year'])) for f in climate_files.values()])
+    plot_keys = plot_keys.drop_duplicates().sort_values(group_columns)
+    plot_key_index = pd.MultiIndex.from_frame(plot_keys)
+    
+    ensemble = ensemble_tools.EnsembleStats(shape = (len(plot_key_index), len(anomaly_columns)))
+    for model, climate_file in sorted(climate_files.items()):
+        if model in phenograss_files:
+            model_phenograss = pd.read_csv(phenograss_files[model])
+        else:
+            model_phenograss = pd.read_csv(phenograss_data_file, nrows=0)
+        model_data = model_anomalies(model_phenograss, pd.read_csv(climate_file))
+        member_columns = ['model'] + [c for c in run_columns if c in model_data.columns]
+        for _, member_data in model_data.groupby(member_columns):
+            member_values = member_data.set_index(group_columns)[anomaly_columns].reindex(plot_key_index)
+            ensemble.add(member_values.values)
+        model_data = member_data = None
+
+phenograss_plot_data = plot_keys.reset_index(drop=True)
+ensemble_mean, ensemble_std = ensemble.mean, ensemble.std()
+for col_i, col in enumerate(anomaly_columns):
+    phenograss_plot_data[col + '_mean'] = ensemble_mean[:,col_i]
+for col_i, col in enumerate(anomaly_columns):
+    phenograss_plot_data[col + '_std'] = ensemble_std[:,col_i]
 
 phenograss_plot_data.to_csv('webapp/data/phenograss_timeseries_plot_data.csv')
+
+# The columnar version for the webapp, where the 0.5 degree mask defines the pixel grid
+website_mask = pd.read_csv('webapp/data/ecoregion_mask.csv')
+plot_store.write_plot_store(phenograss_plot_data, website_mask, 'webapp/data/plot_store/')
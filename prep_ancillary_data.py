@@ -1,30 +1,23 @@
 import xarray as xr
 import numpy as np
-import xmap
+
+from tools.regrid_tools import Regridder
+from tools.raster_tools import grid_bounds, read_raster_stack
 
 """
 Take the original soil rasters in data/soil_rasters, convert them to the
 CMIP5 grid (also subsetting to north america in the process)
 and saving as netcdf
 
-uses xmap, which is no longer maintained but works pretty well with xarray
+The regridding weights are calculated once for each source grid and cached
+in data/regrid_weights/, see tools/regrid_tools.py. This used to use xmap, 
+which is no longer maintained.
 
-pip install git+git://github.com/sdtaylor/xmap
+Only a window of each raster covering the CMIP5 grid, plus a small margin
+for the regridding, is read from disk. So memory and time scale with
+north america and not the full global rasters.
 """
 
-# This does not account for a different CRS, but actually changing the CRS results
-# in minute differences. It also doesn't explicitely account for the original dataarray being
-# worldwide and the target being N. america. But the internals of xmap (a kdtree lookup)
-# seem to deal with this fine.
-def spatial_downscale(ds, target_array, method = 'distance_weighted', 
-                      downscale_args={'k':2}):
-    assert isinstance(target_array, xr.DataArray), 'target array must be DataArray'
-    ds_xmap = xmap.XMap(ds, debug=False)
-    ds_xmap.set_coords(x='longitude',y='latitude')
-    downscaled = ds_xmap.remap_like(target_array, xcoord='longitude', ycoord='latitude',
-                                    how=method, **downscale_args)
-    return downscaled
-
 reference = xr.open_dataset('data/cmip5_nc_files/BCCAv2_0.125deg_pr_day_CCSM4_rcp26_r1i1p1_20060101-20151231.nc4') 
 
 target_array = reference.pr.isel(time=1)
@@ -34,24 +27,19 @@ target_array = reference.pr.isel(time=1)
 target_array['longitude'] = target_array.longitude - 360
 target_array['latitude'] = target_array.latitude
 
+target_bounds = grid_bounds(target_array)
 
 
 ###################################################
 ###################################################
 soil_rasters = {'Wcap':'data/soil_rasters/fieldcap.dat',
                 'Wp'  :'data/soil_rasters/wiltpont.dat'}
-all_variable_datasets = []
-for var, filename in soil_rasters.items():
-    ds = xr.open_rasterio(filename)
-    ds = ds.rename({'x':'longitude','y':'latitude'})
-    ds = ds.sel(band=1)
-    
-    scaled_ds = spatial_downscale(ds=ds, target_array=target_array).rename(var)
-    # 
-    na_value = ds.attrs['nodatavals'][0]
-    scaled_ds = scaled_ds.where(scaled_ds!= na_value)
-    
-    all_variable_datasets.append(scaled_ds)
+# Both soil rasters are on the same grid, so are regridded together
+soil = read_raster_stack(soil_rasters, target_bounds, dim='variable')
+
+scaled_soil = Regridder(source=soil, target=target_array).regrid(soil)
+
+all_variable_datasets = [scaled_soil.sel(variable=var, drop=True).rename(var) for var in soil_rasters]
     
     
 ###################################################
@@ -72,22 +60,14 @@ precip_rasters = {1:'data/annual_precip/wc2.0_10m_prec_01.tif',
                  12:'data/annual_precip/wc2.0_10m_prec_12.tif'
                   }
 
-precip_vars = []
-for month, filename in precip_rasters.items():
-    ds = xr.open_rasterio(filename)
-    ds = ds.rename({'x':'longitude','y':'latitude'})
-    ds = ds.sel(band=1)
-    
-    scaled_ds = spatial_downscale(ds=ds, target_array=target_array).rename('precip')
-    # 
-    na_value = ds.attrs['nodatavals'][0]
-    scaled_ds = scaled_ds.where(scaled_ds != na_value) 
-    
-    scaled_ds = scaled_ds.expand_dims('month').assign_coords(month = ([month]))
-    precip_vars.append(scaled_ds)
+# All 12 months share a grid. They're read concurrently into a single
+# (month, latitude, longitude) array, so this is a single regridding step
+precip = read_raster_stack(precip_rasters, target_bounds, dim='month', max_workers=12)
+
+scaled_precip = Regridder(source=precip, target=target_array).regrid(precip)
     
 # Mean annual precip is the sum of mean monthly precip
-MAP = xr.concat(precip_vars, dim='month').sum('month').rename('MAP')
+MAP = scaled_precip.sum('month').rename('MAP')
 all_variable_datasets.append(MAP)
 
 all_variables = xr.merge(all_variable_datasets)
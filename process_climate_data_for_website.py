@@ -2,9 +2,11 @@ import pandas as pd
 import numpy as np
 import GrasslandModels
 
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from time import sleep
 import os
+import shutil
 
 from dask_jobqueue import SLURMCluster
 from dask.distributed import Client
@@ -20,62 +22,149 @@ resolution to match the phenograss output.
 
 I can be setup to run on a dask cluster, but its easier to just get a single HPC 
 with 128GB+ of memory and run it there.
+
+Several model/scenarios are done at once, each reduced lazily with dask in 
+time chunks instead of being loaded whole, while the total estimated memory 
+stays under memory_limit_gb. Each finished model/scenario is written to its 
+own csv in climate_parts_folder, and those are joined into the final csv.
 """
 
 #################################################
 # Layout all the data
 
-climate_data_folder = 'data/cmip5_nc_files/'
+# climate_data_folder is set below, with the other tools
 climate_model_info = cmip5_file_tools.get_cmip5_spec(models='all',scenarios='all')
     
-chunk_sizes = {'latitude':-1 ,'longitude':-1,'time':-1}
+# About a year of the full grid per chunk
+chunk_sizes = {'latitude':-1 ,'longitude':-1,'time':365}
+
+max_concurrent_combos = 4
+memory_limit_gb       = 100
+# dask threads for each model/scenario, so all combos together use all cpus
+threads_per_combo     = max(1, os.cpu_count() // max_concurrent_combos)
+
+climate_parts_folder = 'data/climate_annual_data_parts/'
+
+# annual tmean/pr already made by apply_model_to_cmip.py
+annual_climate_folder = 'data/climate_annual_nc_files/'
 
 ###################################################
 #client = Client(n_workers=32, memory_limit='2GB', local_directory='/tmp/')
 ###################################################
 # Don't import xarray until here so that it registers with dask
 import xarray as xr
-from tools import xarray_tools
+from tools import xarray_tools, mask_tools, instrument_tools, product_tools, pipeline_tools, quantize_tools
+
+# The int16 copies of the cmip files once they're validated, see tools/quantize_tools.py
+climate_data_folder = quantize_tools.climate_data_folder()
+
+run_report = instrument_tools.RunReport('process_climate_data_for_website')
 
 ###################################################
 # A mask of where the model is relavant. most of the USA will be excluded. 
-# climate data does not use ecoregions, so just aggregate it all to a single layer.
-mask = xr.open_dataarray('data/ecoregion_mask.nc')
-mask = mask.max('ecoregion')
-
-all_climate = []
-for ds_i, ds_info in enumerate(climate_model_info):
+# climate data does not use ecoregions, so any labeled cell is included.
+mask = mask_tools.load_ecoregion_label('data/ecoregion_mask.nc')
+mask = (mask > 0).rename('ecoregion_mask')
+
+memory_budget = pipeline_tools.MemoryBudget(memory_limit_gb * 1e9)
+
+def estimate_memory(ds):
+    """ 
+    Rough peak memory for the annual reduction of a lazy ds. Every dask thread
+    holds a chunk of each variable, plus temporaries about the same size, 
+    along with the annual values and their data.frame.
+    """
+    chunk_bytes = sum([np.prod(ds[v].data.chunksize) * ds[v].dtype.itemsize for v in ['tasmin','tasmax','pr']])
+    n_years = len(np.unique(ds['time.year']))
+    annual_bytes = n_years * ds.latitude.size * ds.longitude.size * 2 * 4
+    return 2 * threads_per_combo * chunk_bytes + 5 * annual_bytes
+
+def annual_climate(climate_model_name, scenario, model_files):
+    """ 
+    The annual tmean/pr, coarsened to 0.5 deg, for a set of cmip files as a data.frame.
+    apply_model_to_cmip.py makes the annual values while running phenograss, so
+    when that file is there the cmip files are not read again.
+    """
+    stage_tags = dict(model = climate_model_name, scenario = scenario)
+    annual_climate_file = annual_climate_folder + 'climate_annual_{m}_{s}.nc'.format(m=climate_model_name, s=scenario)
+    
+    if os.path.exists(annual_climate_file):
+        with run_report.stage('load_annual_climate', **stage_tags):
+            ann = xr.open_dataset(annual_climate_file).load()
+    else:
+        ds = xarray_tools.compile_cmip_data(climate_model_name =  climate_model_name, 
+                                            scenario =            scenario, 
+                                            climate_model_files = model_files, 
+                                            chunk_sizes =         chunk_sizes)
+    
+        # The annual values are computed from the files chunk by chunk, without 
+        # loading the full daily data. 
+        with memory_budget.reserve(estimate_memory(ds)), run_report.stage('annual_climate', **stage_tags):
+            ann = product_tools.annual_climate(ds).compute(scheduler='threads', num_workers=threads_per_combo)
+        ds.close()
+
+    with run_report.stage('coarsen_climate', **stage_tags):
+        ann = xr.merge([ann, mask]).to_dataframe().reset_index()
+        ann = ann[ann.ecoregion_mask]
+    
+        # coursen the cells a tad, agregating to the mean within them
+        ann['latitude'] = np.floor(ann.latitude*2)/2
+        ann['longitude'] = np.floor(ann.longitude*2)/2
+    
+        ann = ann.groupby(['latitude','longitude','model','scenario','time']).agg({'tmean':'mean','pr':'mean'}).reset_index()
+    
+        ann = ann.rename(columns={'time':'year'})
+      
+        # knock of some digits to save space in the csv
+        for col in ['tmean','pr']:
+            ann[col] = ann[col].round(3)
+
+    return ann
+
+def write_scenario_part(ds_info, historic_ann):
+    """
+    Write the annual climate of a model/scenario, with the historic years 
+    from historic_ann, to its own csv in climate_parts_folder.
+    """
     model_files = cmip5_file_tools.get_cmip5_files(model_spec = ds_info,
                                                    base_folder = climate_data_folder,
-                                                   get_historic=True)
+                                                   get_historic = False)
     
-    ds = xarray_tools.compile_cmip_data(climate_model_name =  ds_info['climate_model_name'], 
-                                              scenario =            ds_info['scenario'], 
-                                              climate_model_files = model_files, 
-                                              chunk_sizes =         chunk_sizes)
-
-    ds.load()
-    ds['time'] = ds['time.year']
-    ann_temp = ds.tmean.groupby('time').mean().compute()
-    ann_pr   = ds.pr.groupby('time').sum().compute()
-
-    ann = xr.merge([ann_temp,ann_pr])
-    ann = xr.merge([ann, mask.astype(bool)]).to_dataframe().reset_index()
-    ann = ann[ann.ecoregion_mask]
-
-    # coursen the cells a tad, agregating to the mean within them
-    ann['latitude'] = np.floor(ann.latitude*2)/2
-    ann['longitude'] = np.floor(ann.longitude*2)/2
-
-    ann = ann.groupby(['latitude','longitude','model','scenario','time']).agg({'tmean':'mean','pr':'mean'}).reset_index()
-
-    ann = ann.rename(columns={'time':'year'})
-  
-    # knock of some digits to save space in the csv
-    for col in ['tmean','pr']:
-        ann[col] = ann[col].round(3)
-
-    all_climate.append(ann)
-    ds.close()
-
-pd.concat(all_climate).to_csv('data/climate_annual_data.csv', index=False)
+    ann = annual_climate(ds_info['climate_model_name'], ds_info['scenario'], model_files)
+    ann = pd.concat([historic_ann.result().assign(scenario = ds_info['scenario']), ann])
+    
+    part_file = climate_parts_folder + 'climate_annual_{m}_{s}.csv'.format(m=ds_info['climate_model_name'], s=ds_info['scenario'])
+    ann.to_csv(part_file, index=False)
+    return part_file
+
+os.makedirs(climate_parts_folder, exist_ok=True)
+
+# The pre-2006 historic files are the same for every scenario of a climate
+# model, so they are done once and copied to each scenario. They are all 
+# submitted first so scenarios never wait on a historic run stuck in the queue.
+with ThreadPoolExecutor(max_workers = max_concurrent_combos) as pool:
+    historic_annuals = {}
+    for ds_info in climate_model_info:
+        climate_model_name = ds_info['climate_model_name']
+        if climate_model_name not in historic_annuals:
+            historic_files = cmip5_file_tools.get_cmip5_files(model_spec = ds_info,
+                                                              base_folder = climate_data_folder,
+                                                              get_historic = True,
+                                                              get_forecast = False)
+            historic_annuals[climate_model_name] = pool.submit(annual_climate, climate_model_name, 'historic', historic_files)
+    
+    part_files = [pool.submit(write_scenario_part, ds_info, historic_annuals[ds_info['climate_model_name']]) for ds_info in climate_model_info]
+    part_files = [f.result() for f in part_files]
+
+# Join all the parts, in the same model/scenario order as before, without 
+# reading them into memory.
+with run_report.stage('write_csv'):
+    with open('data/climate_annual_data.csv', 'w') as csv_file:
+        for part_i, part_file in enumerate(part_files):
+            with open(part_file) as part:
+                header = part.readline()
+                if part_i == 0:
+                    csv_file.write(header)
+                shutil.copyfileobj(part, csv_file)
+
+run_report.write('data/run_reports/process_climate_data_for_website.json')
@@ -5,6 +5,7 @@ import xarray as xr
 import pandas as pd
 import numpy as np
 
+from tools import mask_tools, instrument_tools, period_tools, pixel_tools
 
 """
 Take the phenograss files from apply_model_to_cmip in
@@ -13,12 +14,15 @@ annomoly, upscale to a coarse spatial resolution, and save
 to a csv file for use on the website.
 """
 
-chunk_sizes = dict(latitude=100,
-                   longitude=100,
+run_report = instrument_tools.RunReport('process_phenograss_output_for_website')
+
+# The files only have the cells inside the ecoregions, as a pixel dimension.
+# See pixel_tools.
+chunk_sizes = dict(pixel=10000,
                    time=2000)
 
 # A mask of where the model is relavant. most of the USA will be excluded. 
-mask = xr.open_dataarray('data/ecoregion_mask.nc')
+mask = mask_tools.load_ecoregion_label('data/ecoregion_mask.nc')
 
 phenograss_files = glob('data/phenograss_nc_files/phenograss_file*.nc4')
 
@@ -26,18 +30,29 @@ annual_integral_objs = []
 for file_i, filepath in enumerate(phenograss_files):
     print('file: {i}'.format(i=file_i))
     ecoregion = path.basename(filepath).split('_')[-2]
-    p = xr.open_dataset(filepath, chunks=chunk_sizes)
+    p = pixel_tools.open_pixel_dataset(filepath, chunks=chunk_sizes)
     
     # add an ecoregion dimension to pair it with the ecoregion mask
     p = p.expand_dims({'ecoregion':[ecoregion]})
     
     # Get annual integral. The sum of all fCover values in a calendar year
-    p['time'] = p['time.year']
-    annual_fCover = p.groupby('time').sum().compute()
+    with run_report.stage('annual_integral', file = path.basename(filepath)):
+        annual_fCover = period_tools.reduce_periods(p, how='sum', freq='year').compute()
+        annual_fCover = pixel_tools.from_pixels(annual_fCover)
     
     annual_integral_objs.append(annual_fCover)
 
-annual_integral = xr.merge(annual_integral_objs)
+with run_report.stage('merge_annual_integrals'):
+    annual_integral = xr.merge(annual_integral_objs)
+
+    # The 1980-2005 years are done once per climate model in apply_model_to_cmip.py,
+    # as the 'historic' scenario. Put them in every scenario the climate model
+    # has output for, so each scenario is the full 1980-2100 time series.
+    if 'historic' in annual_integral.scenario:
+        historic = annual_integral.sel(scenario='historic', drop=True)
+        annual_integral = annual_integral.drop_sel(scenario='historic')
+        has_output = annual_integral.fCover.notnull().any(['ecoregion','time','latitude','longitude'])
+        annual_integral = annual_integral.fillna(historic.where(has_output))
 
 # Combine all ecoregions into a single layer here. 
 #
@@ -45,15 +60,16 @@ annual_integral = xr.merge(annual_integral_objs)
 # applied over the entire USA climate grids. So, for each location the correct
 # model prediction for that ecoregion must be pulled.
 #
-# In the ecoregion mask every location has an ecoregion dimension. 
-# ie for 3 ecoregions it would be [1,0,0] for ['GrPlains','NWForests','ETemperateForest']
-# Thus taking the average using the ecoregion mask as weights here will
-# pull the correction value.
-annual_integral = annual_integral.weighted(mask.astype(int)).mean('ecoregion') 
+# In the ecoregion mask every location has a bit set for each ecoregion it's in,
+# ie. 1 for NWForests, 3 for the border of NWForests and GrPlains, and 0 for
+# no ecoregion. Thus for every location the prediction from the model of its 
+# ecoregion is pulled, and along borders the average of both models.
+with run_report.stage('combine_ecoregions'):
+    annual_integral = mask_tools.mean_by_label(annual_integral, mask)
 
-annual_integral = annual_integral.to_dataframe().reset_index()
+    annual_integral = annual_integral.to_dataframe().reset_index()
 
-# NA values are locations where no ecoregion was specified. ie. a mask of [0,0,0]
+# NA values are locations where no ecoregion was specified. ie. a label of 0
 # This happens outside the ecoregions designated in create_ecoregion_mask.py
 annual_integral = annual_integral.dropna(0)
 
@@ -70,3 +86,5 @@ for col in ['fCover']:
     annual_integral[col] = annual_integral[col].round(4)
 
 annual_integral.to_csv('data/phenograss_downscaled_annual_integral.csv', index=False)
+
+run_report.write('data/run_reports/process_phenograss_output_for_website.json')
@@ -95,12 +95,14 @@ def get_cmip5_spec(models='all',scenarios='all'):
     
     return to_return
 
-def get_cmip5_files(model_spec, base_folder, get_historic=True):
+def get_cmip5_files(model_spec, base_folder, get_historic=True, get_forecast=True):
     """
     The cmip5 files are usually spread across numerous netCDF files with different time
     ranges (usually 10 year chunks) and variables (precip, tmin, tmax).
     This gets a list of all of them to pass to xarray.open_mfrdataset().
-    Historic is the pre-2006 data which is not tied to any scenario.
+    Historic is the pre-2006 data which is not tied to any scenario. It is
+    the same for every scenario of a climate model, so it can be processed 
+    once by using get_forecast=False, and then get_historic=False for each scenario.
     
     Used in combination with load_cmip5_spec()
     """
@@ -109,8 +111,10 @@ def get_cmip5_files(model_spec, base_folder, get_historic=True):
     forecast_search = model_spec['model_file_search_str'] + '_' + model_spec['scenario'] + '*.nc4'
     historic_search = model_spec['model_file_search_str'] + '_historic*.nc4'
     
-    model_files = glob.glob(base_folder + forecast_search)
-    assert len(model_files) > 5, 'no model files found for {m} - {s}'.format(m = model_spec['climate_model_name'] , s = model_spec['scenario'])
+    model_files = []
+    if get_forecast:
+        model_files.extend(glob.glob(base_folder + forecast_search))
+        assert len(model_files) > 5, 'no model files found for {m} - {s}'.format(m = model_spec['climate_model_name'] , s = model_spec['scenario'])
     
     # The historic files
     if get_historic:
@@ -0,0 +1,156 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+"""
+Streaming statistics over ensemble members, ie. climate models or the
+different runs (r1i1p1, r2i1p1, ...) of a climate model. Members are added
+one at a time, and only the running statistics are kept, so memory does not
+grow with the number of members. split_csv_by_member() gets the members out
+of a large csv without reading it all into memory.
+"""
+
+class EnsembleStats:
+    def __init__(self, shape, quantile_bins=None):
+        """
+        Running count, mean, variance (Welford's algorithm), min and max for
+        every element of an array, eg. every (pixel, scenario, year).
+
+        Parameters
+        ----------
+        shape : tuple
+            shape of the arrays which will be added. Every element is a
+            separate set of statistics.
+        quantile_bins : array or None
+            optional bin edges for a histogram sketch of every element, used to
+            get approximate quantiles. They're only as accurate as the bin width,
+            and use len(quantile_bins)+1 counts for every element.
+        """
+        self.shape = tuple(shape)
+        self.count = np.zeros(self.shape, dtype=np.int32)
+        self._mean = np.zeros(self.shape, dtype=np.float64)
+        self._m2   = np.zeros(self.shape, dtype=np.float64)
+        self._min  = np.full(self.shape, np.inf)
+        self._max  = np.full(self.shape, -np.inf)
+
+        if quantile_bins is None:
+            self.quantile_bins = None
+        else:
+            self.quantile_bins = np.sort(np.asarray(quantile_bins, dtype=np.float64))
+            # the first and last bins are everything below/above the edges
+            self._histogram = np.zeros(self.shape + (len(self.quantile_bins) + 1,), dtype=np.int32)
+
+    def add(self, values):
+        """
+        Add a single ensemble member. values should have the same shape as
+        the statistics, with NaN where the member has no data.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        assert values.shape == self.shape, 'expected shape {e}, got {g}'.format(e=self.shape, g=values.shape)
+
+        is_valid = ~np.isnan(values)
+        self.count += is_valid
+
+        delta = np.where(is_valid, values - self._mean, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self._mean += np.where(is_valid, delta / self.count, 0)
+        self._m2 += np.where(is_valid, delta * (values - self._mean), 0)
+
+        # fmin/fmax ignore NaN
+        np.fmin(self._min, values, out=self._min)
+        np.fmax(self._max, values, out=self._max)
+
+        if self.quantile_bins is not None:
+            valid_i = np.flatnonzero(is_valid)
+            bin_i = np.searchsorted(self.quantile_bins, values.ravel()[valid_i], side='right')
+            self._histogram.reshape(-1, self._histogram.shape[-1])[valid_i, bin_i] += 1
+
+    def merge(self, other):
+        """
+        Combine with the statistics of another set of members, eg. one made
+        in a different process. Uses the parallel variance of Chan et al.
+        """
+        assert other.shape == self.shape, 'shapes do not match'
+        total = self.count + other.count
+        delta = other._mean - self._mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self._mean = np.where(total > 0, self._mean + delta * other.count / total, 0)
+            self._m2   = np.where(total > 0, self._m2 + other._m2 + delta**2 * self.count * other.count / total, 0)
+        self.count = total
+
+        np.fmin(self._min, other._min, out=self._min)
+        np.fmax(self._max, other._max, out=self._max)
+
+        if self.quantile_bins is not None:
+            assert other.quantile_bins is not None and np.array_equal(self.quantile_bins, other.quantile_bins), 'quantile_bins do not match'
+            self._histogram += other._histogram
+
+    @property
+    def mean(self):
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    def variance(self, ddof=1):
+        """ ddof=1 is the sample variance, the same as pandas .var() """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > ddof, self._m2 / (self.count - ddof), np.nan)
+
+    def std(self, ddof=1):
+        """ ddof=1 is the sample standard deviation, the same as pandas .std() """
+        return np.sqrt(self.variance(ddof=ddof))
+
+    @property
+    def min(self):
+        return np.where(self.count > 0, self._min, np.nan)
+
+    @property
+    def max(self):
+        return np.where(self.count > 0, self._max, np.nan)
+
+    def quantile(self, q):
+        """
+        Approximate quantile q (0-1) from the histogram sketch, interpolating
+        linearly within the bin it falls in. The outer bins are bounded by
+        each element's min and max.
+        """
+        assert self.quantile_bins is not None, 'quantile_bins were not set'
+        assert 0 <= q <= 1, 'q must be between 0 and 1'
+
+        cumulative = np.cumsum(self._histogram, axis=-1)
+        target = q * self.count
+        bin_i = np.argmax(cumulative >= target[..., None], axis=-1)[..., None]
+
+        n_in_bin = np.take_along_axis(self._histogram, bin_i, axis=-1)[..., 0]
+        n_before = np.take_along_axis(cumulative, bin_i, axis=-1)[..., 0] - n_in_bin
+        bin_i = bin_i[..., 0]
+
+        edges = np.concatenate([[-np.inf], self.quantile_bins, [np.inf]])
+        lower = np.fmax(edges[bin_i], self._min)
+        upper = np.fmin(edges[bin_i + 1], self._max)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(n_in_bin > 0, (target - n_before) / n_in_bin, 0)
+            estimate = lower + np.clip(fraction, 0, 1) * (upper - lower)
+
+        return np.where(self.count > 0, estimate, np.nan)
+
+def split_csv_by_member(filename, member_columns, folder, chunksize=1000000):
+    """
+    Split a csv into a csv for every ensemble member, eg. every model, in 
+    folder. The file is read chunksize rows at a time, so it's never all in
+    memory, and each member can then be read on its own.
+
+    Returns {member : filename}, where member is the tuple of member_columns
+    values, in the order the members first appear.
+    """
+    os.makedirs(folder, exist_ok=True)
+    member_files = {}
+    for chunk in pd.read_csv(filename, chunksize=chunksize):
+        for member, member_chunk in chunk.groupby(member_columns, sort=False):
+            member = member if isinstance(member, tuple) else (member,)
+            if member not in member_files:
+                member_files[member] = os.path.join(folder, 'member_{i}.csv'.format(i=len(member_files)))
+                member_chunk.to_csv(member_files[member], index=False)
+            else:
+                member_chunk.to_csv(member_files[member], index=False, header=False, mode='a')
+    return member_files
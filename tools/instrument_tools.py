@@ -0,0 +1,260 @@
+import contextlib
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from datetime import datetime
+
+"""
+Timing and memory instrumentation for the processing scripts. Each script
+makes a RunReport, wraps its steps in report.stage(), and writes the
+report to a json file at the end.
+
+    report = instrument_tools.RunReport('apply_model_to_cmip')
+    with report.stage('load_climate', model='ccsm4', scenario='rcp26'):
+        ds.load()
+    report.write('data/run_reports/apply_model_to_cmip.json')
+
+Every stage records the wall time, cpu time, rss at the start and end,
+the peak rss of the process so far, bytes read/written to disk, and the
+number of dask tasks run. Any keyword arguments to stage() (eg. model and
+scenario) are kept as tags so stages can be summarized per model/scenario.
+
+The rss and bytes read/written are for this process only. When using a
+dask.distributed cluster that's the head process, and the worker side
+is in the dask performance report from report.performance_report().
+
+dask_tasks means something different for the two kinds of scheduler:
+    - With the local schedulers it's the tasks of every compute started in
+      the stage's own thread. Nested stages are included in their parent.
+      If stages in other threads were counting at the same time it's None,
+      as dask only gives its global callbacks to one compute at a time.
+    - With a distributed client it's every task the cluster finished while 
+      the stage was open, whoever submitted it. So it's only recorded for
+      top level stages, and stages which do not compute anything on the
+      cluster should turn it off with count_dask_tasks=False, as it would
+      be the tasks of whatever else is running.
+It's None when not counted.
+
+Functions decorated with @instrumented (eg. in xarray_tools) are recorded as
+stages in the active report, the most recently created one. When there is no
+report they run as normal. Many of these only build a lazy dask graph, which 
+is computed later in some other stage. For those lazy is True in the record,
+and the times are only for building the graph (including reading any file 
+metadata), not the computation.
+"""
+
+_active_report = None
+
+def _rss_mb():
+    """ Current resident memory of this process in MB. Linux only, None otherwise. """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    return None
+
+def _peak_rss_mb():
+    # ru_maxrss is KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _io_bytes():
+    """ (bytes read, bytes written) to storage by this process. Linux only, None otherwise. """
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        return int(io['read_bytes']), int(io['write_bytes'])
+    except (FileNotFoundError, PermissionError, KeyError):
+        return None, None
+
+def _cpu_seconds():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + child_usage.ru_utime + child_usage.ru_stime
+
+# The counters of the local scheduler stages open in each thread
+_local_counters = {}
+_local_counters_lock = threading.Lock()
+
+@contextlib.contextmanager
+def _count_dask_tasks(dask_client=None):
+    """
+    Count the dask tasks run inside the context. With the local schedulers
+    this uses a scheduler callback, with a distributed client the task stream.
+    Yields a dict which has the 'n' key set on exit.
+    
+    Scheduler callbacks are global, so they see the computes of every thread.
+    The local schedulers run posttask in the thread which called compute, 
+    so only the tasks from this thread are counted. But while one compute is 
+    running dask hides the global callbacks from any other compute starting, 
+    so when a thread counts at the same time as another the count is 
+    incomplete, and 'n' is None instead.
+    """
+    counter = {'n':None, 'overlapped':False}
+    if dask_client is not None:
+        from distributed import get_task_stream
+        with get_task_stream(client=dask_client) as task_stream:
+            yield counter
+        counter['n'] = len(task_stream.data)
+    else:
+        from dask.callbacks import Callback
+        n_tasks = [0]
+        stage_thread = threading.get_ident()
+        def posttask(key, result, dsk, state, worker_id):
+            if threading.get_ident() == stage_thread:
+                n_tasks[0] += 1
+        
+        with _local_counters_lock:
+            for thread, open_counters in _local_counters.items():
+                if thread != stage_thread and open_counters:
+                    counter['overlapped'] = True
+                    for c in open_counters:
+                        c['overlapped'] = True
+            _local_counters.setdefault(stage_thread, []).append(counter)
+        try:
+            with Callback(posttask=posttask):
+                yield counter
+        finally:
+            with _local_counters_lock:
+                _local_counters[stage_thread] = [c for c in _local_counters[stage_thread] if c is not counter]
+        counter['n'] = None if counter['overlapped'] else n_tasks[0]
+
+class RunReport:
+    def __init__(self, name, dask_client=None, activate=True):
+        """
+        Parameters
+        ----------
+        name : str
+            name of the script or run, saved in the report
+        dask_client : dask.distributed.Client or None
+            the client if using a distributed cluster, used for counting tasks
+            and the performance report
+        activate : bool
+            make this the active report which @instrumented functions use
+        """
+        global _active_report
+        self.name = name
+        self.dask_client = dask_client
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self.stages = []
+        # stages can be added by one thread while another writes the report
+        self._stages_lock = threading.RLock()
+        # Stages are nested per thread, so scripts can run stages in
+        # several threads at once
+        self._thread_stages = threading.local()
+        if activate:
+            _active_report = self
+
+    @contextlib.contextmanager
+    def stage(self, stage_name, count_dask_tasks=True, **tags):
+        """
+        Record everything inside the context as a single stage. Stages can be
+        nested, the parent of each stage is recorded and its tags are inherited.
+        
+        The cpu time, rss, and bytes read/written are for the whole process, 
+        so with stages running in several threads they include all of them.
+        See the module docstring for what dask_tasks counts. count_dask_tasks 
+        False leaves it as None.
+        """
+        if not hasattr(self._thread_stages, 'open'):
+            self._thread_stages.open = []
+        open_stages = self._thread_stages.open
+        parent = open_stages[-1] if open_stages else None
+        record = {'stage'  : stage_name,
+                  'parent' : None if parent is None else parent['stage'],
+                  'tags'   : {**({} if parent is None else parent['tags']), **{k:str(v) for k, v in tags.items()}},
+                  'start'  : datetime.now().isoformat(timespec='seconds')}
+        open_stages.append(record)
+
+        rss_start = _rss_mb()
+        read_start, write_start = _io_bytes()
+        cpu_start = _cpu_seconds()
+        wall_start = time.perf_counter()
+        # With a distributed client the task stream is for the whole cluster, 
+        # a nested stage would only repeat part of its parent's.
+        if self.dask_client is not None and parent is not None:
+            count_dask_tasks = False
+        task_counter = _count_dask_tasks(self.dask_client) if count_dask_tasks else contextlib.nullcontext({'n':None})
+        try:
+            with task_counter as dask_tasks:
+                yield record
+        finally:
+            open_stages.pop()
+            read_end, write_end = _io_bytes()
+            record.update({'wall_s'        : round(time.perf_counter() - wall_start, 4),
+                           'cpu_s'         : round(_cpu_seconds() - cpu_start, 4),
+                           'rss_start_mb'  : rss_start,
+                           'rss_end_mb'    : _rss_mb(),
+                           'peak_rss_mb'   : _peak_rss_mb(),
+                           'bytes_read'    : None if read_start is None else read_end - read_start,
+                           'bytes_written' : None if write_start is None else write_end - write_start,
+                           'dask_tasks'    : dask_tasks['n']})
+            with self._stages_lock:
+                self.stages.append(record)
+
+    def performance_report(self, filename):
+        """
+        A dask.distributed performance report (an html file) of everything
+        inside the context. Does nothing without a distributed client.
+        """
+        if self.dask_client is None:
+            return contextlib.nullcontext()
+        from distributed import performance_report
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        return performance_report(filename=filename)
+
+    def summary(self, by=('model','scenario')):
+        """
+        Total wall/cpu time and max peak rss of top level stages, grouped by
+        the stage name and the tags in by.
+        """
+        with self._stages_lock:
+            stages = list(self.stages)
+        totals = {}
+        for s in stages:
+            if s['parent'] is not None:
+                continue
+            key = ' '.join([s['stage']] + [s['tags'][t] for t in by if t in s['tags']])
+            t = totals.setdefault(key, {'n':0, 'wall_s':0, 'cpu_s':0, 'peak_rss_mb':0})
+            t['n'] += 1
+            t['wall_s'] = round(t['wall_s'] + s['wall_s'], 4)
+            t['cpu_s'] = round(t['cpu_s'] + s['cpu_s'], 4)
+            t['peak_rss_mb'] = max(t['peak_rss_mb'], s['peak_rss_mb'])
+        return totals
+
+    def write(self, filename):
+        """ Write the full report to a json file. The folder is created if needed. """
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with self._stages_lock:
+            report = {'name'     : self.name,
+                      'started'  : self.started,
+                      'finished' : datetime.now().isoformat(timespec='seconds'),
+                      'summary'  : self.summary(),
+                      'stages'   : list(self.stages)}
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2)
+
+def instrumented(func):
+    """
+    Decorator to record a function as a stage, named after the function, in
+    the active RunReport. The record has lazy True when the function returns 
+    a dask collection, ie. it only built the graph.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _active_report is None:
+            return func(*args, **kwargs)
+        from dask import is_dask_collection
+        with _active_report.stage(func.__name__) as record:
+            result = func(*args, **kwargs)
+            record['lazy'] = is_dask_collection(result)
+            return result
+    return wrapper
@@ -0,0 +1,41 @@
+import numpy as np
+import xarray as xr
+
+"""
+Helpers for the integer ecoregion label mask made in create_ecoregion_mask.py.
+
+data/ecoregion_mask.nc has a single int8 (latitude, longitude) layer,
+ecoregion_label, of bit flags. Bit i is set when the cell touches the i'th
+ecoregion, so cells along a border have more than one set, and 0 is outside
+all ecoregions. The bit for each ecoregion name is in the CF style 
+flag_masks/flag_meanings attributes.
+"""
+
+def load_ecoregion_label(filename='data/ecoregion_mask.nc'):
+    return xr.open_dataset(filename).ecoregion_label.load()
+
+def ecoregion_names(label):
+    """ {bit value : ecoregion shortname} from the label attributes """
+    return dict(zip([int(v) for v in np.atleast_1d(label.attrs['flag_masks'])],
+                    label.attrs['flag_meanings'].split(' ')))
+
+def ecoregion_weights(label, dim='ecoregion'):
+    """
+    The label as 0/1 weights with an ecoregion dimension, dim, with the 
+    ecoregion shortnames as coordinates. ie. [1,0,0] for a cell in only
+    the first ecoregion, and [1,1,0] for one on the border of the first two.
+    """
+    names = ecoregion_names(label)
+    weights = xr.concat([((label & bit) > 0).astype(int) for bit in names], dim=dim)
+    return weights.assign_coords({dim:list(names.values())})
+
+def mean_by_label(obj, label, dim='ecoregion'):
+    """
+    For every cell the mean of the values from obj over the ecoregions set
+    in the label mask. So a cell in a single ecoregion gets the values of 
+    that ecoregion, and a cell on a border the average of the ecoregions it
+    touches. obj has dimension dim with the ecoregion shortnames as 
+    coordinates, and the same latitude/longitude as the label. Cells outside
+    all ecoregions are NaN.
+    """
+    return obj.weighted(ecoregion_weights(label, dim)).mean(dim)
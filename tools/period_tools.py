@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask.array as da
+
+"""
+Fast reductions of daily data to years, seasons, or months.
+
+The period boundaries are found once from the time coordinate (so leap years
+and partial periods are handled by the dates themselves), and each period
+is reduced with a single np.add.reduceat/np.fmax.reduceat over the time axis.
+With dask the time chunks are first lined up with the period boundaries, so
+every chunk is reduced on its own with one task, instead of the many small
+tasks from xarray groupby.
+
+    annual_fCover = period_tools.reduce_periods(p, how='sum', freq='year')
+
+is the same as
+
+    p['time'] = p['time.year']
+    annual_fCover = p.groupby('time').sum()
+"""
+
+available_reductions = ['sum','mean','max','argmax']
+
+def period_boundaries(time, freq='year'):
+    """
+    The start index of every period in a time coordinate, along with a label
+    for each period.
+
+    Parameters
+    ----------
+    time : array like of dates
+        the time coordinate, in order
+    freq : str
+        'year', 'season' (DJF, MAM, JJA, SON), or 'month'. December is
+        in the DJF season of the following year.
+
+    Returns
+    -------
+    (labels, starts) : labels are the year for 'year', and the first date
+        of each period otherwise. starts are the index of the first day of
+        each period.
+    """
+    dates = pd.DatetimeIndex(np.asarray(time))
+    if freq == 'year':
+        period_keys = dates.year.values
+    elif freq == 'month':
+        period_keys = dates.year.values * 100 + dates.month.values
+    elif freq == 'season':
+        season_year = dates.year.values + (dates.month.values == 12)
+        period_keys = season_year * 10 + (dates.month.values % 12) // 3
+    else:
+        raise ValueError('unknown freq: {f}'.format(f=freq))
+
+    starts = np.flatnonzero(np.r_[True, period_keys[1:] != period_keys[:-1]])
+    if freq == 'year':
+        labels = period_keys[starts]
+    else:
+        labels = dates.values[starts]
+    return labels, starts
+
+def _reduce_kernel(values, starts, how, axis):
+    """ Reduce each period of a numpy array, along axis, starting at the indices in starts """
+    out_dtype = np.float32 if how == 'argmax' else np.result_type(values.dtype, np.float32)
+
+    if how in ['sum','mean']:
+        # NaN are skipped, like the xarray default. The sum is done in float64
+        # since reduceat adds each value in order.
+        is_valid = ~np.isnan(values)
+        sums = np.add.reduceat(np.where(is_valid, values, 0), starts, axis=axis, dtype=np.float64)
+        if how == 'sum':
+            return sums.astype(out_dtype)
+        counts = np.add.reduceat(is_valid, starts, axis=axis, dtype=np.int32)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / counts, np.nan).astype(out_dtype)
+    elif how == 'max':
+        # fmax skips NaN, and is NaN only when all values in a period are
+        return np.fmax.reduceat(values, starts, axis=axis).astype(out_dtype)
+    elif how == 'argmax':
+        # The index of the max within each period (ie. the day of year - 1
+        # for freq='year'), or NaN when all values in a period are NaN.
+        ends = np.r_[starts[1:], values.shape[axis]]
+        out = []
+        for start, end in zip(starts, ends):
+            period = np.take(values, np.arange(start, end), axis=axis)
+            all_nan = np.isnan(period).all(axis=axis)
+            peak = np.argmax(np.where(np.isnan(period), -np.inf, period), axis=axis).astype(out_dtype)
+            out.append(np.where(all_nan, np.nan, peak))
+        return np.stack(out, axis=axis).astype(out_dtype)
+    else:
+        raise ValueError('unknown reduction: {h}, available: {a}'.format(h=how, a=available_reductions))
+
+def _chunks_of_whole_periods(period_lengths, chunk_size):
+    """
+    Group consecutive periods into time chunks of about chunk_size days.
+    Returns the chunk sizes in days, and in periods.
+    """
+    day_chunks, period_chunks = [], []
+    chunk_days = chunk_periods = 0
+    for length in period_lengths:
+        if chunk_periods > 0 and chunk_days + length > chunk_size:
+            day_chunks.append(chunk_days)
+            period_chunks.append(chunk_periods)
+            chunk_days = chunk_periods = 0
+        chunk_days += length
+        chunk_periods += 1
+    day_chunks.append(chunk_days)
+    period_chunks.append(chunk_periods)
+    return tuple(day_chunks), tuple(period_chunks)
+
+def _reduce_data_array(obj, how, labels, starts):
+    axis = obj.get_axis_num('time')
+
+    if obj.chunks is None:
+        data = _reduce_kernel(obj.values, starts, how=how, axis=axis)
+    else:
+        period_lengths = np.diff(np.r_[starts, obj.sizes['time']])
+        day_chunks, period_chunks = _chunks_of_whole_periods(period_lengths, chunk_size = max(obj.chunks[axis]))
+        chunk_starts = np.split(starts, np.cumsum(period_chunks)[:-1])
+        chunk_starts = [s - s[0] for s in chunk_starts]
+
+        def block_kernel(values, block_info=None):
+            chunk_i = block_info[0]['chunk-location'][axis]
+            return _reduce_kernel(values, chunk_starts[chunk_i], how=how, axis=axis)
+
+        out_chunks = list(obj.data.rechunk({axis:day_chunks}).chunks)
+        out_chunks[axis] = period_chunks
+        data = da.map_blocks(block_kernel,
+                             obj.data.rechunk({axis:day_chunks}),
+                             chunks = tuple(out_chunks),
+                             dtype  = np.float32 if how == 'argmax' else np.result_type(obj.dtype, np.float32))
+
+    coords = {k:v for k, v in obj.coords.items() if 'time' not in v.dims}
+    coords['time'] = labels
+    return xr.DataArray(data, dims=obj.dims, coords=coords, name=obj.name, attrs=obj.attrs)
+
+def reduce_periods(obj, how='sum', freq='year'):
+    """
+    Reduce the daily values of a DataArray or Dataset to every year, season,
+    or month with how (sum, mean, max, or argmax). NaN values are skipped.
+
+    Returns the same type as obj, with the time coordinate replaced by the
+    period labels from period_boundaries(). Dataset variables without a
+    time dimension are kept as is.
+    """
+    labels, starts = period_boundaries(obj.time, freq=freq)
+
+    if isinstance(obj, xr.DataArray):
+        return _reduce_data_array(obj, how, labels, starts)
+
+    reduced = {}
+    for var in obj.data_vars:
+        if 'time' in obj[var].dims:
+            reduced[var] = _reduce_data_array(obj[var], how, labels, starts)
+        else:
+            reduced[var] = obj[var]
+    other_coords = {k:v for k, v in obj.coords.items() if 'time' not in v.dims}
+    return xr.Dataset(reduced, attrs=obj.attrs).assign_coords(other_coords)
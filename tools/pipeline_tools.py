@@ -0,0 +1,160 @@
+import contextlib
+import heapq
+import itertools
+import threading
+
+"""
+Helpers for running several climate model/scenario combinations at once
+in the processing scripts, either in threads of a single process or as
+prioritized futures on a dask.distributed cluster (FutureQueue).
+"""
+
+class MemoryBudget:
+    def __init__(self, limit_bytes):
+        """
+        A cap on the total memory of work running at the same time. Each piece
+        of work reserves its estimated memory, and waits until enough of the
+        budget is released by others.
+
+            budget = MemoryBudget(100e9)
+            with budget.reserve(estimated_bytes):
+                ds.compute()
+
+        Parameters
+        ----------
+        limit_bytes : int
+            the total memory which can be reserved at once
+        """
+        self.limit_bytes = limit_bytes
+        self.in_use_bytes = 0
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, n_bytes):
+        """
+        Block until n_bytes are available, and hold them until the context
+        exits. Anything larger than the full budget is capped to it, so it
+        runs alone instead of waiting forever.
+        """
+        n_bytes = min(int(n_bytes), self.limit_bytes)
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_use_bytes + n_bytes <= self.limit_bytes)
+            self.in_use_bytes += n_bytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_use_bytes -= n_bytes
+                self._condition.notify_all()
+
+class FutureQueue:
+    def __init__(self, client, max_in_flight_bytes):
+        """
+        Prioritized tasks on a dask.distributed client, with a cap on the
+        estimated memory of the results not yet handled. Tasks are added with
+        add(), the highest priority first (ties in the order they were added), 
+        and as many as fit are submitted. results() yields each one as it 
+        finishes, and submits more as they are handled, so the cluster has
+        work until the final task.
+
+            queue = FutureQueue(client, max_in_flight_bytes = 20e9)
+            for tile in tiles:
+                queue.add(tile, run_tile, tile, priority = 1, nbytes = tile_bytes)
+            for tag, future in queue.results():
+                write(tag, future.result())
+
+        Tasks can also be added while iterating results(), eg. ones which
+        depend on a finished future, or from another thread. For the latter
+        give results() the concurrent.futures.Future of the adding thread, 
+        so it keeps waiting for tasks until that finishes.
+
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                adding = pool.submit(add_all_tiles, queue)
+                for tag, future in queue.results(adding = adding):
+                    write(tag, future.result())
+
+        Parameters
+        ----------
+        client : distributed.Client
+        max_in_flight_bytes : int
+            the total estimated result size of tasks submitted but not yet
+            handled. A single task larger than this still runs, alone.
+        """
+        self.client = client
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.in_flight_bytes = 0
+        self._pending = []
+        self._order = itertools.count()
+        self._submitted = {}
+        self._as_completed = None
+        self._condition = threading.Condition(threading.RLock())
+
+    def add(self, tag, func, *args, priority=0, nbytes=0, **kwargs):
+        """
+        Queue func(*args, **kwargs). tag is given back along with the future
+        by results(). args can include other futures.
+        """
+        with self._condition:
+            heapq.heappush(self._pending, (-priority, next(self._order), (tag, func, args, kwargs, priority, nbytes)))
+            self._condition.notify_all()
+
+    def __len__(self):
+        """ The number of tasks queued or running """
+        with self._condition:
+            return len(self._pending) + len(self._submitted)
+
+    def submit_pending(self):
+        """ Submit queued tasks, highest priority first, until the memory cap is reached """
+        from distributed import as_completed
+        with self._condition:
+            if self._as_completed is None:
+                self._as_completed = as_completed()
+
+            while self._pending:
+                tag, func, args, kwargs, priority, nbytes = self._pending[0][2]
+                if self.in_flight_bytes > 0 and self.in_flight_bytes + nbytes > self.max_in_flight_bytes:
+                    break
+                heapq.heappop(self._pending)
+                future = self.client.submit(func, *args, priority=priority, pure=False, **kwargs)
+                self._submitted[future.key] = (tag, nbytes)
+                self.in_flight_bytes += nbytes
+                self._as_completed.add(future)
+
+    def results(self, adding=None):
+        """
+        Yield (tag, future) for every task as it finishes, until none are
+        left. Its memory is released once the loop body is done with it.
+
+        adding is the concurrent.futures.Future of a thread adding tasks. 
+        Until it's done results() waits for more tasks instead of stopping
+        when none are left, and any error it raises is raised here.
+        """
+        def check_adding():
+            if adding is not None and adding.done() and adding.exception() is not None:
+                raise adding.exception()
+
+        if adding is not None:
+            def notify(f):
+                with self._condition:
+                    self._condition.notify_all()
+            adding.add_done_callback(notify)
+
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._submitted or adding is None or adding.done())
+                check_adding()
+                self.submit_pending()
+                if not self._submitted:
+                    return
+                tasks_completed = self._as_completed
+
+            # This stops once everything submitted so far is done, then the 
+            # outer loop waits on any tasks still to be added.
+            for future in tasks_completed:
+                with self._condition:
+                    tag, nbytes = self._submitted.pop(future.key)
+                yield tag, future
+                with self._condition:
+                    self.in_flight_bytes -= nbytes
+                    self.submit_pending()
+                check_adding()
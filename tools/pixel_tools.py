@@ -0,0 +1,202 @@
+import netCDF4
+import numpy as np
+import xarray as xr
+import dask.array as da
+from xarray.backends.locks import HDF5_LOCK, NETCDFC_LOCK
+
+"""
+Storage of gridded outputs for only the cells inside a mask (eg. the
+ecoregion mask), instead of the full CONUS rectangle which is mostly NaN.
+
+The latitude/longitude dimensions are replaced by a single pixel dimension,
+so a (time, latitude, longitude) array is stored as (time, pixel). The
+latitude/longitude of every pixel, their index in the full grid, and the
+full grid coordinates are saved alongside so it can be put back on the grid.
+
+    pixel_tools.write_pixel_netcdf(fCover.to_dataset(name='fCover'), mask, filename)
+    fCover = pixel_tools.open_pixel_dataset(filename, chunks={'time':2000})
+    fCover_grid = pixel_tools.from_pixels(fCover)
+
+A file can also be written one tile of the grid at a time with PixelFileWriter,
+eg. as tiles are finished on a dask cluster.
+"""
+
+def to_pixels(obj, mask):
+    """
+    Select the cells of a gridded DataArray/Dataset where mask is True.
+
+    Parameters
+    ----------
+    obj : xr.DataArray or xr.Dataset
+        with latitude and longitude dimensions, on the same grid as mask
+    mask : xr.DataArray
+        boolean (latitude, longitude) array. It's matched to the obj grid
+        by the nearest coordinates, with cells not in it left out.
+
+    Returns
+    -------
+    obj with a pixel dimension in place of latitude/longitude
+    """
+    mask = mask.transpose('latitude','longitude')
+    mask = mask.reindex(latitude=obj.latitude, longitude=obj.longitude, method='nearest', tolerance=1e-4, fill_value=False)
+    latitude_index, longitude_index = np.nonzero(mask.values)
+
+    pixels = obj.isel(latitude  = xr.DataArray(latitude_index, dims='pixel'),
+                      longitude = xr.DataArray(longitude_index, dims='pixel'))
+
+    return pixels.assign_coords(latitude_index  = ('pixel', latitude_index.astype(np.int32)),
+                                longitude_index = ('pixel', longitude_index.astype(np.int32)),
+                                grid_latitude   = mask.latitude.values,
+                                grid_longitude  = mask.longitude.values)
+
+def _scatter_to_grid(values, flat_index, n_cells):
+    """ Put the pixel values, in the last axis, into a flat grid of NaN """
+    grid = np.full(values.shape[:-1] + (n_cells,), np.nan, dtype=np.result_type(values.dtype, np.float32))
+    grid[..., flat_index] = values
+    return grid
+
+def from_pixels(obj):
+    """
+    Put a pixel DataArray/Dataset, from to_pixels() or open_pixel_dataset(),
+    back on the full latitude/longitude grid with NaN for cells outside the
+    mask. This is lazy when obj is dask backed, with each block scattered
+    separately.
+    """
+    n_latitude = obj.grid_latitude.size
+    n_longitude = obj.grid_longitude.size
+    flat_index = obj.latitude_index.values * n_longitude + obj.longitude_index.values
+
+    pixel_coords = ['latitude','longitude','latitude_index','longitude_index']
+    obj = obj.drop_vars([c for c in pixel_coords if c in obj.coords])
+    if obj.chunks:
+        # The pixels need to be a single chunk to fill in the grid
+        obj = obj.chunk({'pixel':-1})
+
+    def scatter(da):
+        grid = xr.apply_ufunc(_scatter_to_grid, da,
+                              kwargs             = {'flat_index':flat_index, 'n_cells':n_latitude * n_longitude},
+                              input_core_dims    = [['pixel']],
+                              output_core_dims   = [['cell']],
+                              dask               = 'parallelized',
+                              output_dtypes      = [np.result_type(da.dtype, np.float32)],
+                              dask_gufunc_kwargs = {'output_sizes':{'cell':n_latitude * n_longitude}})
+        grid = grid.data.reshape(grid.shape[:-1] + (n_latitude, n_longitude))
+        dims = [d for d in da.dims if d != 'pixel'] + ['latitude','longitude']
+        coords = {k:v for k, v in da.coords.items() if 'pixel' not in v.dims and k not in ['grid_latitude','grid_longitude']}
+        coords['latitude'] = obj.grid_latitude.values
+        coords['longitude'] = obj.grid_longitude.values
+        
+        # latitude/longitude go where pixel was
+        pixel_axis = da.get_axis_num('pixel')
+        original_dims = list(da.dims[:pixel_axis]) + ['latitude','longitude'] + list(da.dims[pixel_axis + 1:])
+        return xr.DataArray(grid, dims=dims, coords=coords, name=da.name, attrs=da.attrs).transpose(*original_dims)
+
+    if isinstance(obj, xr.DataArray):
+        return scatter(obj)
+    return xr.Dataset({v:scatter(obj[v]) if 'pixel' in obj[v].dims else obj[v] for v in obj.data_vars},
+                      attrs=obj.attrs).drop_vars(['grid_latitude','grid_longitude'], errors='ignore')
+
+def write_pixel_netcdf(ds, mask, filename, encoding=None):
+    """ Write only the cells of ds inside mask to a netcdf file """
+    to_pixels(ds, mask).to_netcdf(filename, encoding=encoding)
+
+def open_pixel_dataset(filename, chunks=None):
+    """
+    Open a file from write_pixel_netcdf(), as pixels. Use from_pixels() on it,
+    or on anything reduced from it, to get back to the full grid.
+    """
+    return xr.open_dataset(filename, chunks=chunks)
+
+def tile_slices(n_latitude, n_longitude, tile_size):
+    """ (latitude slice, longitude slice) of every tile_size x tile_size tile of a grid """
+    return [(slice(lat_start, min(lat_start + tile_size, n_latitude)), slice(lon_start, min(lon_start + tile_size, n_longitude)))
+            for lat_start in range(0, n_latitude, tile_size) for lon_start in range(0, n_longitude, tile_size)]
+
+class PixelFileWriter:
+    def __init__(self, filename, template, mask, tiles, encoding=None):
+        """
+        Write a pixel file, the same format as write_pixel_netcdf(), one tile at 
+        a time so the full output never needs to be in memory. The file is 
+        made empty here, with the pixels ordered tile by tile, so every tile 
+        is written to a single block of pixels.
+
+        Parameters
+        ----------
+        filename : str
+            the netcdf file to make
+        template : xr.DataArray
+            with latitude/longitude dimensions and the name, dimensions, and
+            coordinates of the output. Only these are used so it can be lazy.
+        mask : xr.DataArray
+            boolean (latitude, longitude) array of cells to keep
+        tiles : list
+            (latitude slice, longitude slice) of each tile, from tile_slices()
+        encoding : dict or None
+            to_netcdf() encoding
+        """
+        self.filename = filename
+        self.name = template.name
+        
+        mask = mask.transpose('latitude','longitude')
+        mask = mask.reindex(latitude=template.latitude, longitude=template.longitude, method='nearest', tolerance=1e-4, fill_value=False)
+        
+        self.tile_pixels = []
+        latitude_index, longitude_index = [], []
+        n_pixels = 0
+        for latitude_slice, longitude_slice in tiles:
+            tile_latitude_index, tile_longitude_index = np.nonzero(mask.values[latitude_slice, longitude_slice])
+            self.tile_pixels.append((slice(n_pixels, n_pixels + len(tile_latitude_index)), tile_latitude_index, tile_longitude_index))
+            latitude_index.append(tile_latitude_index + latitude_slice.start)
+            longitude_index.append(tile_longitude_index + longitude_slice.start)
+            n_pixels += len(tile_latitude_index)
+        latitude_index = np.concatenate(latitude_index).astype(np.int32)
+        longitude_index = np.concatenate(longitude_index).astype(np.int32)
+        
+        # latitude/longitude are replaced by pixel, which goes where latitude was
+        self.dims = tuple(['pixel' if d == 'latitude' else d for d in template.dims if d != 'longitude'])
+        shape = tuple([n_pixels if d == 'pixel' else template.sizes[d] for d in self.dims])
+        coords = {k:v for k, v in template.coords.items() if 'latitude' not in v.dims and 'longitude' not in v.dims}
+        coords.update(latitude        = ('pixel', template.latitude.values[latitude_index]),
+                      longitude       = ('pixel', template.longitude.values[longitude_index]),
+                      latitude_index  = ('pixel', latitude_index),
+                      longitude_index = ('pixel', longitude_index),
+                      grid_latitude   = template.latitude.values,
+                      grid_longitude  = template.longitude.values)
+        
+        # netcdf chunks of about one tile, so writing a tile doesn't rewrite the whole file
+        largest_tile = max([1] + [len(p[1]) for p in self.tile_pixels])
+        encoding = {} if encoding is None else {k:dict(v) for k, v in encoding.items()}
+        var_encoding = encoding.setdefault(self.name, {})
+        var_encoding.setdefault('chunksizes', tuple([min(largest_tile, max(n_pixels, 1)) if d == 'pixel' else template.sizes[d] for d in self.dims]))
+        
+        # The data is never computed, this only lays out the file
+        empty = xr.Dataset({self.name:(self.dims, da.zeros(shape, dtype=template.dtype, chunks=shape))}, coords=coords)
+        empty.to_netcdf(filename, encoding=encoding, compute=False)
+    
+    def write_tile(self, tile_i, values):
+        """
+        Write the cells of one tile inside the mask.
+
+        Parameters
+        ----------
+        tile_i : int
+            the index of the tile in tiles
+        values : xr.DataArray
+            the output for the tile, with the same dimensions as the template
+        """
+        pixel_slice, tile_latitude_index, tile_longitude_index = self.tile_pixels[tile_i]
+        if len(tile_latitude_index) == 0:
+            return
+        
+        pixels = values.isel(latitude  = xr.DataArray(tile_latitude_index, dims='pixel'),
+                             longitude = xr.DataArray(tile_longitude_index, dims='pixel')).transpose(*self.dims)
+        pixel_location = tuple([pixel_slice if d == 'pixel' else slice(None) for d in self.dims])
+        pixel_values = pixels.values
+        # The same locks xarray uses, as the netcdf/hdf5 libraries are not 
+        # thread safe and other threads may be reading files with xarray.
+        with NETCDFC_LOCK, HDF5_LOCK, netCDF4.Dataset(self.filename, 'a') as nc:
+            nc[self.name][pixel_location] = pixel_values
+    
+    def n_tile_pixels(self, tile_i):
+        """ The number of cells in a tile inside the mask """
+        return len(self.tile_pixels[tile_i][1])
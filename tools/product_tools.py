@@ -0,0 +1,66 @@
+import dask
+import xarray as xr
+
+from tools import period_tools
+
+"""
+Everything made from the climate forcing (the phenograss output, annual climate
+summaries, etc.) as products of a single read. Each product is a function
+taking the dataset from xarray_tools.compile_cmip_model_data() and returning
+a lazy xarray object. compute_products() builds all of them on the same
+dataset and computes them together, so dask reads and derives every chunk of
+forcing once no matter how many products there are.
+
+Reductions used for every climate model/scenario are registered here with
+@register_product, and others (eg. one phenograss run per ecoregion model)
+are passed to compute_products() directly.
+
+    @register_product('annual_max_tmean')
+    def annual_max_tmean(ds):
+        return ds.tmean.groupby('time.year').max()
+"""
+
+registered_products = {}
+
+def register_product(name):
+    """ Decorator to add a function to registered_products """
+    def register(func):
+        registered_products[name] = func
+        return func
+    return register
+
+@register_product('annual_climate')
+def annual_climate(ds):
+    """
+    Annual mean of the daily mean temperature and annual total precip, with
+    the year as the time coordinate. The same as the annual values in
+    process_climate_data_for_website.py.
+    """
+    tmean = ((ds.tasmin + ds.tasmax)/2).rename('tmean')
+    return xr.merge([period_tools.reduce_periods(tmean, how='mean', freq='year'),
+                     period_tools.reduce_periods(ds.pr, how='sum', freq='year')])
+
+def compute_products(ds, products=None, include_registered=True):
+    """
+    Compute several products from a single pass over ds.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        the forcing data, usually lazy (dask backed)
+    products : dict or None
+        {name: function(ds)} products to make in addition to the registered ones
+    include_registered : bool
+        also make every product in registered_products
+
+    Returns
+    -------
+    dict of {name: computed product}
+    """
+    all_products = dict(registered_products) if include_registered else {}
+    if products is not None:
+        all_products.update(products)
+
+    lazy_products = {name:func(ds) for name, func in all_products.items()}
+    computed = dask.compute(*lazy_products.values())
+    return dict(zip(lazy_products.keys(), computed))
@@ -0,0 +1,149 @@
+import json
+import os
+
+import numpy as np
+import xarray as xr
+
+"""
+Scaled int16 storage for the forcing variables, the same idea as the
+scale_factor encoding of the phenograss output in apply_model_to_cmip.py.
+
+A value x is stored as round((x - add_offset) / scale_factor), so the most
+any value changes is half the scale_factor. With int16 (-32767 to 32767,
+-32768 is the fill value) the ranges and precision are:
+
+    variable        scale   max error       range
+    tasmin/tasmax   0.01    0.005 C         -327.67 to 327.67 C
+    tmean           0.01    0.005 C         -327.67 to 327.67 C
+    pr              0.02    0.01 mm/day     0 to 655.34 mm/day, 0 exact
+    et              0.001   0.0005 mm/day   -32.767 to 32.767 mm/day
+    radiation       0.002   0.001 MJ/m2     -65.534 to 65.534 MJ/m2
+
+The max error is plus float32 rounding (eg. 0.0050011 C). Precip under 0.01
+mm/day is stored as 0, which slightly increases the number of dry days.
+Anything outside the range is clipped to it. The scale_factor is float32,
+so the values are read back as float32 (xarray_tools.forcing_dtype) without
+another copy. See validate_forcing_quantization.py for the error this adds
+to the final fCover anomalies.
+
+The int16 files are copies in their own folder, the original downloads are
+kept as is. They are only made once that validation report exists
+(see is_validated()), so the validation can always be redone. The scripts
+reading the forcing get the folder to use from climate_data_folder().
+"""
+
+validation_report_file = 'data/run_reports/forcing_quantization_validation.json'
+
+# The original downloads from download_cmip5.py, and their int16 copies
+original_data_folder = 'data/cmip5_nc_files/'
+quantized_data_folder = 'data/cmip5_int16_nc_files/'
+
+
+forcing_quantization = {'tasmin'    : {'scale_factor':0.01,  'add_offset':0.},
+                        'tasmax'    : {'scale_factor':0.01,  'add_offset':0.},
+                        'tmean'     : {'scale_factor':0.01,  'add_offset':0.},
+                        'pr'        : {'scale_factor':0.02,  'add_offset':0.},
+                        'et'        : {'scale_factor':0.001, 'add_offset':0.},
+                        'radiation' : {'scale_factor':0.002, 'add_offset':0.}}
+
+int16_fill_value = -32768
+int16_max = 32767
+
+def max_abs_error(var):
+    """ The most a value of var changes when quantized, if it's inside the range """
+    return forcing_quantization[var]['scale_factor'] / 2
+
+def valid_range(var):
+    """ The (min, max) of var which can be stored """
+    spec = forcing_quantization[var]
+    return (-int16_max * spec['scale_factor'] + spec['add_offset'],
+            int16_max * spec['scale_factor'] + spec['add_offset'])
+
+def quantized_encoding(ds, complevel=4):
+    """ to_netcdf() encoding for every forcing variable in ds """
+    return {v:{'dtype'        : 'int16',
+               'scale_factor' : np.float32(forcing_quantization[v]['scale_factor']),
+               'add_offset'   : np.float32(forcing_quantization[v]['add_offset']),
+               '_FillValue'   : int16_fill_value,
+               'zlib'         : True,
+               'complevel'    : complevel} for v in ds.data_vars if v in forcing_quantization}
+
+def is_validated(report_file=validation_report_file):
+    """ 
+    True if validate_forcing_quantization.py has been run, and compared the
+    fCover anomalies for at least one climate model.
+    """
+    if not os.path.exists(report_file):
+        return False
+    with open(report_file) as f:
+        report = json.load(f)
+    climate_models = report.get('climate_models', {})
+    return len(climate_models) > 0 and all(['fCover_anomaly' in m for m in climate_models.values()])
+
+def climate_data_folder(original_folder=original_data_folder, quantized_folder=quantized_data_folder, pattern='.nc4'):
+    """
+    The folder to read the cmip forcing from. The int16 copies once they're
+    validated and there's a copy of every original file, otherwise the 
+    original float files.
+    """
+    if not is_validated() or not os.path.isdir(quantized_folder):
+        return original_folder
+    original_files = [f for f in os.listdir(original_folder) if f.endswith(pattern)]
+    if all([os.path.exists(os.path.join(quantized_folder, f)) for f in original_files]):
+        return quantized_folder
+    return original_folder
+
+def quantize(da, var=None):
+    """
+    The values of a DataArray as they would be read back from int16 storage,
+    as float32. var is the forcing_quantization entry to use, by default
+    the DataArray name.
+    """
+    spec = forcing_quantization[da.name if var is None else var]
+    scale_factor = np.float32(spec['scale_factor'])
+    add_offset = np.float32(spec['add_offset'])
+
+    stored = ((da - add_offset) / scale_factor).round().clip(-int16_max, int16_max)
+    return (stored.astype(np.float32) * scale_factor + add_offset).astype(np.float32)
+
+def is_quantized(filename):
+    """ True if all forcing variables in a netcdf file are already int16 """
+    with xr.open_dataset(filename) as ds:
+        forcing_vars = [v for v in ds.data_vars if v in forcing_quantization]
+        return len(forcing_vars) > 0 and all([ds[v].encoding.get('dtype') == np.dtype('int16') for v in forcing_vars])
+
+def quantize_file(filename, out_filename):
+    """
+    Write a copy of a netcdf file with its forcing variables as scaled int16.
+    The original is never changed, as the precision lost can't be recovered.
+    The copy is made via a temporary file, so a failure part way through 
+    doesn't leave a partial out_filename.
+    """
+    if os.path.abspath(filename) == os.path.abspath(out_filename):
+        raise ValueError('out_filename must be different from filename: {f}'.format(f=filename))
+    tmp_filename = out_filename + '.tmp'
+
+    with xr.open_dataset(filename) as ds:
+        ds.load()
+        encoding = quantized_encoding(ds)
+        # drop the original float encoding, eg. its missing_value and _FillValue
+        for v in encoding:
+            ds[v].encoding = {}
+        ds.to_netcdf(tmp_filename, encoding=encoding)
+
+    os.replace(tmp_filename, out_filename)
+
+def quantize_folder(folder, out_folder, pattern='.nc4'):
+    """ 
+    quantize_file() every file in folder into out_folder, with the same file 
+    names. Files already in out_folder are skipped.
+    """
+    os.makedirs(out_folder, exist_ok=True)
+    converted = []
+    for f in sorted(os.listdir(folder)):
+        filename = os.path.join(folder, f)
+        out_filename = os.path.join(out_folder, f)
+        if f.endswith(pattern) and not os.path.exists(out_filename):
+            quantize_file(filename, out_filename)
+            converted.append(out_filename)
+    return converted
@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xarray as xr
+import rasterio
+import rasterio.windows
+
+
+def grid_bounds(da):
+    """
+    The (min_lon, min_lat, max_lon, max_lat) bounding box of a DataArray
+    with latitude/longitude coordinates.
+    """
+    return (float(da.longitude.min()), float(da.latitude.min()),
+            float(da.longitude.max()), float(da.latitude.max()))
+
+def read_raster_window(filename, bounds, margin=1.0):
+    """
+    Read the first band of a raster, but only the part within a bounding box
+    plus a margin. So for a global raster only the North America window gets
+    read into memory.
+
+    Parameters
+    ----------
+    filename : str
+        any raster readable by rasterio/gdal
+    bounds : tuple
+        (min_lon, min_lat, max_lon, max_lat), in the raster CRS (lat/lon here)
+    margin : float
+        extra area to read on all sides, in degrees. This should cover the
+        nearest cells used in any regridding.
+
+    Returns
+    -------
+    xr.DataArray with dims (latitude, longitude) of the raster cell centers,
+    the same as xr.open_rasterio gives. nodata values are NaN.
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+
+    with rasterio.open(filename) as src:
+        window = rasterio.windows.from_bounds(min_lon - margin, min_lat - margin,
+                                              max_lon + margin, max_lat + margin,
+                                              transform = src.transform)
+
+        # Snap outward to whole cells and clip to the raster extent
+        col_start = max(int(np.floor(window.col_off)), 0)
+        row_start = max(int(np.floor(window.row_off)), 0)
+        col_end = min(int(np.ceil(window.col_off + window.width)), src.width)
+        row_end = min(int(np.ceil(window.row_off + window.height)), src.height)
+        window = rasterio.windows.Window(col_start, row_start, col_end - col_start, row_end - row_start)
+
+        values = src.read(1, window=window).astype(np.float32)
+        if src.nodata is not None:
+            values[values == src.nodata] = np.nan
+
+        transform = src.window_transform(window)
+
+    longitude = transform.c + (np.arange(window.width) + 0.5) * transform.a
+    latitude  = transform.f + (np.arange(window.height) + 0.5) * transform.e
+
+    return xr.DataArray(values,
+                        dims = ('latitude','longitude'),
+                        coords = {'latitude':latitude, 'longitude':longitude})
+
+def read_raster_stack(filenames, bounds, dim, margin=1.0, max_workers=4):
+    """
+    Read several rasters on the same grid with read_raster_window(), in
+    parallel threads, and stack them into a single (dim, latitude, longitude)
+    array.
+
+    Parameters
+    ----------
+    filenames : dict
+        {coordinate value : filename}, eg. {1:'prec_01.tif', 2:'prec_02.tif'}
+        for dim='month'
+    bounds : tuple
+        (min_lon, min_lat, max_lon, max_lat)
+    dim : str
+        name of the new stacked dimension
+    margin : float
+        see read_raster_window()
+    max_workers : int
+        number of files to read at once
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        rasters = list(executor.map(lambda f: read_raster_window(f, bounds, margin=margin), filenames.values()))
+
+    for r in rasters[1:]:
+        assert r.shape == rasters[0].shape and np.allclose(r.latitude, rasters[0].latitude) and np.allclose(r.longitude, rasters[0].longitude), 'rasters are not all on the same grid'
+
+    stacked = np.stack([r.values for r in rasters])
+    return xr.DataArray(stacked,
+                        dims = (dim, 'latitude', 'longitude'),
+                        coords = {dim         : list(filenames),
+                                  'latitude'  : rasters[0].latitude,
+                                  'longitude' : rasters[0].longitude})
@@ -0,0 +1,122 @@
+import hashlib
+import os
+
+import numpy as np
+import xarray as xr
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+
+class Regridder:
+    def __init__(self, source, target, k=2, cache_folder='data/regrid_weights/'):
+        """
+        Distance weighted regridding from one regular latitude/longitude grid
+        to another, using the k nearest source cells for every target cell.
+        This replaces xmap.XMap(...).remap_like(how='distance_weighted').
+
+        The weights are a sparse matrix of shape (n target cells, n source cells),
+        so regridding any number of rasters on the same source grid is a
+        single sparse matrix multiplication. They are saved in cache_folder,
+        keyed by a hash of both grids and k, so they only get calculated once.
+
+        This does not account for a different CRS, but actually changing the
+        CRS results in minute differences. Source grids can be global, only
+        the nearest cells to the target get any weight.
+
+        Parameters
+        ----------
+        source : xr.DataArray
+            with latitude and longitude coordinates of the source grid.
+        target : xr.DataArray
+            with latitude and longitude coordinates of the target grid.
+        k : int
+            number of nearest source cells to use.
+        cache_folder : str or None
+            folder to save/load the weights. None to not cache them.
+        """
+        self.source_lat = np.asarray(source.latitude.values, dtype=np.float64)
+        self.source_lon = np.asarray(source.longitude.values, dtype=np.float64)
+        self.target_lat = np.asarray(target.latitude.values, dtype=np.float64)
+        self.target_lon = np.asarray(target.longitude.values, dtype=np.float64)
+        self.k = k
+
+        self.grid_hash = self._grid_hash()
+
+        cache_file = None
+        if cache_folder is not None:
+            cache_file = os.path.join(cache_folder, 'regrid_weights_{h}.npz'.format(h=self.grid_hash))
+
+        if cache_file is not None and os.path.exists(cache_file):
+            self.weights = sparse.load_npz(cache_file)
+        else:
+            self.weights = self._build_weights()
+            if cache_file is not None:
+                os.makedirs(cache_folder, exist_ok=True)
+                sparse.save_npz(cache_file, self.weights)
+
+    def _grid_hash(self):
+        h = hashlib.sha1()
+        for a in [self.source_lat, self.source_lon, self.target_lat, self.target_lon]:
+            h.update(str(a.shape).encode())
+            h.update(a.tobytes())
+        h.update('distance_weighted_k{k}'.format(k=self.k).encode())
+        return h.hexdigest()[:16]
+
+    def _build_weights(self):
+        """
+        Inverse distance weights of the k nearest source cells, normalized to sum
+        to 1 for each target cell. Where a target cell sits exactly on a source
+        cell that one gets all the weight.
+        """
+        source_lon, source_lat = np.meshgrid(self.source_lon, self.source_lat)
+        target_lon, target_lat = np.meshgrid(self.target_lon, self.target_lat)
+
+        tree = cKDTree(np.column_stack([source_lon.ravel(), source_lat.ravel()]))
+        distance, source_i = tree.query(np.column_stack([target_lon.ravel(), target_lat.ravel()]), k=self.k)
+        distance = distance.reshape(-1, self.k)
+        source_i = source_i.reshape(-1, self.k)
+
+        with np.errstate(divide='ignore'):
+            w = 1 / distance
+        exact_match = np.isinf(w)
+        w[exact_match.any(axis=1)] = 0
+        w[exact_match] = 1
+        w = w / w.sum(axis=1, keepdims=True)
+
+        n_target = len(self.target_lat) * len(self.target_lon)
+        n_source = len(self.source_lat) * len(self.source_lon)
+        target_i = np.repeat(np.arange(n_target), self.k)
+        return sparse.csr_matrix((w.ravel(), (target_i, source_i.ravel())), shape=(n_target, n_source))
+
+    def regrid(self, da):
+        """
+        Regrid a DataArray on the source grid to the target grid. The last two
+        dimensions must be latitude, longitude, any others (eg. month, band)
+        are all done in the same matrix multiplication.
+
+        NaN source cells are left out, with the weights of the remaining
+        nearest cells scaled back up to 1. Target cells where all the nearest
+        source cells are NaN are NaN.
+        """
+        assert da.dims[-2:] == ('latitude','longitude'), 'last dimensions must be latitude, longitude'
+        assert np.array_equal(da.latitude.values, self.source_lat), 'latitude does not match the source grid'
+        assert np.array_equal(da.longitude.values, self.source_lon), 'longitude does not match the source grid'
+
+        other_dims = da.dims[:-2]
+        other_shape = da.shape[:-2]
+
+        # (n source cells, everything else)
+        values = np.asarray(da.values, dtype=np.float64).reshape(-1, len(self.source_lat) * len(self.source_lon)).T
+        is_valid = ~np.isnan(values)
+
+        regridded = self.weights @ np.where(is_valid, values, 0)
+        total_weight = self.weights @ is_valid.astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            regridded = np.where(total_weight > 0, regridded / total_weight, np.nan)
+
+        regridded = regridded.T.reshape(other_shape + (len(self.target_lat), len(self.target_lon)))
+
+        coords = {d:da[d] for d in other_dims if d in da.coords}
+        coords['latitude'] = self.target_lat
+        coords['longitude'] = self.target_lon
+        return xr.DataArray(regridded, dims=other_dims + ('latitude','longitude'), coords=coords, name=da.name)
@@ -0,0 +1,244 @@
+import argparse
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask.array as da
+
+from tools import cmip5_file_tools
+from tools.cmip_download_tool import cmip5_info
+
+"""
+Synthetic BCCA daily climate files for testing the pipeline at scale without
+downloading the real ones. The files have the same names, decade splits,
+grid, variables, units and fill values as the real files from
+gdo-dcp.ucllnl.org, so get_cmip5_files() and everything after it can use them.
+
+Values are a simple climate: temperature with a seasonal cycle which gets
+larger to the north, a warming trend which depends on the scenario, and
+precipitation on ~30% of days which is wetter to the east. Cells outside a
+rough continent outline are NaN, like the ocean in the real files.
+
+The data is generated lazily one year at a time while writing, so the full
+0.125 degree CONUS grid can be made without much memory. Every model,
+scenario and year gets its own random seed, so files are reproducible.
+
+Writing a full set of files, eg. into a scratch copy of the repo:
+
+    python -m tools.synthetic_cmip_tools --output-folder data/cmip5_nc_files/ --ancillary-folder data/
+
+or a smaller/faster set:
+
+    python -m tools.synthetic_cmip_tools --models ccsm4 --scenarios rcp26 rcp85 --end-year 2035 --resolution 0.5
+"""
+
+# The real BCCA CONUS grid, cell centers with longitude 0-360.
+conus_grid = dict(lat_min    = 25.1875,
+                  lat_max    = 52.8125,
+                  lon_min    = 235.3125,
+                  lon_max    = 292.9375,
+                  resolution = 0.125)
+
+# The historic files are split by these periods, the scenario ones use
+# cmip5_info['available_decades'] from cmip_download_tool.py
+historic_decades = {'1980' : ['19800101','19891231'],
+                    '1990' : ['19900101','19991231'],
+                    '2000' : ['20000101','20051231']}
+
+# degrees C per year of warming after 2005
+scenario_warming = {'historical' : 0.0,
+                    'rcp26'      : 0.008,
+                    'rcp45'      : 0.02,
+                    'rcp60'      : 0.025,
+                    'rcp85'      : 0.045}
+
+variable_attrs = {'pr'     : {'standard_name':'precipitation_flux', 'long_name':'Precipitation', 'units':'mm/d'},
+                  'tasmax' : {'standard_name':'air_temperature', 'long_name':'Daily Maximum Near-Surface Air Temperature', 'units':'C'},
+                  'tasmin' : {'standard_name':'air_temperature', 'long_name':'Daily Minimum Near-Surface Air Temperature', 'units':'C'}}
+
+fill_value = np.float32(1e20)
+
+def make_grid(lat_min, lat_max, lon_min, lon_max, resolution):
+    latitude  = np.arange(lat_min, lat_max + resolution/2, resolution, dtype=np.float32)
+    longitude = np.arange(lon_min, lon_max + resolution/2, resolution, dtype=np.float32)
+    return latitude, longitude
+
+def land_mask(latitude, longitude):
+    """
+    A rough continent with a wavy coastline, True for land. latitude/longitude
+    are 1d and the result is 2d (lat, lon). Relative to the grid, so any
+    grid size has some ocean along the edges.
+    """
+    y = (latitude - latitude.min()) / max(np.ptp(latitude), 1e-6)
+    x = (longitude - longitude.min()) / max(np.ptp(longitude), 1e-6)
+    x, y = np.meshgrid(x, y)
+    coast_wobble = 0.06 * np.sin(9 * x) + 0.04 * np.cos(13 * y)
+    return ((x - 0.5)/0.5)**2 + ((y - 0.6)/0.62)**2 < 1 + coast_wobble
+
+def build_filename(climate_model_file_str, scenario, variable, run, date_range):
+    """ The same as the real files, see CMIP_FTP_TOOL.build_cmip5_url() """
+    file_prefix = 'BCCAv2_0' if variable == 'pr' else 'BCCA_0'
+    return '{p}.125deg_{v}_day_{m}_{s}_{r}_{d1}-{d2}.nc4'.format(p = file_prefix,
+                                                                v = variable,
+                                                                m = climate_model_file_str,
+                                                                s = scenario,
+                                                                r = run,
+                                                                d1 = date_range[0],
+                                                                d2 = date_range[1])
+
+def _seed(*parts):
+    return zlib.crc32('_'.join([str(p) for p in parts]).encode())
+
+def _daily_values(variable, time, latitude, longitude, scenario, seed):
+    """
+    Values for a block of days (time is a DatetimeIndex) over the full grid,
+    as float32 (time, lat, lon).
+    """
+    rng = np.random.default_rng(seed)
+    doy = time.dayofyear.values[:, None, None]
+    years_warming = np.clip(time.year.values + doy[:,0,0]/365 - 2005, 0, None)[:, None, None]
+    lat = latitude[None, :, None]
+    lon = longitude[None, None, :]
+    shape = (len(time), len(latitude), len(longitude))
+
+    if variable == 'pr':
+        # wetter to the east, and in the summer
+        east = (lon - longitude.min()) / max(np.ptp(longitude), 1e-6)
+        mean_wet_day = 4 + 6 * east + 2 * np.sin(2 * np.pi * (doy - 80) / 365)
+        is_wet = rng.random(shape, dtype=np.float32) < 0.3
+        values = is_wet * rng.gamma(shape=0.8, scale=1, size=shape).astype(np.float32) * mean_wet_day
+    else:
+        # warmer to the south, with a larger seasonal cycle to the north
+        annual_mean = 28 - 0.75 * (lat - 25)
+        seasonal_amplitude = 6 + 0.35 * (lat - 25)
+        tmean = annual_mean - seasonal_amplitude * np.cos(2 * np.pi * (doy - 15) / 365)
+        tmean = tmean + scenario_warming[scenario] * years_warming
+        tmean = tmean + rng.normal(0, 3, size=shape).astype(np.float32)
+        half_range = 6 + np.sin(2 * np.pi * (doy - 100) / 365)
+        values = tmean + half_range if variable == 'tasmax' else tmean - half_range
+
+    return np.broadcast_to(values, shape).astype(np.float32)
+
+def synthetic_variable(variable, climate_model, scenario, date_range, latitude, longitude, mask):
+    """
+    A lazy DataArray for one file, with one dask chunk per year.
+    """
+    time = pd.date_range(date_range[0], date_range[1], freq='D') + pd.Timedelta(hours=12)
+    years = time.year.values
+    _, year_starts = np.unique(years, return_index=True)
+    year_lengths = np.diff(np.append(year_starts, len(time)))
+
+    # tasmin and tasmax share the same daily weather, so tasmax is always the larger
+    seed_variable = 'pr' if variable == 'pr' else 'temperature'
+
+    def make_block(block, block_info=None):
+        time_start = block_info[None]['array-location'][0][0]
+        block_time = time[time_start:time_start + block.shape[0]]
+        values = _daily_values(variable, block_time, latitude, longitude, scenario,
+                               seed = _seed(climate_model, scenario, seed_variable, block_time.year[0]))
+        return np.where(mask, values, np.nan).astype(np.float32)
+
+    empty = da.empty((len(time), len(latitude), len(longitude)),
+                     chunks = (tuple(year_lengths), -1, -1), dtype=np.float32)
+    values = empty.map_blocks(make_block, dtype=np.float32)
+
+    return xr.DataArray(values,
+                        dims = ('time','latitude','longitude'),
+                        coords = {'time':time, 'latitude':latitude, 'longitude':longitude},
+                        name = variable,
+                        attrs = variable_attrs[variable])
+
+def write_model_files(climate_model, climate_model_file_str, scenario, output_folder,
+                      latitude, longitude, mask, start_year=1980, end_year=2100,
+                      variables=('pr','tasmax','tasmin'), run='r1i1p1', complevel=4,
+                      overwrite=False):
+    """
+    Write all the decade files for a model/scenario which overlap start_year-end_year.
+    scenario='historical' gives the pre-2006 files. Returns the filenames.
+    """
+    decades = historic_decades if scenario == 'historical' else cmip5_info['available_decades']
+    written = []
+    for decade, date_range in decades.items():
+        if int(date_range[1][:4]) < start_year or int(date_range[0][:4]) > end_year:
+            continue
+        for variable in variables:
+            filename = os.path.join(output_folder, build_filename(climate_model_file_str, scenario, variable, run, date_range))
+            if os.path.exists(filename) and not overwrite:
+                continue
+            da_var = synthetic_variable(variable, climate_model, scenario, date_range, latitude, longitude, mask)
+            encoding = {variable : {'zlib'       : complevel > 0,
+                                    'complevel'  : complevel,
+                                    'dtype'      : 'float32',
+                                    '_FillValue' : fill_value,
+                                    'chunksizes' : (min(365, da_var.shape[0]), min(100, len(latitude)), min(100, len(longitude)))},
+                        'time'   : {'units':'days since 1950-01-01', 'calendar':'standard', 'dtype':'float64'}}
+            da_var.to_dataset().to_netcdf(filename, encoding=encoding)
+            written.append(filename)
+    return written
+
+def write_ancillary_files(output_folder, latitude, longitude, mask):
+    """
+    Synthetic versions of other_variables.nc (Wcap, Wp, MAP) and the
+    ecoregion label mask, on the same grid with longitude -180 - 180.
+    The ecoregions are west to east bands of the land cells.
+    """
+    coords = {'latitude':latitude, 'longitude':longitude - 360}
+    lon_fraction = np.broadcast_to((longitude - longitude.min()) / max(np.ptp(longitude), 1e-6), mask.shape)
+
+    other_variables = xr.Dataset({'Wcap' : (('latitude','longitude'), np.where(mask, 200 + 100*lon_fraction, np.nan)),
+                                  'Wp'   : (('latitude','longitude'), np.where(mask, 80 + 60*lon_fraction, np.nan)),
+                                  'MAP'  : (('latitude','longitude'), np.where(mask, 300 + 1000*lon_fraction, np.nan))},
+                                 coords = coords)
+    other_variables.to_netcdf(os.path.join(output_folder, 'other_variables.nc'))
+
+    shortnames = ['NWForests','GrPlains','ETempForests']
+    label = np.where(mask, 2 ** np.digitize(lon_fraction, [0.3, 0.6]), 0).astype(np.int8)
+    mask_nc = xr.Dataset({'ecoregion_label' : (('latitude','longitude'), label)}, coords = coords)
+    mask_nc.ecoregion_label.attrs = {'flag_masks'    : 2 ** np.arange(len(shortnames), dtype=np.int8),
+                                     'flag_meanings' : ' '.join(shortnames)}
+    mask_nc.attrs = {'notes':'synthetic ecoregion mask from synthetic_cmip_tools.py'}
+    mask_nc.to_netcdf(os.path.join(output_folder, 'ecoregion_mask.nc'))
+
+if __name__ == '__main__':
+    all_models = sorted(set([s['climate_model_name'] for s in cmip5_file_tools.get_cmip5_spec()]))
+    parser = argparse.ArgumentParser(description='Write synthetic BCCA daily climate files')
+    parser.add_argument('--output-folder', default='data/synthetic/cmip5_nc_files/')
+    parser.add_argument('--ancillary-folder', default=None,
+                        help='also write synthetic other_variables.nc and ecoregion_mask.nc here')
+    parser.add_argument('--models', nargs='+', default=all_models, choices=all_models)
+    parser.add_argument('--scenarios', nargs='+', default=['rcp26','rcp45','rcp60','rcp85'])
+    parser.add_argument('--start-year', type=int, default=1980)
+    parser.add_argument('--end-year', type=int, default=2100)
+    parser.add_argument('--resolution', type=float, default=conus_grid['resolution'],
+                        help='grid resolution in degrees, over the CONUS extent')
+    parser.add_argument('--lat-range', type=float, nargs=2, default=[conus_grid['lat_min'], conus_grid['lat_max']])
+    parser.add_argument('--lon-range', type=float, nargs=2, default=[conus_grid['lon_min'], conus_grid['lon_max']],
+                        help='longitude range, 0-360')
+    parser.add_argument('--complevel', type=int, default=4, help='zlib compression level, 0 for none')
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    latitude, longitude = make_grid(args.lat_range[0], args.lat_range[1], args.lon_range[0], args.lon_range[1], args.resolution)
+    mask = land_mask(latitude, longitude)
+    os.makedirs(args.output_folder, exist_ok=True)
+    print('grid: {a} x {o} cells, {p:.0%} land'.format(a=len(latitude), o=len(longitude), p=mask.mean()))
+
+    model_specs = cmip5_file_tools.get_cmip5_spec(models=args.models, scenarios=args.scenarios)
+    file_strs = {s['climate_model_name']:s['model_file_search_str'].lstrip('*') for s in model_specs}
+
+    for climate_model, file_str in file_strs.items():
+        model_scenarios = ['historical'] + [s['scenario'] for s in model_specs if s['climate_model_name'] == climate_model]
+        for scenario in model_scenarios:
+            written = write_model_files(climate_model, file_str, scenario, args.output_folder,
+                                        latitude, longitude, mask,
+                                        start_year = args.start_year,
+                                        end_year   = args.end_year,
+                                        complevel  = args.complevel,
+                                        overwrite  = args.overwrite)
+            print('{m} {s}: {n} files'.format(m=climate_model, s=scenario, n=len(written)))
+
+    if args.ancillary_folder:
+        os.makedirs(args.ancillary_folder, exist_ok=True)
+        write_ancillary_files(args.ancillary_folder, latitude, longitude, mask)
@@ -4,10 +4,23 @@ import pandas as pd
 import xarray as xr
 import bottleneck as bn
 import glob
+import json
 import os
 
 import dask.array as da
 
+from tools.instrument_tools import instrumented
+
+
+# All forcing data, derived variables (tmean, et, radiation), and the phenograss
+# output are kept as float32. Everything is cast once when it's read in,
+# so model_wrapper doesn't copy every chunk and half as many bytes get 
+# sent around to dask workers.
+forcing_dtype = np.float32
+
+def as_forcing_dtype(obj):
+    """ Cast an xarray Dataset/DataArray to forcing_dtype. No copy if it already is. """
+    return obj.astype(forcing_dtype, copy=False)
 
 # testing variables
 # climate_model_files = glob.glob('data/cmip5_nc_files/*nc4')
@@ -17,6 +30,7 @@ import dask.array as da
 # chunk_sizes = {'latitude':4,'longitude':4,'time':-1}
 # other_var_ds = xr.open_dataset('data/other_variables.nc')
 
+@instrumented
 def compile_cmip_data(climate_model_name,
                       scenario,
                       climate_model_files,
@@ -44,6 +58,7 @@ def compile_cmip_data(climate_model_name,
 
     """
     all_vars = xr.open_mfdataset(climate_model_files, combine='by_coords', chunks=chunk_sizes)
+    all_vars = as_forcing_dtype(all_vars)
     
     # Switch from longitude of 0-360 (default in cmip) to -180 - 180
     all_vars['longitude'] = all_vars.longitude - 360
@@ -56,11 +71,13 @@ def compile_cmip_data(climate_model_name,
     
     return all_vars
 
+@instrumented
 def compile_cmip_model_data(climate_model_name,
                             scenario,
                             climate_model_files,
                             other_var_ds,
-                            chunk_sizes):
+                            chunk_sizes,
+                            historic_ds=None):
     """
     Put together a single xarray dataset for a specified cmip model/scenario.
     Will include all derived variables (ie. ET, tmean, daylength) for PhenoGraass model.
@@ -80,6 +97,11 @@ def compile_cmip_model_data(climate_model_name,
         the other_variables.nc dataset object for soil/map variables
     chunk_sizes : dict
         chunk sizes passed to all xarray functions.
+    historic_ds : xr.Dataset or None
+        when climate_model_files are only the forecast (2006-2100) files, 
+        the compile_cmip_model_data() output for the historic files of the 
+        same climate model. The last days of it are used for the first days 
+        of the smoothed tmean, so they match a run with all the files.
 
     Returns
     -------
@@ -87,6 +109,7 @@ def compile_cmip_model_data(climate_model_name,
 
     """
     climate = xr.open_mfdataset(climate_model_files, combine='by_coords', chunks=chunk_sizes)
+    climate = as_forcing_dtype(climate)
     
     # Switch from longitude of 0-360 (default in cmip) to -180 - 180
     climate['longitude'] = climate.longitude - 360
@@ -100,7 +123,7 @@ def compile_cmip_model_data(climate_model_name,
     et = et.chunk(chunk_sizes)
 
     # The other_var ds needs all chunks except time
-    other_var_ds = other_var_ds.chunk({k:chunk_sizes[k] for k in ['latitude','longitude']}) 
+    other_var_ds = as_forcing_dtype(other_var_ds).chunk({k:chunk_sizes[k] for k in ['latitude','longitude']}) 
     
     all_vars = xr.merge([climate, radiation, et, other_var_ds])
     all_vars = all_vars.chunk(chunk_sizes)
@@ -110,7 +133,9 @@ def compile_cmip_model_data(climate_model_name,
     # TODO: setup test to make sure apply_ufunc rolling mean function matches
     # the xarray rolling mean function. Not neccesarrily to a high precicion though.
     #all_vars['tmean'] = ((all_vars.tasmin + all_vars.tasmax) / 2).rolling(time=15, center=False).mean().chunk(chunk_sizes)
-    all_vars['tmean'] = rolling_tmean(ds = all_vars, window_size = 15)
+    if historic_ds is not None:
+        historic_ds = historic_ds[['tasmin','tasmax']].isel(model=0, scenario=0, drop=True)
+    all_vars['tmean'] = rolling_tmean(ds = all_vars, window_size = 15, prior_ds = historic_ds)
     
     
     all_vars = all_vars.expand_dims({'model':[climate_model_name]})
@@ -120,26 +145,84 @@ def compile_cmip_model_data(climate_model_name,
     return all_vars
 
 
-def rolling_tmean(ds, window_size=15):
+def _move_mean_kernel(values, window_size, axis):
+    """
+    The mean of the window_size values up to and including each entry along
+    axis, NaN for the first window_size-1 entries or if any value in the
+    window is NaN. The same as bn.move_mean(values, window_size, axis).
+    
+    Every window is summed on its own, in float64 and always in the same order,
+    so the result for a day does not depend on where the array starts. bn.move_mean
+    keeps a running sum, so it does. This is what makes the result identical
+    whatever the time chunks are.
+    """
+    n = values.shape[axis]
+    out_shape = list(values.shape)
+    out_shape[axis] = max(n - window_size + 1, 0)
+    
+    def window_slice(offset):
+        s = [slice(None)] * values.ndim
+        s[axis] = slice(offset, offset + out_shape[axis])
+        return tuple(s)
+    
+    window_sum = np.zeros(out_shape, dtype=np.float64)
+    if out_shape[axis] > 0:
+        for offset in range(window_size):
+            window_sum += values[window_slice(offset)]
+    
+    means = (window_sum / window_size).astype(forcing_dtype)
+    
+    padding = [(0,0)] * values.ndim
+    padding[axis] = (min(window_size - 1, n), 0)
+    return np.pad(means, padding, constant_values=np.nan)
+
+@instrumented
+def rolling_tmean(ds, window_size=15, prior_ds=None):
     """ 
     xarray has a moving window average method but it does not do lazy computations,
-    so here is a custom one using bottleneck.move_mean
+    so here is a custom one. The mean uses the window_size days up to and 
+    including each day.
+    
+    With dask this uses map_overlap, where every time chunk gets the prior 
+    window_size-1 days from the chunk before it. So time does not need to be a 
+    single chunk, and the results are identical for any time chunking.
+    
+    prior_ds, with tasmin/tasmax for the days just before ds, fills in the
+    first window_size-1 days which are otherwise NaN.
     """
-    def move_mean_wrapper(tasmin, tasmax):
-        return bn.move_mean(( (tasmin + tasmax) / 2), window=window_size, axis=-1)
-    
-    return xr.apply_ufunc(move_mean_wrapper,
-                          ds.tasmin,
-                          ds.tasmax,
-                          input_core_dims = [['time'],['time']],
-                          output_core_dims=[['time']],
-                          output_dtypes=[np.float32],
-                          dask = 'parallelized',
-                          )
+    tmean = as_forcing_dtype((ds.tasmin + ds.tasmax) / 2)
+    
+    n_prior_days = 0
+    if prior_ds is not None:
+        prior_tmean = as_forcing_dtype((prior_ds.tasmin + prior_ds.tasmax) / 2)
+        prior_tmean = prior_tmean.isel(time=slice(-(window_size - 1), None)).transpose(*tmean.dims)
+        n_prior_days = len(prior_tmean.time)
+        if tmean.chunks is not None:
+            # The prior days go in the first time chunk
+            time_chunks = list(tmean.chunks[tmean.get_axis_num('time')])
+            time_chunks[0] += n_prior_days
+            tmean = xr.concat([prior_tmean, tmean], dim='time').chunk({'time':tuple(time_chunks)})
+        else:
+            tmean = xr.concat([prior_tmean.load(), tmean], dim='time')
+    
+    time_axis = tmean.get_axis_num('time')
+    
+    if tmean.chunks is None:
+        rolling_mean = _move_mean_kernel(tmean.values, window_size=window_size, axis=time_axis)
+    else:
+        rolling_mean = tmean.data.map_overlap(_move_mean_kernel,
+                                              depth    = {time_axis:(window_size - 1, 0)},
+                                              boundary = 'none',
+                                              dtype    = forcing_dtype,
+                                              window_size = window_size,
+                                              axis        = time_axis)
+    
+    return tmean.copy(data=rolling_mean).isel(time=slice(n_prior_days, None))
 
 def tile_array_to_shape():
     pass
 
+@instrumented
 def create_et_data_array(tmin, tmax, radiation):
     """
     Calculate evapotranspiration and return a dataarray of the same shape
@@ -148,10 +231,12 @@ def create_et_data_array(tmin, tmax, radiation):
     Hargreaves function has the form:
     et_utils.hargreaves(tmin, tmax, et_rad)
     """
-    return xr.apply_ufunc(et_utils.hargreaves,
-                          tmin, tmax, radiation,
-                          dask='allowed').rename('et')
+    et = xr.apply_ufunc(et_utils.hargreaves,
+                        tmin, tmax, radiation,
+                        dask='allowed')
+    return as_forcing_dtype(et).rename('et')
     
+@instrumented
 def create_radiation_data_array(ref):
     """Return an xarray datarray containing
     
@@ -167,7 +252,8 @@ def create_radiation_data_array(ref):
     # latitude and doy info. Making a 0 filled data array, referenced
     # to the ref dataset, and broadcast the latitude and doy values across it.
     lat_array = xr.zeros_like(ref.pr) + ref.latitude
-    doy_array = xr.zeros_like(ref.pr) + ref['time.dayofyear']
+    # doy as float32 so nothing gets promoted to float64 here
+    doy_array = xr.zeros_like(ref.pr) + ref['time.dayofyear'].astype(forcing_dtype)
     
     latitude_radians = xr.apply_ufunc(et_utils.deg2rad,
                                       lat_array,
@@ -193,7 +279,7 @@ def create_radiation_data_array(ref):
                                ird,
                                dask='allowed')
 
-    return radiation.rename('radiation')
+    return as_forcing_dtype(radiation).rename('radiation')
 
 def create_radiation_array_dask(ref):
     return xr.apply_ufunc(create_radiation_data_array,
@@ -202,13 +288,108 @@ def create_radiation_array_dask(ref):
 
 
 
-def apply_phenograss_dask_wrapper(model, ds):
+# GrasslandModels predictor names and the dataset variables for them
+phenograss_timeseries_vars = {'precip':'pr', 'evap':'et', 'Ra':'radiation', 'Tm':'tmean'}
+phenograss_static_vars     = {'Wcap':'Wcap', 'Wp':'Wp', 'MAP':'MAP'}
+
+# The PhenoGrass state carried between time segments. The keys are the state 
+# variables in the model output from return_variables='all', and the values the 
+# keyword used to set their initial value in the next segment.
+phenograss_state_vars = {'W':'W_initial', 'V':'V_initial'}
+
+def phenograss_warmup_days(model):
+    """
+    PhenoGrass also depends on the days before each one, through the L day 
+    soil water lag and the h day precip window, which are not part of the 
+    W/V state. These start over in every model run. So a run started from a 
+    carried over state re-runs the max(L, h) + 1 days before it as a warm-up,
+    starting from the state the day before those, and the warm-up output is 
+    dropped.
+    """
+    params = model.get_params()
+    return int(np.ceil(max(params['L'], params['h']))) + 1
+
+def check_phenograss_state_api(model, n_days=60):
+    """
+    Check the installed GrasslandModels takes the phenograss_state_vars initial
+    values as predictors, returns the state variables with return_variables='all',
+    and actually starts from the initial values given. Everything carrying the
+    state between runs depends on this, and an unknown predictor could otherwise
+    be silently ignored. Runs the model on n_days of constant forcing at a single
+    cell from two different initial states, and raises a RuntimeError if any of
+    that does not hold.
+
+    Returns
+    -------
+        dict of {state variable: its first day value from each initial state}
+    """
+    static = {'Wcap':np.array([250.]), 'Wp':np.array([50.]), 'MAP':np.array([500.])}
+    forcing = {'precip':2., 'evap':3., 'Ra':20., 'Tm':20.}
+    predictors = {name:np.full((n_days, 1), value) for name, value in forcing.items()}
+    predictors.update(static)
+
+    low_state  = {'W_initial':np.array([60.]),  'V_initial':np.array([0.01])}
+    high_state = {'W_initial':np.array([240.]), 'V_initial':np.array([0.5])}
+
+    outputs = []
+    for initial_state in [low_state, high_state]:
+        try:
+            model_output = model.predict(predictors=dict(predictors, **initial_state), return_variables='all')
+        except TypeError as e:
+            raise RuntimeError('GrasslandModels does not take the {k} predictors: {e}'.format(k=list(initial_state), e=e))
+        missing = [v for v in phenograss_state_vars if v not in model_output]
+        if missing:
+            raise RuntimeError('GrasslandModels does not return the {v} state with return_variables="all"'.format(v=missing))
+        outputs.append(model_output)
+
+    first_day = {}
+    for var in phenograss_state_vars:
+        low, high = [float(np.asarray(o[var])[0].ravel()[0]) for o in outputs]
+        if np.asarray(outputs[0][var]).shape[0] != n_days:
+            raise RuntimeError('GrasslandModels {v} output is not time first'.format(v=var))
+        if not low < high:
+            raise RuntimeError('GrasslandModels ignores {k}, {v} starts at {l} and {h} from different initial values'.format(k=phenograss_state_vars[var], v=var, l=low, h=high))
+        first_day[var] = [low, high]
+    return first_day
+
+# Written by validate_segmented_phenograss.py
+segmented_validation_report_file = 'data/run_reports/segmented_phenograss_validation.json'
+
+def is_segmented_run_validated(report_file=segmented_validation_report_file):
+    """ 
+    True if validate_segmented_phenograss.py found segmented and handed off
+    runs match a full run, for the real phenograss models, with the state
+    predictors checked by check_phenograss_state_api().
+    """
+    if not os.path.exists(report_file):
+        return False
+    with open(report_file) as f:
+        report = json.load(f)
+    return report.get('passed', False) and report.get('state_api_checked', False)
+
+def _phenograss_layout(ds):
+    """ time first DataArrays of the timeseries and static phenograss variables """
+    spatial_dims = [d for d in ds.pr.dims if d != 'time']
+    template = ds.pr.isel(time=0, drop=True)
+    timeseries = [as_forcing_dtype(ds[v]).transpose('time', *spatial_dims) for v in phenograss_timeseries_vars.values()]
+    static     = [as_forcing_dtype(ds[v]).broadcast_like(template).transpose(*spatial_dims) for v in phenograss_static_vars.values()]
+    return timeseries, static
+
+@instrumented
+def apply_phenograss_dask_wrapper(model, ds, initial_state=None, return_state=False, warmup_days=0):
     """
     Apply the phenograss model (from GrasslandModels package)
     to an xarray dataset.
-    Specifically this wraps the function around apply_ufunc,
+    Specifically this maps the model over the dask blocks of the dataset, 
     which allows the process to be parsed out on an HPC via
-    dask and dask.distributed.
+    dask and dask.distributed. A dataset already loaded into memory is
+    done in a single model run.
+    
+    GrasslandModels needs time as the first axis. So everything is laid out 
+    time first, with time as a single chunk, and every block is handed to 
+    the model as a C-contiguous array as is. There are no moveaxis/transpose 
+    copies of the inputs or output. When ds comes from compile_cmip_model_data() 
+    it is already in this layout.
 
     Parameters
     ----------
@@ -216,45 +397,232 @@ def apply_phenograss_dask_wrapper(model, ds):
         A GrasslandModel.models.PhenoGrass model type.
     ds : 
         Xarray dataset with all required phenograss 
+    initial_state : xr.Dataset or None
+        the model state to start from, as returned with return_state=True 
+        from a run over the preceding days. eg. the historic 1980-2005 
+        run for a 2006-2100 scenario. Its scenario coordinate is replaced 
+        with the one in ds, so one historic state can start every scenario. 
+        None to use the model defaults.
+    return_state : bool
+        also return the model state warmup_days + 1 days before the end of 
+        the run, to start a following run from
+    warmup_days : int
+        the warm-up overlap between runs handing off the state, see 
+        phenograss_warmup_days(). With initial_state, the first warmup_days 
+        of ds are the last days of the previous run, and are dropped from 
+        the output. 0 for the state on the last day and no overlap.
 
     Returns
     -------
-        xarray DataArray of phenograss output. All input coordinates will be
-        returned (eg. scenario, model)
+        xarray DataArray of phenograss output, with time as the first dimension.
+        All input coordinates will be returned (eg. scenario, model)
+        If return_state is True then a tuple of (output, state), where state 
+        is a Dataset of the phenograss_state_vars on the same spatial grid.
 
     """
     #TODO: make sure to return fCover here as by default it returns GCC
     
-    def model_wrapper(precip, evap, Ra, Tm, Wcap, Wp, MAP):
-        # ufunc will move the core axis, time, to the end ,but GrasslandModels
-        # needs it at the begining.
-        precip = np.moveaxis(precip, -1, 0)
-        evap = np.moveaxis(evap, -1, 0)
-        Ra = np.moveaxis(Ra, -1, 0)
-        Tm = np.moveaxis(Tm, -1, 0)
-        model_output = model.predict(predictors={'precip': precip.astype('float32'),
-                                                 'evap'  : evap.astype('float32'),
-                                                 'Ra'    : Ra.astype('float32'),
-                                                 'Tm'    : Tm.astype('float32'),
-                                                 'Wcap'  : Wcap.astype('float32'),
-                                                 'Wp'    : Wp.astype('float32'),
-                                                 'MAP'   : MAP.astype('float32')},
-                                     return_variables='all')
-        return np.moveaxis(model_output['fCover'], 0,-1)        
-    
-    return xr.apply_ufunc(model_wrapper,
-                          ds.pr,
-                          ds.et,
-                          ds.radiation,
-                          ds.tmean,
-                          ds.Wcap,
-                          ds.Wp,
-                          ds.MAP,
-                          input_core_dims = [['time'],['time'],['time'],['time'],[],[],[]],
-                          output_core_dims=[['time']],
-                          dask = 'parallelized',
-                          output_dtypes=[float]
-                          )
+    # These are views, unless ds is not already time first
+    timeseries, static = _phenograss_layout(ds)
+    
+    predictor_names = list(phenograss_timeseries_vars) + list(phenograss_static_vars)
+    
+    # The initial state goes in with the static variables, as the 
+    # W_initial/V_initial predictors
+    if initial_state is not None:
+        if 'scenario' in initial_state.dims:
+            initial_state = initial_state.assign_coords(scenario = ds.scenario)
+        template = ds.pr.isel(time=0, drop=True)
+        static = static + [as_forcing_dtype(initial_state[v]).broadcast_like(template).transpose(*template.dims) for v in phenograss_state_vars.values()]
+        predictor_names = predictor_names + list(phenograss_state_vars.values())
+    
+    n_days = len(timeseries[0].time)
+    n_state_vars = len(phenograss_state_vars) if return_state else 0
+    
+    def model_block(*arrays):
+        # np.ascontiguousarray does nothing when the blocks are already C-contiguous, 
+        # which they are for the time first layout.
+        predictors = {name:np.ascontiguousarray(a) for name, a in zip(predictor_names, arrays)}
+        model_output = model.predict(predictors=predictors, return_variables='all')
+        fCover = model_output['fCover'].astype(forcing_dtype, copy=False)
+        if return_state:
+            # The state day of each state variable goes after the last day of
+            # fCover, so both come from a single model run.
+            state_day = n_days - 1 - warmup_days
+            return np.concatenate([fCover] + [model_output[v][state_day:state_day + 1].astype(forcing_dtype) for v in phenograss_state_vars], axis=0)
+        return fCover
+    
+    if any([v.chunks is not None for v in timeseries + static]):
+        # All blocks need the same spatial chunks, with time as a single chunk.
+        # The static variables have no time axis, and map_blocks lines them up
+        # with the trailing (spatial) axes of the timeseries blocks.
+        timeseries = [v.chunk({'time':-1}) for v in timeseries]
+        static = [v.chunk() if v.chunks is None else v for v in static]
+        all_vars = xr.unify_chunks(*timeseries, *static)
+        
+        fCover = da.map_blocks(model_block,
+                               *[v.data for v in all_vars],
+                               dtype  = forcing_dtype,
+                               chunks = ((n_days + n_state_vars),) + all_vars[0].data.chunks[1:])
+        timeseries = all_vars[:len(timeseries)]
+    else:
+        fCover = model_block(*[v.values for v in timeseries + static])
+    
+    output = xr.DataArray(fCover[:n_days],
+                          dims   = timeseries[0].dims,
+                          coords = timeseries[0].coords)
+    if initial_state is not None and warmup_days > 0:
+        output = output.isel(time = slice(warmup_days, None))
+    if not return_state:
+        return output
+    
+    template = timeseries[0].isel(time=0, drop=True)
+    state = xr.Dataset({v:template.copy(data=fCover[n_days + i]) for i, v in enumerate(phenograss_state_vars.values())})
+    return output, state
+
+
+def with_prior_days(ds, prior_ds, n_days=None):
+    """
+    ds with the last n_days (None for all) of prior_ds in front of it, eg. 
+    the historic days before a scenario. Only the variables with a time 
+    dimension in both are extended, the rest are from ds. The model/scenario 
+    coordinates of prior_ds are replaced with those in ds, and with dask time 
+    is kept as a single chunk.
+    """
+    if n_days == 0:
+        return ds
+    time_vars = [v for v in ds.data_vars if 'time' in ds[v].dims and v in prior_ds]
+    prior = prior_ds[time_vars]
+    if n_days is not None:
+        prior = prior.isel(time = slice(-n_days, None))
+    prior = prior.assign_coords({d:ds[d] for d in ['model','scenario'] if d in prior.dims})
+    
+    extended = xr.concat([prior, ds[time_vars]], dim='time')
+    if extended.chunks:
+        extended = extended.chunk({'time':-1})
+    return xr.merge([extended, ds.drop_vars(time_vars).drop_dims('time', errors='ignore')])
+
+def check_state_handoff(model, ds, split_day, warmup_days=None):
+    """
+    The max absolute difference in fCover between a single full length run 
+    and one split at split_day, where the second part starts from the state
+    handed off by the first with apply_phenograss_dask_wrapper(). This is 
+    how each scenario is started from the historic run in apply_model_to_cmip.py
+    with historic_state_handoff. warmup_days None for phenograss_warmup_days().
+    """
+    if warmup_days is None:
+        warmup_days = phenograss_warmup_days(model)
+    ds = ds.load()
+    full_run = apply_phenograss_dask_wrapper(model, ds)
+    first_run, state = apply_phenograss_dask_wrapper(model, ds.isel(time = slice(0, split_day)), 
+                                                     return_state = True, warmup_days = warmup_days)
+    second_run = apply_phenograss_dask_wrapper(model, ds.isel(time = slice(split_day - warmup_days, None)), 
+                                               initial_state = state, warmup_days = warmup_days)
+    split_run = np.concatenate([first_run.values, second_run.values], axis=0)
+    return float(np.nanmax(np.abs(full_run.values - split_run)))
+
+def iterate_phenograss_segments(model, ds, segment_days=3650, initial_state=None, warmup_days=None):
+    """
+    Run the phenograss model over consecutive time segments of ds. The model
+    state (soil water W and vegetation V, see phenograss_state_vars) is
+    carried from each segment to the next. Every segment after the first 
+    also re-runs the phenograss_warmup_days() before it, starting from the 
+    state on the day before those, so the lagged soil water and precip 
+    window are filled in from the forcing as they would be in a full run. 
+    See validate_segmented_phenograss.py for how close this is to a single 
+    run over the full time series.
+    
+    Only one segment of the forcing data is loaded at a time. So with a lazy
+    (dask or netcdf backed) ds the memory needed is set by segment_days
+    instead of the full 1980-2100 time series. 
+
+    Parameters
+    ----------
+    model : 
+        A GrasslandModel.models.PhenoGrass model type.
+    ds : 
+        Xarray dataset with all required phenograss variables
+    segment_days : int
+        number of days in each segment, more than warmup_days
+    initial_state : dict or None
+        initial state for the first segment, the state the day before ds
+        starts. None to use the model defaults.
+    warmup_days : int or None
+        days re-run before each segment, None for phenograss_warmup_days(). 
+        A longer warm-up gives any difference in W/V from the restarted lags 
+        more time to fade out.
+
+    Yields
+    ------
+        (fCover, state) for every segment in order. fCover is a time first 
+        DataArray for the segment. state is the dict of the model state on 
+        the day before the warm-up of the next segment, ie. warmup_days + 1 
+        days before the segment end.
+    """
+    timeseries, static = _phenograss_layout(ds)
+    static_values = [np.ascontiguousarray(v.values) for v in static]
+    predictor_names = list(phenograss_timeseries_vars) + list(phenograss_static_vars)
+    
+    if warmup_days is None:
+        warmup_days = phenograss_warmup_days(model)
+    if segment_days <= warmup_days:
+        raise ValueError('segment_days must be more than the {w} warm-up days'.format(w=warmup_days))
+    
+    state = {} if initial_state is None else initial_state
+    n_days = len(timeseries[0].time)
+    for segment_start in range(0, n_days, segment_days):
+        segment_end = min(segment_start + segment_days, n_days)
+        run_start = 0 if segment_start == 0 else segment_start - warmup_days
+        run_values = [np.ascontiguousarray(v[run_start:segment_end].values) for v in timeseries]
+        
+        predictors = dict(zip(predictor_names, run_values + static_values))
+        predictors.update(state)
+        model_output = model.predict(predictors=predictors, return_variables='all')
+        
+        # The next run starts warmup_days before this segment ends
+        state_day = max(segment_end - warmup_days - 1 - run_start, 0)
+        state = {initial_keyword:np.array(model_output[var][state_day]) for var, initial_keyword in phenograss_state_vars.items()}
+        fCover = xr.DataArray(model_output['fCover'][segment_start - run_start:].astype(forcing_dtype, copy=False),
+                              dims   = timeseries[0].dims,
+                              coords = timeseries[0][segment_start:segment_end].coords)
+        yield fCover, state
+
+@instrumented
+def apply_phenograss_segmented(model, ds, segment_days=3650, warmup_days=None):
+    """
+    Apply the phenograss model to ds one time segment at a time with 
+    iterate_phenograss_segments(), writing each segment into a single 
+    preallocated output array. warmup_days is passed to 
+    iterate_phenograss_segments().
+
+    Returns
+    -------
+        xarray DataArray of phenograss output, to within the tolerance in
+        validate_segmented_phenograss.py of apply_phenograss_dask_wrapper()
+    """
+    timeseries, _ = _phenograss_layout(ds)
+    fCover = np.empty(timeseries[0].shape, dtype=forcing_dtype)
+    
+    segment_start = 0
+    for segment_fCover, _ in iterate_phenograss_segments(model, ds, segment_days=segment_days, warmup_days=warmup_days):
+        segment_end = segment_start + len(segment_fCover.time)
+        fCover[segment_start:segment_end] = segment_fCover.values
+        segment_start = segment_end
+    
+    return xr.DataArray(fCover,
+                        dims   = timeseries[0].dims,
+                        coords = timeseries[0].coords)
+
+def check_segmented_run(model, ds, segment_days=365, warmup_days=None):
+    """
+    The max absolute difference in fCover between a segmented run and a 
+    single full length run. Use a small ds (eg. data/test_dataset.nc4 with 
+    the other variables added) as the full run is loaded into memory.
+    validate_segmented_phenograss.py runs this for every phenograss model.
+    """
+    full_run = apply_phenograss_dask_wrapper(model, ds.load())
+    segmented_run = apply_phenograss_segmented(model, ds, segment_days=segment_days, warmup_days=warmup_days)
+    return float(np.nanmax(np.abs(full_run.values - segmented_run.values)))
 
 
 if __name__ == "__main__":
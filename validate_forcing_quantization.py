@@ -0,0 +1,112 @@
+import json
+import os
+
+import numpy as np
+import xarray as xr
+import GrasslandModels
+
+from tools import cmip5_file_tools, xarray_tools, quantize_tools, period_tools
+
+import site_config
+
+"""
+How much does storing the forcing as scaled int16 (see tools/quantize_tools.py)
+change the final fCover anomalies?
+
+For a region of each climate model, phenograss is run on the original float
+forcing and on the same forcing after an int16 round trip, with the derived
+variables (et, radiation, tmean) also quantized as they would be stored. The
+annual integral and its anomaly (relative to the climatology years, as in
+generate_plot_data_for_website.py) are compared between the two.
+
+This uses the original float files in data/cmip5_nc_files/, which are never
+changed. The report is written to quantize_tools.validation_report_file
+(data/run_reports/forcing_quantization_validation.json), and download_cmip5.py
+only makes the int16 copies once it exists.
+"""
+
+climate_data_folder = quantize_tools.original_data_folder
+climate_model_info = cmip5_file_tools.get_cmip5_spec(models='all', scenarios=['rcp85'])
+
+# A 2x2 degree area in the central great plains, to keep this quick
+validation_region = dict(latitude  = slice(38, 40),
+                         longitude = slice(-100, -98))
+
+phenograss_model_file = 'models/ecoregion-vegtype_GrPlains_GR_PhenoGrass_4dac8b702c3241eb.json'
+
+report_file = quantize_tools.validation_report_file
+
+climatology_years = list(site_config.climatology_years)
+
+other_var_ds = xr.open_dataset('data/other_variables.nc')
+
+model = GrasslandModels.utils.load_saved_model(phenograss_model_file)
+model.set_internal_method('numpy')
+
+def quantized_forcing(ds):
+    """ ds with every forcing variable replaced by its int16 round trip """
+    ds = ds.copy()
+    for var in quantize_tools.forcing_quantization:
+        if var in ds:
+            ds[var] = quantize_tools.quantize(ds[var], var=var)
+    return ds
+
+def derive_forcing(climate, other_var_ds):
+    """ The same derived variables as xarray_tools.compile_cmip_model_data(), in memory """
+    ds = climate.copy()
+    ds['radiation'] = xarray_tools.create_radiation_data_array(ref = ds)
+    ds['et'] = xarray_tools.create_et_data_array(tmin = ds.tasmin, tmax = ds.tasmax, radiation = ds.radiation)
+    ds['tmean'] = xarray_tools.rolling_tmean(ds = ds, window_size = 15)
+    ds = xr.merge([ds, xarray_tools.as_forcing_dtype(other_var_ds).sel(**validation_region)], join='left')
+    return ds.expand_dims({'model':['m'], 'scenario':['s']}).transpose('time','latitude','longitude','model','scenario')
+
+def annual_anomaly(ds):
+    """ The annual fCover integral and its anomaly relative to the climatology years """
+    fCover = xarray_tools.apply_phenograss_dask_wrapper(model = model, ds = ds)
+    annual = period_tools.reduce_periods(fCover, how='sum', freq='year')
+    climatology = annual.sel(time = annual.time.isin(climatology_years)).mean('time')
+    return annual, (annual - climatology) / climatology
+
+def error_summary(original, quantized):
+    error = np.abs(quantized.values - original.values)
+    error = error[~np.isnan(error)]
+    return {'max_abs_error'  : float(error.max()),
+            'mean_abs_error' : float(error.mean()),
+            'p99_abs_error'  : float(np.percentile(error, 99))}
+
+report = {'region' : {k:[v.start, v.stop] for k, v in validation_region.items()},
+          'phenograss_model' : phenograss_model_file,
+          'climatology_years' : [min(climatology_years), max(climatology_years)],
+          'quantization' : {v:dict(**spec, max_abs_error = quantize_tools.max_abs_error(v)) for v, spec in quantize_tools.forcing_quantization.items()},
+          'climate_models' : {}}
+
+for ds_info in climate_model_info:
+    print('validating {m}'.format(m=ds_info['climate_model_name']))
+    model_files = cmip5_file_tools.get_cmip5_files(model_spec = ds_info,
+                                                   base_folder = climate_data_folder,
+                                                   get_historic = True)
+    climate = xr.open_mfdataset(model_files, combine='by_coords')
+    climate = xarray_tools.as_forcing_dtype(climate)
+    climate['longitude'] = climate.longitude - 360
+    climate = climate[['tasmin','tasmax','pr']].sel(**validation_region).load()
+
+    original = derive_forcing(climate, other_var_ds)
+    quantized = quantized_forcing(derive_forcing(quantized_forcing(climate), other_var_ds))
+
+    model_report = {'forcing' : {}}
+    for var in quantize_tools.forcing_quantization:
+        low, high = quantize_tools.valid_range(var)
+        model_report['forcing'][var] = dict(**error_summary(original[var], quantized[var]),
+                                            n_clipped = int(((original[var] < low) | (original[var] > high)).sum()))
+
+    original_annual, original_anomaly = annual_anomaly(original)
+    quantized_annual, quantized_anomaly = annual_anomaly(quantized)
+    model_report['annual_fCover'] = error_summary(original_annual, quantized_annual)
+    model_report['fCover_anomaly'] = error_summary(original_anomaly, quantized_anomaly)
+
+    report['climate_models'][ds_info['climate_model_name']] = model_report
+    print(json.dumps(model_report['fCover_anomaly']))
+
+os.makedirs(os.path.dirname(report_file), exist_ok=True)
+with open(report_file, 'w') as f:
+    json.dump(report, f, indent=2)
@@ -0,0 +1,83 @@
+import json
+import os
+
+import numpy as np
+import xarray as xr
+import GrasslandModels
+
+from tools import xarray_tools
+
+"""
+Does running phenograss in time segments (xarray_tools.iterate_phenograss_segments),
+or starting a scenario from the end of its historic run (xarray_tools.check_state_handoff,
+historic_state_handoff in apply_model_to_cmip.py) give the same fCover as a 
+single run over the full time series?
+
+First the installed GrasslandModels is checked to take the W_initial/V_initial
+predictors and return the W/V state (xarray_tools.check_phenograss_state_api),
+so the comparisons below can't pass with the initial state silently ignored.
+
+Only the W/V state is carried between segments, with a warm-up overlap for
+the lagged soil water and precip window (xarray_tools.phenograss_warmup_days).
+This checks that against a full run for every ecoregion phenograss model,
+using the year of data in data/test_dataset.nc4, with the minimum warm-up 
+and with a longer one (long_warmup_days). The hand-off is split at handoff_day. The max absolute difference
+for each model is written to data/run_reports/segmented_phenograss_validation.json,
+and it passes when all are within half the scale_factor the fCover output
+is stored with in apply_model_to_cmip.py.
+"""
+
+phenograss_model_files = ['models/ecoregion-vegtype_ETempForests_GR_PhenoGrass_4dac8b702c3241eb.json',  
+                          'models/ecoregion-vegtype_NWForests_GR_PhenoGrass_4dac8b702c3241eb.json',
+                          'models/ecoregion-vegtype_GrPlains_GR_PhenoGrass_4dac8b702c3241eb.json']
+
+test_data_file = 'data/test_dataset.nc4'
+segment_days = 120
+long_warmup_days = 60
+handoff_day = 200
+tolerance = 0.0005
+
+report_file = xarray_tools.segmented_validation_report_file
+
+other_var_ds = xr.open_dataset('data/other_variables.nc')
+
+def test_forcing():
+    """ data/test_dataset.nc4 with the derived variables, as in xarray_tools.compile_cmip_model_data() """
+    ds = xarray_tools.as_forcing_dtype(xr.open_dataset(test_data_file).load())
+    ds['longitude'] = ds.longitude - 360
+    ds['radiation'] = xarray_tools.create_radiation_data_array(ref = ds)
+    ds['et'] = xarray_tools.create_et_data_array(tmin = ds.tasmin, tmax = ds.tasmax, radiation = ds.radiation)
+    ds['tmean'] = xarray_tools.rolling_tmean(ds = ds, window_size = 15)
+    ds = xr.merge([ds, xarray_tools.as_forcing_dtype(other_var_ds)], join='left')
+    return ds.expand_dims({'model':['m'], 'scenario':['s']}).transpose('time','latitude','longitude','model','scenario')
+
+ds = test_forcing()
+
+report = {'test_data' : test_data_file,
+          'segment_days' : segment_days,
+          'long_warmup_days' : long_warmup_days,
+          'handoff_day' : handoff_day,
+          'tolerance' : tolerance,
+          'phenograss_models' : {}}
+
+for model_file in phenograss_model_files:
+    model = GrasslandModels.utils.load_saved_model(model_file)
+    model.set_internal_method('numpy')
+    
+    model_report = {'state_api_first_day' : xarray_tools.check_phenograss_state_api(model),
+                    'warmup_days' : xarray_tools.phenograss_warmup_days(model),
+                    'segmented_max_abs_diff' : xarray_tools.check_segmented_run(model, ds, segment_days = segment_days),
+                    'segmented_long_warmup_max_abs_diff' : xarray_tools.check_segmented_run(model, ds, segment_days = segment_days, 
+                                                                                             warmup_days = long_warmup_days),
+                    'handoff_max_abs_diff' : xarray_tools.check_state_handoff(model, ds, split_day = handoff_day)}
+    report['phenograss_models'][model_file] = model_report
+    print(model_file, json.dumps(model_report))
+
+# check_phenograss_state_api() raises on any problem, so getting here means it passed
+report['state_api_checked'] = True
+report['passed'] = all([m['segmented_max_abs_diff'] <= tolerance and m['handoff_max_abs_diff'] <= tolerance for m in report['phenograss_models'].values()])
+print('passed' if report['passed'] else 'FAILED')
+
+os.makedirs(os.path.dirname(report_file), exist_ok=True)
+with open(report_file, 'w') as f:
+    json.dump(report, f, indent=2)
@@ -0,0 +1,183 @@
+import gzip
+import hashlib
+import io
+from functools import lru_cache
+
+import flask
+import numpy as np
+
+"""
+REST endpoints on the dash flask server for getting the timeseries plot data
+directly, instead of a rendered figure from the dash callbacks.
+
+    /api/pixel?lat=40.2&lon=-104.7&scenario=rcp45
+    /api/bbox?min_lat=38&max_lat=41&min_lon=-105&max_lon=-102&scenario=rcp45
+
+scenario is optional in both. Adding format=parquet returns a parquet file
+instead of json records. Responses are gzipped when the client accepts it
+and carry ETag and Cache-Control headers, so repeat requests can be handled by
+a CDN or reverse proxy. The plot data only changes on redeploy.
+
+The gzipped timeseries values script from plot_store.write_timeseries_values()
+is served at /timeseries-values.js, see register_timeseries_values().
+"""
+
+api_columns = ['pixel_id','latitude','longitude','scenario','year',
+               'fCover_annomoly_mean','fCover_annomoly_std',
+               'tmean_annomoly_mean','tmean_annomoly_std',
+               'pr_anomaly_mean','pr_anomaly_std']
+
+mimetypes = {'json'   : 'application/json',
+             'parquet': 'application/vnd.apache.parquet'}
+
+def register_api(server, plot_store, cache_max_age=86400, cache_size=4096, max_bbox_pixels=2500):
+    """
+    Add the /api/pixel and /api/bbox routes to the flask server.
+
+    Parameters
+    ----------
+    server : flask.Flask
+        the dash app.server object
+    plot_store : plot_store.PlotStore
+        the timeseries plot data
+    cache_max_age : int
+        seconds clients and proxies can cache a response for
+    cache_size : int
+        number of response bodies to keep in memory
+    max_bbox_pixels : int
+        bounding boxes covering more cells than this are rejected
+    """
+    pixel_grid = plot_store.grid
+    available_scenarios = set(plot_store.scenarios)
+
+    @lru_cache(maxsize=cache_size)
+    def query_body(pixel_key, scenario, fmt):
+        if pixel_key[0] == 'pixel':
+            pixels = [pixel_key[1]]
+        else:
+            corners = np.array(pixel_key[1:])
+            lats, lons = pixel_grid.latitude(corners), pixel_grid.longitude(corners)
+            pixels = pixel_grid.bbox_pixel_ids(lats[0], lats[1], lons[0], lons[1])
+
+        selected = plot_store.frame(plot_store.pixel_rows(pixels), scenario=scenario)[api_columns]
+
+        if fmt == 'parquet':
+            buffer = io.BytesIO()
+            selected.to_parquet(buffer, index=False)
+            body = buffer.getvalue()
+        else:
+            body = selected.to_json(orient='records', double_precision=4).encode('utf-8')
+
+        return body, hashlib.sha1(body).hexdigest()
+
+    @lru_cache(maxsize=cache_size)
+    def gzip_body(pixel_key, scenario, fmt):
+        return gzip.compress(query_body(pixel_key, scenario, fmt)[0])
+
+    def parse_args(*names):
+        try:
+            return [float(flask.request.args[n]) for n in names]
+        except KeyError as e:
+            flask.abort(400, description='missing parameter {p}'.format(p=e.args[0]))
+        except ValueError:
+            flask.abort(400, description='{p} must be numbers'.format(p=','.join(names)))
+
+    def build_response(pixel_key):
+        scenario = flask.request.args.get('scenario', None)
+        fmt = flask.request.args.get('format', 'json')
+
+        if scenario is not None and scenario not in available_scenarios:
+            flask.abort(400, description='unknown scenario {s}'.format(s=scenario))
+        if fmt not in mimetypes:
+            flask.abort(400, description='format must be one of {f}'.format(f=','.join(mimetypes)))
+
+        try:
+            body, etag = query_body(pixel_key, scenario, fmt)
+        except ImportError:
+            # pandas needs pyarrow or fastparquet for to_parquet()
+            flask.abort(406, description='parquet output is not available on this server')
+
+        use_gzip = 'gzip' in flask.request.accept_encodings
+        if use_gzip:
+            # The gzip version is a different representation so needs its own etag
+            etag = etag + '-gzip'
+
+        if etag in flask.request.if_none_match:
+            response = flask.Response(status=304)
+        else:
+            response = flask.Response(gzip_body(pixel_key, scenario, fmt) if use_gzip else body,
+                                      mimetype = mimetypes[fmt])
+            if use_gzip:
+                response.headers['Content-Encoding'] = 'gzip'
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'public, max-age={a}'.format(a=cache_max_age)
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    @server.route('/api/pixel')
+    def api_pixel():
+        lat, lon = parse_args('lat','lon')
+        pixel_id = int(pixel_grid.pixel_id(lat, lon))
+        if pixel_id < 0:
+            flask.abort(404, description='location outside of the forecast area')
+
+        return build_response(('pixel', pixel_id))
+
+    @server.route('/api/bbox')
+    def api_bbox():
+        min_lat, max_lat, min_lon, max_lon = parse_args('min_lat','max_lat','min_lon','max_lon')
+
+        pixels = pixel_grid.bbox_pixel_ids(min_lat, max_lat, min_lon, max_lon)
+        if len(pixels) == 0:
+            flask.abort(404, description='bounding box outside of the forecast area')
+        if len(pixels) > max_bbox_pixels:
+            flask.abort(400, description='bounding box covers {n} cells, the max is {m}'.format(n=len(pixels), m=max_bbox_pixels))
+
+        # The lower left and upper right cells define the box snapped to the
+        # grid, so nearby boxes share a cache entry.
+        return build_response(('bbox', int(pixels[0]), int(pixels[-1])))
+
+def file_etag(filename):
+    """ sha1 of a file, read in blocks """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def timeseries_values_url(filename):
+    """
+    The url the timeseries values script is served at. It includes the file 
+    hash, so browsers can keep it cached until the plot data changes.
+    """
+    return '/timeseries-values.js?v={e}'.format(e=file_etag(filename)[:12])
+
+def register_timeseries_values(server, filename, cache_max_age=86400*365):
+    """
+    Add the /timeseries-values.js route to the flask server, which sends the 
+    already gzipped file as is. It's only decompressed for the rare client 
+    which doesn't accept gzip. The file is read for every request, from the 
+    page cache, instead of being held in every worker.
+    """
+    etag = file_etag(filename)
+
+    @server.route('/timeseries-values.js')
+    def timeseries_values():
+        use_gzip = 'gzip' in flask.request.accept_encodings
+        response_etag = etag + '-gzip' if use_gzip else etag
+
+        if response_etag in flask.request.if_none_match:
+            response = flask.Response(status=304)
+        else:
+            with open(filename, 'rb') as f:
+                body = f.read()
+            response = flask.Response(body if use_gzip else gzip.decompress(body),
+                                      mimetype = 'application/javascript')
+            if use_gzip:
+                response.headers['Content-Encoding'] = 'gzip'
+
+        response.set_etag(response_etag)
+        response.headers['Cache-Control'] = 'public, max-age={a}'.format(a=cache_max_age)
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
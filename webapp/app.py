@@ -14,6 +14,8 @@ import geopandas as gp
 import json
 
 from map_tools import build_geojson_grid
+from plot_store import PlotStore
+import api
 
 import site_text
                                   
@@ -26,35 +28,160 @@ display_years = site_config.display_years
 year_resolution = site_config.year_resolution # final figure will display the average of this many years.
 
 debug=site_config.debug
+clientside_timeseries = site_config.clientside_timeseries
 
 
 ################################
 
-phenograss_plot_data = pd.read_csv('data/phenograss_timeseries_plot_data.csv')
+# The plot data is memory mapped, so all the server workers share a single
+# copy. See plot_store.py, it's made in generate_plot_data_for_website.py
+plot_store = PlotStore('data/plot_store/')
 
 # Setup the USA grid. The mask contains the bounderies of the full grid, though
-# not every area will have data.
-mask = pd.read_csv('data/ecoregion_mask.csv')
-
-pixel_ids = mask[['latitude','longitude']].drop_duplicates().reset_index().drop(columns=['index'])
-pixel_ids['pixel_id'] = pixel_ids.index
+# not every area will have data. Rows are in pixel_id order.
+mask = plot_store.mask_frame()
 
 us_grid = build_geojson_grid(mask, polygon_resolution=0.499)
 us_grid = json.loads(us_grid.to_json())
 [f.update(id=i) for i,f in enumerate(us_grid['features'])]
-# TODO: make feature numbers based on the pixel_id column in phenograss_data
-
-# Assign the pixel id's back to data
-phenograss_plot_data = pd.merge(phenograss_plot_data ,pixel_ids, on=['latitude','longitude'], how='left')
 
 # Need a data.frame to fill in the dash map. the only thing it actually holds
 # is the hover text values.
-map_data = phenograss_plot_data[['latitude','longitude','pixel_id']].drop_duplicates()
+map_data = mask.loc[plot_store.pixels_with_data(), ['latitude','longitude']]
+map_data['pixel_id'] = map_data.index
+
+map_data['hover_text'] = ['{lat} Latitude\n{lon} Longitude'.format(lat=lat, lon=lon) for lat, lon in zip(map_data.latitude, map_data.longitude)]
 
-def map_hover_text(row):
-    return '{lat} Latitude\n{lon} Longitude'.format(lat=row.latitude, lon=row.longitude)
+#################################################
+# Timeseries figure setup. Shared by the server callback and the clientside
+# data bundle.
+#################################################
 
-map_data['hover_text'] = map_data.apply(map_hover_text, axis=1)
+# Setup the timeseries axis
+x_axis_values = np.unique(np.array(display_years) - (np.array(display_years) % year_resolution))
+x_axis_labels = ["{y}'s".format(y=y) for y in x_axis_values]
+
+# Make labels like -30%, +20%, and No change for 0
+y_axis_percent_values = [-0.2, -0.1, 0, 0.1, 0.2, 0.3]
+y_axis_percent_labels = []
+for v in y_axis_percent_values:
+    if v < 0:
+        y_axis_percent_labels.append(str(int(v*100))+'%')
+    elif v > 0:
+        y_axis_percent_labels.append('+'+str(int(v*100))+'%')
+    else:
+        y_axis_percent_labels.append('No Change')
+
+# For temerature make labels like +2 C, -1 C, and No Change
+y_axis_temp_values = [-1,0,1,2,3,4]
+y_axis_temp_labels = []
+for v in y_axis_temp_values:
+    if v < 0:
+        y_axis_temp_labels.append(str(v)+'° C')
+    elif v > 0:
+        y_axis_temp_labels.append('+'+str(v)+'° C')
+    else:
+        y_axis_temp_labels.append('No Change')
+
+variable_info = [{'variable_desc':'Change in Grassland Productivity',
+                  'variable': 'Grassland productivity',
+                  'color':'#009E73',
+                  'mean_var':'fCover_annomoly_mean',
+                  'std_var':'fCover_annomoly_std',
+                  'y_labels':'percent',
+                  'offset':0},
+                 {'variable_desc':'Change in Average Yearly Temperature',
+                  'variable': 'Average yearly temperature',
+                  'color':'#d5000d',
+                  'mean_var':'tmean_annomoly_mean',
+                  'std_var':'tmean_annomoly_std',
+                  'y_labels':'temp',
+                  'offset':0},
+                 {'variable_desc':'Change in Average Yearly Rain',
+                  'variable': 'Average yearly rain',
+                  'color':'#0072B2',
+                  'mean_var':'pr_anomaly_mean',
+                  'std_var':'pr_anomaly_std',
+                  'y_labels':'percent',
+                  'offset':0}]
+
+# The pixel shown before anything on the map is clicked
+default_pixel = 3664
+
+def build_timeseries_figure(pixel_data=None, hover_text=None):
+    """
+    Build the 3 panel timeseries figure for a single pixel/scenario subset
+    of the plot data. hover_text is a dictionary with the hover text for
+    each mean_var in variable_info, from plot_store.pixel_hover_text().
+    With pixel_data=None the traces are left empty, which is used as the
+    template for the clientside figures.
+    """
+    variable_title_text = [v['variable_desc'] for v in variable_info]
+    
+    fig = make_subplots(rows=len(variable_info), cols=1, shared_xaxes=True,
+                        subplot_titles=variable_title_text)
+    
+    # Add the data to each of the plots
+    for v_i, v in enumerate(variable_info):
+        if pixel_data is not None:
+            x_values    = pixel_data.year + v['offset']
+            mean_values = pixel_data[v['mean_var']]
+            std_values  = pixel_data[v['std_var']]
+            trace_hover_text = hover_text[v['mean_var']]
+        else:
+            x_values = mean_values = std_values = trace_hover_text = []
+        
+        fig.append_trace(go.Scatter(x=x_values, y=mean_values,
+                                    error_y = dict(type='data',array=std_values, width=0, thickness=3),
+                                    mode='markers', marker=dict(color=v['color'], size=10),
+                                    hovertext = trace_hover_text, hoverinfo = "text",
+                                    name=v['variable_desc'],  # only the top gets legend entries
+                                    showlegend=False),
+                         row=v_i+1,col=1)
+        
+        # Specifying axis labels
+        fig.update_xaxes(tickmode='array', tickangle=-45,
+                          tickvals = x_axis_values, ticktext = x_axis_labels,
+                          gridcolor='grey')
+        
+        if v['y_labels'] == 'percent':
+            fig.update_yaxes(tickmode='array', range=[min(y_axis_percent_values),max(y_axis_percent_values)],
+                              tickvals = y_axis_percent_values, ticktext = y_axis_percent_labels,
+                              gridcolor='grey', row=v_i+1, col=1)
+        elif v['y_labels'] == 'temp':
+            fig.update_yaxes(tickmode='array', range=[min(y_axis_temp_values),max(y_axis_temp_values)],
+                              tickvals = y_axis_temp_values, ticktext = y_axis_temp_labels,
+                              gridcolor='grey', row=v_i+1, col=1)
+            
+    
+    # Horizontal lines 
+    hline = dict(type='line', 
+                x0=x_axis_values.min()-10,x1=x_axis_values.max()+10,
+                y0=0,y1=0, 
+                line=dict(color='black',width=2))
+    for variable_i in range(len(variable_info)):
+        fig.add_shape(hline, row=variable_i+1,col=1)
+    
+
+    # fig.update_layout(legend=dict(x=0, y=-0.5)) # if a legend is ever added this will adjust the location.
+    fig.update_layout(margin=dict(l=50, r=50, t=50, b=50))
+    fig.update_layout(title = '', height=600, plot_bgcolor='white')
+
+    return fig
+
+def build_timeseries_bundle(plot_store):
+    """
+    The figure template and settings for the timeseries-data store, which 
+    assets/timeseries.js uses to draw the figures and map layers without a 
+    trip to the server. The values themselves are in the timeseries values 
+    script from the plot store (see plot_store.write_timeseries_values()), 
+    which is loaded once and cached by the browser, so this stays small.
+    """
+    return {'default_pixel' : default_pixel,
+            'variables'     : [{k:v[k] for k in ['mean_var','std_var']} for v in variable_info],
+            'figure'        : build_timeseries_figure().to_plotly_json(),
+            'map_styles'    : {layer:map_layer_style(layer) for layer in map_layers},
+            'default_map_scenario' : default_map_scenario}
 
 #################################################                                    
 #################################################
@@ -64,11 +191,24 @@ map_data['hover_text'] = map_data.apply(map_hover_text, axis=1)
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+# The values for the clientside figures, a gzipped static script made with
+# the plot store. It's loaded before the callbacks run.
+timeseries_values_file = 'data/plot_store/timeseries_values.js.gz'
+if clientside_timeseries:
+    external_scripts = [api.timeseries_values_url(timeseries_values_file)]
+else:
+    external_scripts = []
+
+app = dash.Dash(__name__, external_stylesheets=external_stylesheets, external_scripts=external_scripts)
 
 # server object used for wsgi integration
 server = app.server
 
+# REST endpoints for the plot data, see api.py
+api.register_api(server, plot_store)
+if clientside_timeseries:
+    api.register_timeseries_values(server, timeseries_values_file)
+
 # Title text 
 page_title_text = html.Div([html.H1("Long Term Grassland Productivity Forecast")],
                                 style={'textAlign': "center", "padding-bottom": "30"})
@@ -78,44 +218,101 @@ app.title = 'Grassland Forecasts'
 
 ######################
 # The map
-map_trace = go.Choroplethmapbox(
-                    geojson=us_grid,
-                    z = np.repeat(1,len(map_data)), # Make all fill values the same so it displays a single color
-                    showscale=False,
-                    marker = dict(opacity=0.2,line_color='red', line_width=0.2),
-                    colorscale="Reds",
-                    locations = map_data['pixel_id'],
-                    featureidkey='id',
-                    hoverinfo='text',
-                    hovertext = map_data['hover_text'],
-                    #selectedpoints = [842], # The index of pixel_id 4681     # docs sort of imply these control the "on/off"
-                    #selected = dict(marker_opacity=1.0),                     # of the selected location, but that doesn't seem
-                    #unselected = dict(marker_opacity=0.2),                   # to be the case. Likely need to implement in a callback
-                    )
+# Cells are shaded by the decade anomaly of the layer chosen in the map-layer
+# dropdown, for the scenario of the selected tab. With the 'none' layer
+# all cells are a single color. Switching layers only changes the z values and
+# colors of the trace, never the geometry.
+map_layers = {'none'                 : {'label':'Forecast area'},
+              'fCover_annomoly_mean' : {'label':'Change in Grassland Productivity',
+                                        'colorscale':'BrBG', 'zmin':-0.3, 'zmax':0.3, 'tickformat':'+.0%'},
+              'tmean_annomoly_mean'  : {'label':'Change in Average Yearly Temperature',
+                                        'colorscale':'RdBu', 'reversescale':True, 'zmin':-4, 'zmax':4, 'ticksuffix':'° C'},
+              'pr_anomaly_mean'      : {'label':'Change in Average Yearly Rain',
+                                        'colorscale':'BrBG', 'zmin':-0.3, 'zmax':0.3, 'tickformat':'+.0%'}}
+
+# The map layer shown while on the about tab
+default_map_scenario = 'rcp45'
+
+# The decade slider uses the index of the decades in the anomaly cube
+map_decade_labels = {i:"{y}'s".format(y=y) for i, y in enumerate(plot_store.decades)}
+default_map_decade = int(np.searchsorted(plot_store.decades, 2050))
+
+def map_layer_style(layer):
+    """ The map trace attributes which change between layers """
+    if layer == 'none':
+        return dict(showscale=False, colorscale='Reds', reversescale=False, zauto=True,
+                    marker = dict(opacity=0.2,line_color='red', line_width=0.2))
+    
+    info = map_layers[layer]
+    return dict(showscale=True, colorscale=info['colorscale'], reversescale=info.get('reversescale', False),
+                zauto=False, zmin=info['zmin'], zmax=info['zmax'],
+                colorbar = dict(tickformat=info.get('tickformat',''), ticksuffix=info.get('ticksuffix',''),
+                                thickness=15),
+                marker = dict(opacity=0.7, line_color='grey', line_width=0.2))
+
+def build_map_figure(layer='none', z=None):
+    if z is None:
+        z = np.repeat(1,len(map_data)) # Make all fill values the same so it displays a single color
+    
+    map_trace = go.Choroplethmapbox(
+                        geojson=us_grid,
+                        z = z,
+                        locations = map_data['pixel_id'],
+                        featureidkey='id',
+                        hoverinfo='text',
+                        hovertext = map_data['hover_text'],
+                        #selectedpoints = [842], # The index of pixel_id 4681     # docs sort of imply these control the "on/off"
+                        #selected = dict(marker_opacity=1.0),                     # of the selected location, but that doesn't seem
+                        #unselected = dict(marker_opacity=0.2),                   # to be the case. Likely need to implement in a callback
+                        **map_layer_style(layer)
+                        )
+    return {'data': [map_trace],
+            'layout': map_layout}
+
 map_layout = go.Layout(title=None,
                        height=900,width=500,
                        margin=dict(l=20, r=20, t=20, b=20),
                        mapbox_style='stamen-terrain',
                        mapbox_zoom=3, mapbox_center = {"lat": 40, "lon": -100})
 
+map_controls = html.Div(id='map-controls',
+                        children = [
+                                dcc.Dropdown(id='map-layer',
+                                             options = [{'label':info['label'], 'value':layer} for layer, info in map_layers.items()],
+                                             value = 'none',
+                                             clearable = False),
+                                dcc.Slider(id='map-decade',
+                                           min = 0, max = len(plot_store.decades) - 1, step = 1,
+                                           value = default_map_decade,
+                                           marks = map_decade_labels)
+                                ])
+
 map_container = html.Div(id='map-container',
                            children = [
                                    html.P(id='map-title',
                                           children=''),
+                                   map_controls,
                                    dcc.Graph(id='map',
-                                             figure = {
-                                                 'data': [map_trace],
-                                                 'layout': map_layout
-                                                 })
+                                             figure = build_map_figure())
                                       ])
 
 # Timeseries container, also includes the markdown container for 
 # the text within the tabs.
 
+# With clientside_timeseries the figure is always in the page and the browser
+# fills it in from the timeseries values, with the settings in the 
+# timeseries-data store. Otherwise the server callback
+# returns a new graph into the timeseries div.
+if clientside_timeseries:
+    timeseries_children = [dcc.Store(id='timeseries-data', data=build_timeseries_bundle(plot_store)),
+                           dcc.Graph(id='timeseries-graph', style={'display':'none'})]
+else:
+    timeseries_children = []
+
 timeseries_container = html.Div(id='timeseries-container',
                            children = [
                                dcc.Markdown(id='rcp_description'),
-                               html.Div(id='timeseries')
+                               html.Div(id='timeseries', children=timeseries_children)
                                ]
                            )
 
@@ -195,157 +392,77 @@ def update_tabtext(value):
     else:
         return d(site_text.rcp_tab_text[value])
 
-#######################
-# The primary timeseries plots
+######################
+# Map layers
 ######################
 
-# Setup the timeseries axis
-x_axis_values = np.unique(np.array(display_years) - (np.array(display_years) % year_resolution))
-x_axis_labels = ["{y}'s".format(y=y) for y in x_axis_values]
-
-# Make labels like -30%, +20%, and No change for 0
-y_axis_percent_values = [-0.2, -0.1, 0, 0.1, 0.2, 0.3]
-y_axis_percent_labels = []
-for v in y_axis_percent_values:
-    if v < 0:
-        y_axis_percent_labels.append(str(int(v*100))+'%')
-    elif v > 0:
-        y_axis_percent_labels.append('+'+str(int(v*100))+'%')
-    else:
-        y_axis_percent_labels.append('No Change')
+if clientside_timeseries:
+    # Swaps the z values of the map trace in the browser, see update_map in
+    # assets/timeseries.js. The values are the same ones as the timeseries.
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(namespace='timeseries', function_name='update_map'),
+        dash.dependencies.Output('map', 'figure'),
+        [dash.dependencies.Input('map-layer', 'value'),
+         dash.dependencies.Input('map-decade', 'value'),
+         dash.dependencies.Input('timeseries-tabs', 'value')],
+        [dash.dependencies.State('map', 'figure'),
+         dash.dependencies.State('timeseries-data', 'data')])
+else:
+    @app.callback(
+        dash.dependencies.Output('map', 'figure'),
+        [dash.dependencies.Input('map-layer', 'value'),
+         dash.dependencies.Input('map-decade', 'value'),
+         dash.dependencies.Input('timeseries-tabs', 'value')])
+    def update_map(layer, decade_i, value):
+        if layer == 'none':
+            return build_map_figure()
+        
+        scenario = default_map_scenario if value == 'about' else value
+        z = plot_store.map_layer(scenario, plot_store.decades[decade_i], layer, pixel_ids = map_data.pixel_id.values)
+        return build_map_figure(layer, z)
 
-# For temerature make labels like +2 C, -1 C, and No Change
-y_axis_temp_values = [-1,0,1,2,3,4]
-y_axis_temp_labels = []
-for v in y_axis_temp_values:
-    if v < 0:
-        y_axis_temp_labels.append(str(v)+'° C')
-    elif v > 0:
-        y_axis_temp_labels.append('+'+str(v)+'° C')
-    else:
-        y_axis_temp_labels.append('No Change')
+#######################
+# The primary timeseries plots
+######################
 
-# Special function for the timeseries hover text
-#TODO: need different wording for temperature
-def generate_hover_str(variable, timeperiod, change_value):
-    if timeperiod in ["1990's","2000's","2010's",]:
-        # dont make claims about the past
-        return ''
-    
-    if variable == 'Average yearly temperature':
-        change_text = '{}° C'.format(round(change_value,1))
-    else:
-        change_text = '{}%'.format(int(change_value*100))
+if clientside_timeseries:
+    # The browser builds the figure from the timeseries values, see
+    # update_timeseries in assets/timeseries.js. The graph is hidden on the
+    # about tab.
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(namespace='timeseries', function_name='update_timeseries'),
+        [dash.dependencies.Output('timeseries-graph', 'figure'),
+         dash.dependencies.Output('timeseries-graph', 'style')],
+        [dash.dependencies.Input('map', 'clickData'),
+         dash.dependencies.Input('timeseries-tabs', 'value')],
+        [dash.dependencies.State('timeseries-data', 'data')])
+else:
+    # Primary callback which queries the location and scenario-tab, parses the
+    # needed data and hover text, and builds the timeseries figures.
+    @app.callback(
+        dash.dependencies.Output('timeseries', 'children'),
+        [dash.dependencies.Input('map', 'clickData'),
+         dash.dependencies.Input('timeseries-tabs', 'value')])
+    def update_timeseries(clickData, value):
+        if value == 'about':
+            # For the about tab return a blank list here so the 'timeseries' div
+            # becomes empty
+            return []
         
-    s = '{var} is expected to <br><b>{verb}</b> {value} by the {timeperiod} in this scenario'
-    
-    if not np.isnan(change_value):
-        change_verb = 'increase' if change_value>0 else 'decrease'
-    else:
-        return ''
-    
-    s = s.format(var        = variable,
-                 verb       = change_verb,
-                 value      = change_text,
-                 timeperiod = timeperiod)
-    
-    return s
-
-# Primary callback which queries the location and scenario-tab, parses the
-# needed data, creates hover text, and builds the timeseries figures.
-@app.callback(
-    dash.dependencies.Output('timeseries', 'children'),
-    [dash.dependencies.Input('map', 'clickData'),
-     dash.dependencies.Input('timeseries-tabs', 'value')])
-def update_timeseries(clickData, value):
-    if value == 'about':
-        # For the about tab return a blank list here so the 'timeseries' div
-        # becomes empty
-        return []
-    
-    print(clickData)
-    try:
-        selected_pixel = clickData['points'][0]['location']
-    except:
-        selected_pixel = 3664
-    print(selected_pixel)
-    
-    print('selected_tab: '+str(value))
-    selected_scenario = value
-    
-    pixel_data = phenograss_plot_data[(phenograss_plot_data.pixel_id==selected_pixel) & (phenograss_plot_data.scenario==selected_scenario)]
-    
-    
-    variable_info = [{'variable_desc':'Change in Grassland Productivity',
-                      'variable': 'Grassland productivity',
-                      'color':'#009E73',
-                      'mean_var':'fCover_annomoly_mean',
-                      'std_var':'fCover_annomoly_std',
-                      'y_labels':'percent',
-                      'offset':0},
-                     {'variable_desc':'Change in Average Yearly Temperature',
-                      'variable': 'Average yearly temperature',
-                      'color':'#d5000d',
-                      'mean_var':'tmean_annomoly_mean',
-                      'std_var':'tmean_annomoly_std',
-                      'y_labels':'temp',
-                      'offset':0},
-                     {'variable_desc':'Change in Average Yearly Rain',
-                      'variable': 'Average yearly rain',
-                      'color':'#0072B2',
-                      'mean_var':'pr_anomaly_mean',
-                      'std_var':'pr_anomaly_std',
-                      'y_labels':'percent',
-                      'offset':0}]
-    
-    variable_title_text = [v['variable_desc'] for v in variable_info]
-    
-    fig = make_subplots(rows=len(variable_info), cols=1, shared_xaxes=True,
-                        subplot_titles=variable_title_text)
-    
-    # Add the data to each of the plots
-    for v_i, v in enumerate(variable_info):
-        # Tie togther the y + x values to generate a unique string
-        hover_attributes = zip(x_axis_labels,pixel_data[v['mean_var']])
-        hover_text = [generate_hover_str(v['variable'], *attr) for attr in hover_attributes]
+        try:
+            selected_pixel = clickData['points'][0]['location']
+        except (TypeError, KeyError, IndexError):
+            # No click yet
+            selected_pixel = default_pixel
         
-        fig.append_trace(go.Scatter(x=pixel_data.year + v['offset'], y=pixel_data[v['mean_var']],
-                                    error_y = dict(type='data',array=pixel_data[v['std_var']], width=0, thickness=3),
-                                    mode='markers', marker=dict(color=v['color'], size=10),
-                                    hovertext = hover_text, hoverinfo = "text",
-                                    name=v['variable_desc'],  # only the top gets legend entries
-                                    showlegend=False),
-                         row=v_i+1,col=1)
+        selected_scenario = value
         
-        # Specifying axis labels
-        fig.update_xaxes(tickmode='array', tickangle=-45,
-                          tickvals = x_axis_values, ticktext = x_axis_labels,
-                          gridcolor='grey')
+        pixel_data = plot_store.pixel_frame(selected_pixel, scenario=selected_scenario)
         
-        if v['y_labels'] == 'percent':
-            fig.update_yaxes(tickmode='array', range=[min(y_axis_percent_values),max(y_axis_percent_values)],
-                              tickvals = y_axis_percent_values, ticktext = y_axis_percent_labels,
-                              gridcolor='grey', row=v_i+1, col=1)
-        elif v['y_labels'] == 'temp':
-            fig.update_yaxes(tickmode='array', range=[min(y_axis_temp_values),max(y_axis_temp_values)],
-                              tickvals = y_axis_temp_values, ticktext = y_axis_temp_labels,
-                              gridcolor='grey', row=v_i+1, col=1)
-            
-    
-    # Horizontal lines 
-    hline = dict(type='line', 
-                x0=x_axis_values.min()-10,x1=x_axis_values.max()+10,
-                y0=0,y1=0, 
-                line=dict(color='black',width=2))
-    for variable_i in range(len(variable_info)):
-        fig.add_shape(hline, row=variable_i+1,col=1)
-    
-
-    # fig.update_layout(legend=dict(x=0, y=-0.5)) # if a legend is ever added this will adjust the location.
-    fig.update_layout(margin=dict(l=50, r=50, t=50, b=50))
-    fig.update_layout(title = '', height=600, plot_bgcolor='white')
-
-    return dcc.Graph(figure = fig)
+        # The hover text is made along with the plot data, see plot_store.py
+        hover_text = {v['mean_var']:plot_store.pixel_hover_text(selected_pixel, selected_scenario, v['mean_var'], pixel_data.year.values) for v in variable_info}
+        
+        return dcc.Graph(figure = build_timeseries_figure(pixel_data, hover_text))
 
 #################################################                                    
 #################################################
@@ -0,0 +1,88 @@
+/*
+Clientside versions of the update_timeseries and update_map callbacks in
+app.py. The figure layout and empty traces come from build_timeseries_figure()
+on the server, held in the timeseries-data store by build_timeseries_bundle().
+The values, and the hover text made by generate_hover_str() in plot_store.py,
+are in window.timeseries_values, from the cached script made by
+plot_store.write_timeseries_values(). So a click, tab switch, or map layer 
+change never needs a trip to the server.
+*/
+
+// Position of a pixel_id in timeseries_values.pixels, or undefined when
+// the pixel has no data. The lookup is made on first use.
+function pixel_position(pixel_id) {
+    var values = window.timeseries_values;
+    if (!values.pixel_positions) {
+        values.pixel_positions = {};
+        values.pixels.forEach(function(p, i) { values.pixel_positions[p] = i; });
+    }
+    return values.pixel_positions[pixel_id];
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    timeseries: {
+        update_timeseries: function(clickData, scenario, bundle) {
+            var values = window.timeseries_values;
+            if (scenario === 'about' || !bundle || !values || !(scenario in values.values)) {
+                // Hide the figure on the about tab
+                return [bundle ? bundle.figure : {}, {'display': 'none'}];
+            }
+
+            var selected_pixel = bundle.default_pixel;
+            if (clickData && clickData.points && clickData.points.length > 0) {
+                selected_pixel = clickData.points[0].location;
+            }
+
+            // A pixel without data gets empty traces
+            var n_years = values.n_years;
+            var position = pixel_position(selected_pixel);
+            var start = position === undefined ? 0 : position * n_years;
+            var end = position === undefined ? 0 : start + n_years;
+            var scenario_values = values.values[scenario];
+
+            var data = bundle.figure.data.map(function(trace, v_i) {
+                var v = bundle.variables[v_i];
+                var mean_values = scenario_values[v.mean_var].slice(start, end);
+                var std_values = scenario_values[v.std_var].slice(start, end);
+                var hover_text = values.hover_index[scenario][v.mean_var].slice(start, end).map(function(text_i) {
+                    return values.hover_text[text_i];
+                });
+
+                return Object.assign({}, trace, {
+                    x: values.years.slice(0, end - start),
+                    y: mean_values,
+                    error_y: Object.assign({}, trace.error_y, {array: std_values}),
+                    hovertext: hover_text
+                });
+            });
+
+            return [{data: data, layout: bundle.figure.layout}, {'display': 'block'}];
+        },
+
+        // Mirrors update_map() in app.py. Only the z values and colors of
+        // the map trace change, the geojson is reused as is.
+        update_map: function(layer, decade_i, scenario, figure, bundle) {
+            var values = window.timeseries_values;
+            if (!bundle || !figure || !values) {
+                return window.dash_clientside.no_update;
+            }
+            var trace = Object.assign({}, figure.data[0], bundle.map_styles[layer]);
+
+            if (layer === 'none') {
+                trace.z = trace.locations.map(function() { return 1; });
+            } else {
+                if (!(scenario in values.values)) {
+                    scenario = bundle.default_map_scenario;
+                }
+                var n_years = values.n_years;
+                var layer_values = values.values[scenario][layer];
+                trace.z = trace.locations.map(function(pixel_id) {
+                    var position = pixel_position(pixel_id);
+                    return position === undefined ? null : layer_values[position * n_years + decade_i];
+                });
+            }
+
+            return Object.assign({}, figure, {data: [trace]});
+        }
+    }
+});
@@ -0,0 +1,81 @@
+import numpy as np
+
+
+class PixelGrid:
+    def __init__(self, latitudes, longitudes, resolution=0.5):
+        """
+        The regular latitude/longitude grid used for the website map. Each
+        cell is identified by its lower left corner, which is how the data
+        are aggregated (ie. np.floor(latitude*2)/2 for 0.5 degree cells).
+
+        pixel_id's are assigned row major, latitude then longitude, which is
+        the same order as the rows in data/ecoregion_mask.csv. So they can be
+        found with grid arithmetic instead of a lookup table.
+
+        Parameters
+        ----------
+        latitudes : array like
+            latitude values of the cells. duplicates are ignored.
+        longitudes : array like
+            longitude values of the cells. duplicates are ignored.
+        resolution : float
+            cell size in degrees.
+        """
+        self.resolution = resolution
+        self.latitudes  = np.unique(latitudes)
+        self.longitudes = np.unique(longitudes)
+
+        self.lat_min = self.latitudes.min()
+        self.lon_min = self.longitudes.min()
+        self.n_lat   = int(round((self.latitudes.max() - self.lat_min) / resolution)) + 1
+        self.n_lon   = int(round((self.longitudes.max() - self.lon_min) / resolution)) + 1
+        self.n_pixels = self.n_lat * self.n_lon
+
+        assert self.n_lat == len(self.latitudes), 'latitudes are not a regular {r} degree grid'.format(r=resolution)
+        assert self.n_lon == len(self.longitudes), 'longitudes are not a regular {r} degree grid'.format(r=resolution)
+
+    @classmethod
+    def from_mask(cls, mask, resolution=0.5):
+        """
+        Setup the grid from the ecoregion_mask.csv data.frame, checking that the
+        row order there lines up with the pixel_id's.
+        """
+        grid = cls(mask.latitude.values, mask.longitude.values, resolution=resolution)
+
+        pixels = mask[['latitude','longitude']].drop_duplicates()
+        assert len(pixels) == grid.n_pixels, 'mask does not cover the full grid'
+        assert np.all(grid.pixel_id(pixels.latitude.values, pixels.longitude.values) == np.arange(grid.n_pixels)), 'mask rows not in latitude, longitude order'
+
+        return grid
+
+    def lat_index(self, latitude):
+        return np.floor((np.asarray(latitude) - self.lat_min) / self.resolution + 1e-6).astype(int)
+
+    def lon_index(self, longitude):
+        return np.floor((np.asarray(longitude) - self.lon_min) / self.resolution + 1e-6).astype(int)
+
+    def pixel_id(self, latitude, longitude):
+        """
+        pixel_id of the cell containing each latitude/longitude. Locations
+        outside the grid get -1.
+        """
+        lat_i = self.lat_index(latitude)
+        lon_i = self.lon_index(longitude)
+
+        inside = (lat_i >= 0) & (lat_i < self.n_lat) & (lon_i >= 0) & (lon_i < self.n_lon)
+        return np.where(inside, lat_i * self.n_lon + lon_i, -1)
+
+    def bbox_pixel_ids(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        pixel_id's of all cells which overlap a bounding box, clipped to the grid.
+        """
+        lat_i = np.arange(max(self.lat_index(min_lat), 0), min(self.lat_index(max_lat), self.n_lat - 1) + 1)
+        lon_i = np.arange(max(self.lon_index(min_lon), 0), min(self.lon_index(max_lon), self.n_lon - 1) + 1)
+
+        return (lat_i[:,None] * self.n_lon + lon_i[None,:]).ravel()
+
+    def latitude(self, pixel_id):
+        return self.lat_min + (np.asarray(pixel_id) // self.n_lon) * self.resolution
+
+    def longitude(self, pixel_id):
+        return self.lon_min + (np.asarray(pixel_id) % self.n_lon) * self.resolution
@@ -0,0 +1,345 @@
+import gzip
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from pixel_grid import PixelGrid
+
+"""
+Columnar storage of the timeseries plot data for the website. Every column
+is a separate .npy file which the webapp memory maps read only, so all the
+gunicorn workers share a single copy in the page cache and start without
+parsing a csv.
+
+Rows are sorted by pixel_id, scenario, then year. pixel_offsets.npy is the
+index, where the rows for pixel_id i are pixel_offsets[i]:pixel_offsets[i+1].
+index.json holds the column dtypes, the scenario names the scenario column
+codes refer to, and the grid used for the pixel_id's.
+
+anomaly_cube.npy has the same values as a dense float32 array with dims
+(scenario, decade, variable, pixel), where variable is value_columns and
+pixel is pixel_id. It's NaN where there is no data. Any map layer or
+pixel timeseries is then a single slice of it.
+
+The timeseries hover text is made here too. hover_text.json is a list of all
+the unique strings, and hover_index.npy the index of the string for every
+(scenario, decade, variable, pixel), with variable being hover_variables.
+
+timeseries_values.js.gz is a gzipped script, setting window.timeseries_values,
+with the anomaly cube values and hover text for only the pixels with data.
+The webapp serves it as a static, browser cached, file for the clientside
+timeseries figures and map layers (see assets/timeseries.js), so the values
+are never rebuilt as python objects by the server.
+
+Made in generate_plot_data_for_website.py. An existing csv can also be
+converted with:
+
+    python plot_store.py data/phenograss_timeseries_plot_data.csv data/ecoregion_mask.csv data/plot_store/
+"""
+
+value_columns = ['fCover_annomoly_mean','fCover_annomoly_std',
+                 'tmean_annomoly_mean','tmean_annomoly_std',
+                 'pr_anomaly_mean','pr_anomaly_std']
+
+column_dtypes = dict(pixel_id = 'int32',
+                     scenario = 'int8',
+                     year     = 'int16',
+                     **{c:'float32' for c in value_columns})
+
+# The variable name used in the hover text for each column
+hover_variables = {'fCover_annomoly_mean' : 'Grassland productivity',
+                   'tmean_annomoly_mean'  : 'Average yearly temperature',
+                   'pr_anomaly_mean'      : 'Average yearly rain'}
+
+def format_change_value(variable, change_value):
+    """ The change value as it's shown in the hover text, ie. 12% or 1.5° C """
+    if np.isnan(change_value):
+        return ''
+    if variable == 'Average yearly temperature':
+        return '{}° C'.format(round(change_value,1))
+    else:
+        return '{}%'.format(int(change_value*100))
+
+# Special function for the timeseries hover text
+# The clientside figures use the same strings, from build_timeseries_values().
+#TODO: need different wording for temperature
+def generate_hover_str(variable, timeperiod, change_value):
+    if timeperiod in ["1990's","2000's","2010's",]:
+        # dont make claims about the past
+        return ''
+    
+    change_text = format_change_value(variable, change_value)
+        
+    s = '{var} is expected to <br><b>{verb}</b> {value} by the {timeperiod} in this scenario'
+    
+    if not np.isnan(change_value):
+        change_verb = 'increase' if change_value>0 else 'decrease'
+    else:
+        return ''
+    
+    s = s.format(var        = variable,
+                 verb       = change_verb,
+                 value      = change_text,
+                 timeperiod = timeperiod)
+    
+    return s
+
+def write_plot_store(plot_data, mask, folder):
+    """
+    Write the plot data to a plot store folder.
+
+    Parameters
+    ----------
+    plot_data : pd.DataFrame
+        the timeseries plot data from generate_plot_data_for_website.py
+    mask : pd.DataFrame
+        the 0.5 degree ecoregion_mask.csv data, which defines the pixel grid.
+    folder : str
+        output folder, created if needed. existing files are overwritten.
+    """
+    grid = PixelGrid.from_mask(mask, resolution=0.5)
+
+    plot_data = plot_data.copy()
+    plot_data['pixel_id'] = grid.pixel_id(plot_data.latitude, plot_data.longitude)
+    assert (plot_data.pixel_id >= 0).all(), 'some plot data locations are outside the mask grid'
+
+    scenarios = sorted(plot_data.scenario.unique())
+    plot_data['scenario'] = plot_data.scenario.map({s:i for i, s in enumerate(scenarios)})
+    plot_data = plot_data.sort_values(['pixel_id','scenario','year'])
+
+    os.makedirs(folder, exist_ok=True)
+    for col, dtype in column_dtypes.items():
+        np.save(os.path.join(folder, col + '.npy'), plot_data[col].values.astype(dtype))
+
+    pixel_offsets = np.searchsorted(plot_data.pixel_id.values, np.arange(grid.n_pixels + 1))
+    np.save(os.path.join(folder, 'pixel_offsets.npy'), pixel_offsets.astype('int64'))
+
+    decades = np.unique(plot_data.year.values)
+    np.save(os.path.join(folder, 'anomaly_cube.npy'), build_anomaly_cube(plot_data, len(scenarios), decades, grid.n_pixels))
+
+    hover_index, hover_text = build_hover_index(plot_data, len(scenarios), decades, grid.n_pixels)
+    np.save(os.path.join(folder, 'hover_index.npy'), hover_index)
+    with open(os.path.join(folder, 'hover_text.json'), 'w') as f:
+        json.dump(hover_text, f)
+
+    pixels = mask[['latitude','longitude','ecoregion_mask']].drop_duplicates(['latitude','longitude'])
+    np.save(os.path.join(folder, 'ecoregion_mask.npy'), pixels.ecoregion_mask.values.astype(bool))
+
+    index = {'columns'   : column_dtypes,
+             'scenarios' : scenarios,
+             'n_rows'    : len(plot_data),
+             'cube'      : {'dims'      : ['scenario','decade','variable','pixel'],
+                            'decades'   : decades.tolist(),
+                            'variables' : value_columns},
+             'hover'     : {'dims'      : ['scenario','decade','variable','pixel'],
+                            'variables' : list(hover_variables)},
+             'grid'      : {'lat_min'    : float(grid.lat_min),
+                            'lon_min'    : float(grid.lon_min),
+                            'n_lat'      : grid.n_lat,
+                            'n_lon'      : grid.n_lon,
+                            'resolution' : grid.resolution}}
+    with open(os.path.join(folder, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+
+    write_timeseries_values(PlotStore(folder), os.path.join(folder, timeseries_values_file))
+
+def build_anomaly_cube(plot_data, n_scenarios, decades, n_pixels):
+    """
+    Scatter the plot data into a (scenario, decade, variable, pixel) array.
+    plot_data should have the pixel_id and scenario codes already assigned.
+    """
+    cube = np.full((n_scenarios, len(decades), len(value_columns), n_pixels), np.nan, dtype=np.float32)
+
+    scenario_i = plot_data.scenario.values
+    decade_i   = np.searchsorted(decades, plot_data.year.values)
+    pixel_i    = plot_data.pixel_id.values
+    for variable_i, col in enumerate(value_columns):
+        cube[scenario_i, decade_i, variable_i, pixel_i] = plot_data[col].values
+
+    return cube
+
+def build_hover_index(plot_data, n_scenarios, decades, n_pixels):
+    """
+    Hover text for every (scenario, decade, variable, pixel). The text only
+    depends on the variable, decade, the change value as it's shown (from
+    format_change_value()), and whether it's an increase. So generate_hover_str() is only run once for
+    every unique combination of those.
+
+    Returns
+    -------
+    hover_index : int32 array of shape (scenario, decade, variable, pixel)
+    hover_text  : list of strs which hover_index refers to. 0 is an empty string,
+                  which is used where there is no data.
+    """
+    hover_index = np.zeros((n_scenarios, len(decades), len(hover_variables), n_pixels), dtype=np.int32)
+    hover_text = ['']
+
+    for variable_i, (col, variable) in enumerate(hover_variables.items()):
+        values = plot_data[col].values
+        has_data = ~np.isnan(values)
+        values = values[has_data]
+
+        decade_i = np.searchsorted(decades, plot_data.year.values[has_data])
+        # The key uses the same formatting as the text, so values which only
+        # differ after rounding never share a string they don't show.
+        shown_value = [format_change_value(variable, v) for v in values]
+
+        key_i, _ = pd.MultiIndex.from_arrays([decade_i, shown_value, values > 0]).factorize()
+        _, first_i = np.unique(key_i, return_index=True)
+
+        hover_index[plot_data.scenario.values[has_data],
+                    decade_i,
+                    variable_i,
+                    plot_data.pixel_id.values[has_data]] = key_i.ravel() + len(hover_text)
+
+        hover_text.extend([generate_hover_str(variable, "{y}'s".format(y=decades[decade_i[i]]), values[i]) for i in first_i])
+
+    return hover_index, hover_text
+
+timeseries_values_file = 'timeseries_values.js.gz'
+
+def build_timeseries_values(store):
+    """
+    The anomaly cube values of a PlotStore for the clientside figures, for only 
+    the pixels with data. pixels is the pixel_id of each of those, and every 
+    scenario/variable entry in values is a flat list ordered by the position 
+    in pixels, then decade. So the values for pixels[i] are at 
+    [i*n_years:(i+1)*n_years]. Missing values are None, since json has no NaN.
+
+    hover_index is the same for the hover text of each hover_variables column,
+    as the position of the string in hover_text.
+    """
+    pixels = store.pixels_with_data()
+    n_years = len(store.decades)
+
+    values = {}
+    for scenario_i, scenario in enumerate(store.scenarios):
+        values[scenario] = {}
+        for variable_i, col in enumerate(store.cube_variables):
+            # (decade, pixel) slice of the cube, flattened pixel first
+            v = store.anomaly_cube[scenario_i, :, variable_i, :][:, pixels]
+            v = np.round(v.T.astype(float), 4).ravel()
+            values[scenario][col] = [None if np.isnan(x) else x for x in v.tolist()]
+
+    hover_index = {}
+    for scenario_i, scenario in enumerate(store.scenarios):
+        hover_index[scenario] = {}
+        for variable_i, col in enumerate(store.hover_variables):
+            hover_index[scenario][col] = store.hover_index[scenario_i, :, variable_i, :][:, pixels].T.ravel().tolist()
+
+    return {'n_years'     : n_years,
+            'years'       : store.decades.tolist(),
+            'pixels'      : pixels.tolist(),
+            'values'      : values,
+            'hover_index' : hover_index,
+            'hover_text'  : store.hover_text.tolist()}
+
+def write_timeseries_values(store, filename):
+    """
+    Write build_timeseries_values() as a gzipped script which sets 
+    window.timeseries_values. The gzip header has no timestamp, so the same 
+    data always gives the same file (and etag).
+    """
+    script = 'window.timeseries_values = ' + json.dumps(build_timeseries_values(store), separators=(',',':')) + ';\n'
+    with open(filename, 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as gz:
+            gz.write(script.encode('utf-8'))
+
+class PlotStore:
+    def __init__(self, folder):
+        """
+        Read only access to a plot store folder. The columns are memory mapped,
+        so nothing is read from disk until it's used.
+        """
+        with open(os.path.join(folder, 'index.json')) as f:
+            self.index = json.load(f)
+
+        self.scenarios = self.index['scenarios']
+        self.scenario_codes = {s:i for i, s in enumerate(self.scenarios)}
+
+        g = self.index['grid']
+        self.grid = PixelGrid(latitudes  = g['lat_min'] + np.arange(g['n_lat']) * g['resolution'],
+                              longitudes = g['lon_min'] + np.arange(g['n_lon']) * g['resolution'],
+                              resolution = g['resolution'])
+
+        self.columns = {c:np.load(os.path.join(folder, c + '.npy'), mmap_mode='r') for c in self.index['columns']}
+        self.pixel_offsets = np.load(os.path.join(folder, 'pixel_offsets.npy'), mmap_mode='r')
+        self.ecoregion_mask = np.load(os.path.join(folder, 'ecoregion_mask.npy'), mmap_mode='r')
+
+        self.anomaly_cube = np.load(os.path.join(folder, 'anomaly_cube.npy'), mmap_mode='r')
+        self.decades = np.array(self.index['cube']['decades'])
+        self.cube_variables = self.index['cube']['variables']
+
+        self.hover_index = np.load(os.path.join(folder, 'hover_index.npy'), mmap_mode='r')
+        self.hover_variables = self.index['hover']['variables']
+        with open(os.path.join(folder, 'hover_text.json')) as f:
+            self.hover_text = np.array(json.load(f), dtype=object)
+
+    def __len__(self):
+        return self.index['n_rows']
+
+    def pixels_with_data(self):
+        """ pixel_id's which have at least one row """
+        return np.flatnonzero(np.diff(self.pixel_offsets) > 0)
+
+    def pixel_rows(self, pixel_ids):
+        """ row numbers for one or more pixel_id's """
+        pixel_ids = np.atleast_1d(pixel_ids)
+        return np.concatenate([np.arange(self.pixel_offsets[p], self.pixel_offsets[p+1]) for p in pixel_ids])
+
+    def frame(self, rows, scenario=None):
+        """
+        A data.frame, with the same columns as the plot data csv, of the
+        requested rows. rows can be a slice or array of row numbers. Optionally
+        also subset to a single scenario.
+        """
+        df = pd.DataFrame({c:np.asarray(values[rows]) for c, values in self.columns.items()})
+        if scenario is not None:
+            df = df[df.scenario == self.scenario_codes[scenario]].copy()
+
+        df['scenario']  = np.array(self.scenarios)[df.scenario.values]
+        df['latitude']  = self.grid.latitude(df.pixel_id.values)
+        df['longitude'] = self.grid.longitude(df.pixel_id.values)
+        return df.reset_index(drop=True)
+
+    def pixel_frame(self, pixel_id, scenario=None):
+        """ All rows for a single pixel_id, optionally a single scenario """
+        return self.frame(slice(self.pixel_offsets[pixel_id], self.pixel_offsets[pixel_id+1]), scenario=scenario)
+
+    def map_layer(self, scenario, decade, variable, pixel_ids=None):
+        """
+        Values of a single variable for every pixel, or just pixel_ids, for
+        a scenario and decade. For every pixel this is a view into the
+        anomaly cube, so no data is copied.
+        """
+        layer = self.anomaly_cube[self.scenario_codes[scenario],
+                                  int(np.searchsorted(self.decades, decade)),
+                                  self.cube_variables.index(variable)]
+        if pixel_ids is not None:
+            layer = layer[pixel_ids]
+        return layer
+
+    def pixel_hover_text(self, pixel_id, scenario, variable, years):
+        """
+        The precomputed hover text for a pixel/scenario/variable for each of
+        years, which should be decades from the plot data.
+        """
+        decade_i = np.searchsorted(self.decades, years)
+        return self.hover_text[self.hover_index[self.scenario_codes[scenario],
+                                                decade_i,
+                                                self.hover_variables.index(variable),
+                                                pixel_id]]
+
+    def mask_frame(self):
+        """ The pixel grid as a data.frame like ecoregion_mask.csv, in pixel_id order """
+        pixel_ids = np.arange(self.grid.n_pixels)
+        return pd.DataFrame({'latitude'       : self.grid.latitude(pixel_ids),
+                             'longitude'      : self.grid.longitude(pixel_ids),
+                             'ecoregion_mask' : np.asarray(self.ecoregion_mask)})
+
+if __name__ == '__main__':
+    plot_data_csv, mask_csv, folder = sys.argv[1:4]
+    write_plot_store(pd.read_csv(plot_data_csv), pd.read_csv(mask_csv), folder)
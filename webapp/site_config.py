@@ -1,8 +1,12 @@
 
 
-
 climatology_years = range(1990,2011)
 display_years = range(1990,2100)
 year_resolution = 10 # final figure will display the average of this many years.
 
-debug=True
\ No newline at end of file
+# Render the timeseries figures in the browser from a data bundle sent along
+# with the page. When False every click/tab switch goes through the server
+# callback instead.
+clientside_timeseries = True
+
+debug=True